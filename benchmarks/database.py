@@ -0,0 +1,175 @@
+"""
+Compares the memory, sqlite and redis databases on the workloads the bot puts on them: batched history writes,
+history reads, and small set and hash commands like the ignore list's.
+
+Run from the repository root:
+    python benchmarks/database.py [--entries N] [--redis HOST:PORT]
+
+Redis is skipped if it can't be reached. The redis database's contents are deleted.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from obrbot.database import MemoryDatabase, SQLiteDatabase, RedisClient  # noqa: E402
+from obrbot.history import ZSetHistoryBackend, encode_record, next_sequence  # noqa: E402
+from obrbot.event import EventType  # noqa: E402
+
+CHANNELS = 20
+BATCH_SIZE = 500
+
+
+@asyncio.coroutine
+def write_history(db, entries):
+    backend = ZSetHistoryBackend(db)
+    batch = []
+    start = time.time() - entries
+    for index in range(entries):
+        key = backend.key("bench", "#channel{}".format(index % CHANNELS))
+        record = encode_record(next_sequence(), EventType.message, ("nick", "message number {}".format(index)))
+        batch.append((key, record, start + index))
+        if len(batch) >= BATCH_SIZE or index == entries - 1:
+            pipeline = db.pipeline(transaction=False)
+            by_key = {}
+            for key, record, timestamp in batch:
+                by_key.setdefault(key, []).extend((timestamp, record))
+            for key, key_entries in by_key.items():
+                backend.queue_writes(pipeline, key, key_entries)
+            yield from pipeline.execute()
+            batch = []
+    return entries
+
+
+@asyncio.coroutine
+def read_history(db, entries):
+    backend = ZSetHistoryBackend(db)
+    start = time.time() - entries
+    reads = entries // 100
+    for index in range(reads):
+        key = backend.key("bench", "#channel{}".format(index % CHANNELS))
+        low = start + (index * 97) % entries
+        yield from db.zrangebyscore(key, low, low + 2000, start=0, num=100, withscores=True)
+    return reads
+
+
+@asyncio.coroutine
+def page_history(db, entries):
+    backend = ZSetHistoryBackend(db)
+    pages = 0
+    for channel in range(CHANNELS):
+        position = None
+        while True:
+            page, position = yield from backend.read_page(backend.key("bench", "#channel{}".format(channel)),
+                                                          position, 200)
+            pages += 1
+            if position is None:
+                break
+    return pages
+
+
+@asyncio.coroutine
+def set_commands(db, entries):
+    commands = entries // 10
+    for index in range(commands):
+        yield from db.sadd("bench:ignored", "*!*@host{}".format(index % 50))
+        yield from db.smembers("bench:ignored")
+    return commands * 2
+
+
+@asyncio.coroutine
+def hash_commands(db, entries):
+    commands = entries // 10
+    for index in range(commands):
+        yield from db.hincrby("bench:counters", "field{}".format(index % 50))
+        yield from db.hgetall("bench:counters")
+    return commands * 2
+
+
+@asyncio.coroutine
+def scan_keys(db, entries):
+    scans = 0
+    for _ in range(10):
+        cursor = 0
+        while True:
+            cursor, keys = yield from db.scan(cursor, match="obrbot:connections:bench:*", count=100)
+            scans += 1
+            if cursor == 0:
+                break
+    return scans
+
+
+workloads = (
+    ("history writes", write_history),
+    ("history reads", read_history),
+    ("history pages", page_history),
+    ("set commands", set_commands),
+    ("hash commands", hash_commands),
+    ("key scans", scan_keys),
+)
+
+
+@asyncio.coroutine
+def clear(db):
+    cursor = 0
+    while True:
+        cursor, keys = yield from db.scan(cursor, match="obrbot:connections:bench:*", count=1000)
+        if keys:
+            yield from db.delete(*keys)
+        if cursor == 0:
+            break
+    yield from db.delete("bench:ignored", "bench:counters")
+
+
+@asyncio.coroutine
+def run(db, entries):
+    yield from clear(db)
+    results = []
+    for name, workload in workloads:
+        start = time.perf_counter()
+        operations = yield from workload(db, entries)
+        results.append((name, operations, time.perf_counter() - start))
+    yield from clear(db)
+    return results
+
+
+@asyncio.coroutine
+def open_redis(address, loop):
+    host, _, port = address.partition(":")
+    db = RedisClient(host, int(port or 6379), loop=loop)
+    try:
+        yield from asyncio.wait_for(db.ping(), 2, loop=loop)
+    except (OSError, asyncio.TimeoutError) as e:
+        print("Skipping redis, couldn't connect to {}: {}".format(address, e))
+        db.close()
+        return None
+    return db
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--entries", type=int, default=20000, help="number of history entries to write")
+    parser.add_argument("--redis", default="localhost:6379", help="address of the redis server to use")
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    directory = tempfile.mkdtemp()
+    databases = [MemoryDatabase(loop=loop), SQLiteDatabase(os.path.join(directory, "bench.db"), loop=loop)]
+    redis_db = loop.run_until_complete(open_redis(args.redis, loop))
+    if redis_db is not None:
+        databases.append(redis_db)
+
+    print("{:<10} {:<16} {:>10} {:>10} {:>12}".format("database", "workload", "operations", "seconds", "ops/second"))
+    for db in databases:
+        for name, operations, duration in loop.run_until_complete(run(db, args.entries)):
+            print("{:<10} {:<16} {:>10} {:>10.3f} {:>12.0f}".format(db.name, name, operations, duration,
+                                                                  operations / duration))
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Compares CaseInsensitiveDict, which folds keys through a cached IRC casemapping, with the str.lower() based dict it
+replaced, on the lookups the bot does for every event: nick and channel membership tests, gets and sets.
+
+Run from the repository root:
+    python benchmarks/dictionaries.py [--keys N] [--rounds N]
+"""
+import argparse
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from obrbot.util.dictionaries import CaseInsensitiveDict  # noqa: E402
+
+
+class LowerDict(dict):
+    """
+    The dict CaseInsensitiveDict replaced, which folds each key with str.lower()
+    """
+
+    def get(self, k, d=None):
+        return super().get(k.lower() if k is not None else k, d)
+
+    def __contains__(self, k):
+        return super().__contains__(k.lower() if k is not None else k)
+
+    def __getitem__(self, k):
+        return super().__getitem__(k.lower() if k is not None else k)
+
+    def __setitem__(self, k, v):
+        return super().__setitem__(k.lower() if k is not None else k, v)
+
+
+def workloads(keys):
+    """
+    :rtype: list[(str, callable)]
+    """
+    present = ["Nick{}[away]".format(index) for index in range(keys)]
+    missing = ["Other{}|afk".format(index) for index in range(keys)]
+
+    def contains(d):
+        for key in present:
+            key in d
+
+    def get_missing(d):
+        for key in missing:
+            d.get(key)
+
+    def get(d):
+        for key in present:
+            d[key]
+
+    def set_(d):
+        for key in present:
+            d[key] = None
+
+    return [("contains", contains), ("get missing", get_missing), ("getitem", get), ("setitem", set_)], present
+
+
+def allocated(function, d):
+    """
+    Measures the most memory a workload had allocated at once, above what was in use before it started. Keys which
+    are folded into a new string each time show up here, even though each string is freed straight after.
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    function(d)
+    peak = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--keys", type=int, default=1000, help="number of nicks in the dict")
+    parser.add_argument("--rounds", type=int, default=200, help="times to run each workload")
+    args = parser.parse_args()
+
+    tests, present = workloads(args.keys)
+    print("{:<22} {:<12} {:>14} {:>12}".format("dict", "workload", "ns per lookup", "peak bytes"))
+    for cls in (LowerDict, CaseInsensitiveDict):
+        d = cls()
+        for key in present:
+            d[key] = None
+        for name, function in tests:
+            seconds = min(timeit.repeat(lambda: function(d), number=args.rounds, repeat=5))
+            nanoseconds = seconds / (args.rounds * args.keys) * 1e9
+            print("{:<22} {:<12} {:>14.1f} {:>12}".format(cls.__name__, name, nanoseconds, allocated(function, d)))
+
+
+if __name__ == "__main__":
+    main()
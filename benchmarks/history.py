@@ -0,0 +1,74 @@
+"""
+Measures the memory used by each channel's in-memory recent history: the HistoryRing the bot keeps, against the
+deque of (EventType, nick, datetime, content) tuples it replaced, with every channel full.
+
+Run from the repository root:
+    python benchmarks/history.py [--channels N] [--size N] [--speakers N]
+"""
+import argparse
+from collections import deque
+import datetime
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from obrbot.event import EventType  # noqa: E402
+from obrbot.util.ringbuffer import HistoryRing  # noqa: E402
+
+# messages are mostly short, and each is a new string, like parsing lines from the server would make
+CONTENT = "short message"
+
+
+def events(channels, size, speakers):
+    """
+    Yields (channel index, nick, content) for every event, making new strings for each
+    """
+    for index in range(channels * size):
+        yield index % channels, "speaker{}".format(index % speakers), CONTENT + str(index % 10)
+
+
+def ring(channels, size, speakers):
+    histories = [HistoryRing(size) for _ in range(channels)]
+    for channel, nick, content in events(channels, size, speakers):
+        histories[channel].append(EventType.message, nick, content)
+    return histories
+
+
+def tuples(channels, size, speakers):
+    histories = [deque(maxlen=size) for _ in range(channels)]
+    for channel, nick, content in events(channels, size, speakers):
+        histories[channel].append((EventType.message, nick, datetime.datetime.utcnow(), content))
+    return histories
+
+
+def measure(function, channels, size, speakers):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = function(channels, size, speakers)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--channels", type=int, default=500, help="number of channels")
+    parser.add_argument("--size", type=int, default=100, help="events kept per channel")
+    parser.add_argument("--speakers", type=int, default=2000, help="number of distinct nicks speaking")
+    args = parser.parse_args()
+
+    events_kept = args.channels * args.size
+    print("{} channels keeping {} events each".format(args.channels, args.size))
+    print("{:<8} {:>12} {:>16} {:>20}".format("layout", "total bytes", "bytes per event", "read all (ms)"))
+    for name, function in (("ring", ring), ("tuples", tuples)):
+        used, histories = measure(function, args.channels, args.size, args.speakers)
+        seconds = min(timeit.repeat(lambda: [list(history) for history in histories], number=1, repeat=5))
+        print("{:<8} {:>12} {:>16.1f} {:>20.2f}".format(name, used, used / events_kept, seconds * 1000))
+        del histories
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Measures the memory used to track channel members: shared User objects with per-channel Memberships, as the bot
+keeps them, against a separate user object per channel membership, as it used to.
+
+Run from the repository root:
+    python benchmarks/users.py [--memberships N] [--channels-per-user N]
+"""
+import argparse
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from obrbot.connection import Channel, Membership, UserRegistry  # noqa: E402
+from obrbot.util.dictionaries import CaseInsensitiveDict  # noqa: E402
+
+CHANNELS = 500
+HOSTS = 200
+
+
+class UnsharedUser:
+    """
+    A user as tracked before Users were shared, with one per channel membership
+    """
+
+    def __init__(self, nick, *, ident=None, host=None, mask=None, mode=''):
+        self.nick = nick
+        self.ident = ident
+        self.host = host
+        self.mask = mask
+        self.mask_known = mask is not None
+        self.mode = mode
+
+
+def members(memberships, channels_per_user):
+    """
+    Yields (channel index, nick, ident, host) for each membership, making new strings for each like parsing lines
+    from the server would
+    """
+    for index in range(memberships):
+        user = index // channels_per_user
+        channel = (user * 7 + index % channels_per_user * 31) % CHANNELS
+        yield channel, "nick{}".format(user), "ident{}".format(user), "cloak/{}/user".format(user % HOSTS)
+
+
+def shared(memberships, channels_per_user):
+    registry = UserRegistry()
+    channels = [Channel("bench", "#channel{}".format(index)) for index in range(CHANNELS)]
+    for channel, nick, ident, host in members(memberships, channels_per_user):
+        channel = channels[channel]
+        channel.users[nick] = Membership(registry.add(nick, channel, ident=ident, host=host))
+    return registry, channels
+
+
+def unshared(memberships, channels_per_user):
+    channels = [CaseInsensitiveDict() for _ in range(CHANNELS)]
+    for channel, nick, ident, host in members(memberships, channels_per_user):
+        channels[channel][nick] = UnsharedUser(nick, ident=ident, host=host,
+                                               mask="{}!{}@{}".format(nick, ident, host))
+    return channels
+
+
+def measure(function, memberships, channels_per_user):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = function(memberships, channels_per_user)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del result
+    return used
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--memberships", type=int, default=100000, help="number of channel memberships")
+    parser.add_argument("--channels-per-user", type=int, default=5, help="number of channels each user is in")
+    args = parser.parse_args()
+
+    print("{} memberships, {} users in {} channels".format(args.memberships, args.memberships // args.channels_per_user,
+                                                           CHANNELS))
+    print("{:<10} {:>14} {:>22}".format("layout", "total bytes", "bytes per 100k members"))
+    for name, function in (("shared", shared), ("unshared", unshared)):
+        used = measure(function, args.memberships, args.channels_per_user)
+        print("{:<10} {:>14} {:>22.0f}".format(name, used, used / args.memberships * 100000))
+
+
+if __name__ == "__main__":
+    main()
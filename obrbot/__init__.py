@@ -56,12 +56,23 @@ def _setup():
                 "formatter": "full",
                 "level": "INFO",
                 "filename": os.path.join(logging_dir, "bot.log")
+            },
+            "slow_hooks": {
+                "class": "logging.FileHandler",
+                "formatter": "full",
+                "level": "INFO",
+                "filename": os.path.join(logging_dir, "slow_hooks.log")
             }
         },
         "loggers": {
             "obrbot": {
                 "level": "DEBUG",
                 "handlers": ["console", "file"]
+            },
+            "obrbot.slow_hooks": {
+                "level": "INFO",
+                "handlers": ["slow_hooks"],
+                "propagate": False
             }
         }
     }
@@ -19,6 +19,7 @@ os.chdir(path0)
 
 # import bot
 from obrbot.bot import ObrBot
+from obrbot.handover import export_handover
 
 
 def main():
@@ -61,6 +62,9 @@ def main():
 
     # the bot has stopped, do we want to restart?
     if restart:
+        # connections being handed over are passed to the new process through the environment
+        if bot.handover:
+            export_handover(bot.handover)
         # remove reference to obrbot, so exit_gracefully won't try to stop it
         bot = None
         # sleep one second for timeouts
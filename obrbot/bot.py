@@ -11,6 +11,15 @@ from obrbot.config import Config
 from obrbot.plugin import PluginManager
 from obrbot.event import Event, CommandHookEvent, RegexHookEvent, EventType
 from obrbot.clients.irc import IrcConnection
+from obrbot.watchdog import LoopLagMonitor
+from obrbot.metrics import CommandMetrics, MeteredThreadPoolExecutor
+from obrbot.metrics_server import MetricsServer
+from obrbot.tracing import Tracer
+from obrbot.database import create_database, DatabaseError
+from obrbot.handover import take_handover, close_handover
+from obrbot.history import HistoryCompactor, create_history_backend
+from obrbot.search import SearchIndex
+from obrbot.stats import ChannelStats
 
 logger = logging.getLogger("bot")
 
@@ -23,6 +32,24 @@ def clean_name(n):
     return re.sub('\s+', '', n.lower())
 
 
+class _MeteredRedis(redis.StrictRedis):
+    """
+    A StrictRedis which records the latency of every command it runs
+    :type command_metrics: CommandMetrics
+    """
+
+    def __init__(self, *args, command_metrics, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.command_metrics = command_metrics
+
+    def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            self.command_metrics.record(args[0].lower(), time.perf_counter() - start)
+
+
 class ObrBot:
     """
     :type start_time: float
@@ -30,10 +57,20 @@ class ObrBot:
     :type connections: list[Connection | IrcConnection]
     :type config: core.config.Config
     :type plugin_manager: PluginManager
-    :type db: redis.StrictRedis
+    :type db: obrbot.database.Database
+    :type db_metrics: CommandMetrics
+    :type history_backend: obrbot.history.ZSetHistoryBackend | obrbot.history.StreamHistoryBackend
+    :type history_compactor: HistoryCompactor
+    :type search_index: SearchIndex
+    :type channel_stats: ChannelStats
+    :type executor: MeteredThreadPoolExecutor
+    :type loop_monitor: LoopLagMonitor
+    :type metrics_server: MetricsServer
+    :type tracer: Tracer
     :type loop: asyncio.events.AbstractEventLoop
     :type stopped_future: asyncio.Future
     :param: stopped_future: Future that will be given a result when the bot has stopped.
+    :param: db: the database, whose commands are coroutines. Threaded hooks can use sync_db instead, with redis.
     """
 
     def __init__(self, loop=asyncio.get_event_loop()):
@@ -46,19 +83,69 @@ class ObrBot:
 
         # stores each bot server connection
         self.connections = []
+        # connections handed over by the bot we restarted from, and those we're handing over when restarting
+        self._handed_over = take_handover()
+        self.handover = {}
 
         # set up config
         self.config = Config(self)
         logger.debug("Config system initialised.")
 
+        # set up the executor used for threaded hooks and blocking calls
+        self.executor = MeteredThreadPoolExecutor(self.config.get("executor_threads", 5))
+        self.loop.set_default_executor(self.executor)
+
         # setup db
         db_config = self.config.get('database')
-        db_host = db_config.get('host', 'localhost')
-        db_port = db_config.get('port', 6379)
-        db_database = db_config.get('database', 0)
-        logger.info("Connecting to redis at {}:{}/{}".format(db_host, db_port, db_database))
-        self.db = redis.StrictRedis(host=db_host, port=db_port, db=db_database)
-        logger.debug("Database system initialised.")
+        self.db_metrics = CommandMetrics()
+        self.db = create_database(db_config, loop=self.loop, command_metrics=self.db_metrics)
+        self._sync_db = None
+        self.history_backend = create_history_backend(self.db, db_config)
+        logger.debug("Database system initialised, storing history in {}s.".format(self.history_backend.name))
+
+        # set up history search, and retention
+        history_config = self.config.get("history", {})
+        self.search_index = SearchIndex(self.db, self.history_backend, self.loop,
+                                        enabled=history_config.get("search_enabled", True),
+                                        max_tokens=history_config.get("search_max_tokens", 32),
+                                        interval=history_config.get("flush_interval", 0.1),
+                                        max_entries=history_config.get("flush_entries", 500))
+        self.history_compactor = HistoryCompactor(self.db, self.loop,
+                                                  interval=history_config.get("compaction_interval", 600),
+                                                  scan_count=history_config.get("compaction_scan_count", 100),
+                                                  batch_size=history_config.get("compaction_batch_size", 1000),
+                                                  max_age=history_config.get("retention_max_age", 0),
+                                                  max_entries=history_config.get("retention_max_entries", 0),
+                                                  channels=history_config.get("retention_channels"),
+                                                  search_index=self.search_index,
+                                                  seen_max_age=self.config.get("seen", {}).get("max_age", 31536000))
+
+        # set up channel activity statistics
+        stats_config = self.config.get("stats", {})
+        self.channel_stats = ChannelStats(self.db, self.loop, enabled=stats_config.get("enabled", True),
+                                          interval=stats_config.get("flush_interval", 10),
+                                          retention={"minute": stats_config.get("minute_retention", 172800),
+                                                     "hour": stats_config.get("hour_retention", 7776000),
+                                                     "day": stats_config.get("day_retention", 63072000)})
+
+        # set up loop lag monitoring
+        metrics_config = self.config.get("metrics", {})
+        self.loop_monitor = LoopLagMonitor(self.loop, interval=metrics_config.get("loop_lag_interval", 0.25),
+                                           threshold=metrics_config.get("loop_lag_threshold", 0.1),
+                                           slow_callback_debug=metrics_config.get("loop_slow_callback_debug", False))
+
+        # set up event tracing
+        self.tracer = Tracer(sample_rate=metrics_config.get("trace_sample_rate", 0.01),
+                             slow_threshold=metrics_config.get("trace_slow_threshold", 1),
+                             max_traces=metrics_config.get("trace_buffer_size", 1000))
+
+        # set up the metrics endpoint
+        if metrics_config.get("http_enabled", False):
+            self.metrics_server = MetricsServer(self, host=metrics_config.get("http_host", "127.0.0.1"),
+                                                port=metrics_config.get("http_port", 9197),
+                                                unix_socket=metrics_config.get("http_unix_socket"))
+        else:
+            self.metrics_server = None
 
         # Bot initialisation complete
         logger.debug("Bot setup completed.")
@@ -68,6 +155,20 @@ class ObrBot:
 
         self.plugin_manager = PluginManager(self)
 
+    @property
+    def sync_db(self):
+        """
+        A blocking redis-py client, for threaded hooks which can't use the asyncio client in bot.db. It is only
+        created when first used, and is only available when the database is redis.
+        :rtype: redis.StrictRedis
+        """
+        if self.db.name != "redis":
+            raise DatabaseError("sync_db is only available with the redis database, not {}".format(self.db.name))
+        if self._sync_db is None:
+            self._sync_db = _MeteredRedis(host=self.db.host, port=self.db.port, db=self.db.db,
+                                          command_metrics=self.db_metrics)
+        return self._sync_db
+
     def run(self):
         """
         Starts ObrBot.
@@ -97,10 +198,25 @@ class ObrBot:
             logger.debug("[{}] Created connection.".format(name))
 
     @asyncio.coroutine
-    def stop(self, reason=None, *, restart=False):
-        """quits all networks and shuts the bot down"""
+    def stop(self, reason=None, *, restart=False, handover=False):
+        """
+        quits all networks and shuts the bot down
+        :param handover: When restarting, hand the connections which can be handed over to the restarted bot, rather
+                         than quitting them
+        """
         logger.info("Stopping.")
 
+        # save our channels while we're still in them, so they're warm after a restart
+        yield from asyncio.gather(*[conn.snapshots.save() for conn in self.connections], loop=self.loop)
+        for conn in self.connections:
+            conn.snapshots.stop()
+
+        if restart and handover:
+            for connection in self.connections:
+                state = connection.detach()
+                if state is not None:
+                    self.handover[connection.name] = state
+
         for connection in self.connections:
             if not connection.connected:
                 # Don't quit a connection that hasn't connected
@@ -117,16 +233,37 @@ class ObrBot:
                 continue
             connection.close()
 
+        # write buffered history before on_stop hooks run, so they see all of it
+        yield from asyncio.gather(*[conn.history_writer.flush() for conn in self.connections], loop=self.loop)
+
         yield from self.plugin_manager.run_shutdown_hooks()
 
+        yield from asyncio.gather(*[conn.history_writer.close() for conn in self.connections], loop=self.loop)
+        yield from self.search_index.close()
+        yield from asyncio.gather(*[conn.seen.close() for conn in self.connections], loop=self.loop)
+        yield from self.channel_stats.close()
+
+        self.plugin_manager.watchdog.stop()
+        self.loop_monitor.stop()
+        self.history_compactor.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+
+        self.db.close()
+
         self.running = False
         # Give the stopped_future a result, so that run() will exit
         self.stopped_future.set_result(restart)
 
     @asyncio.coroutine
-    def restart(self, reason=None):
-        """shuts the bot down and restarts it"""
-        yield from self.stop(reason=reason, restart=True)
+    def restart(self, reason=None, *, handover=None):
+        """
+        shuts the bot down and restarts it
+        :param handover: Whether to hand connections over to the restarted bot, defaulting to the restart config
+        """
+        if handover is None:
+            handover = self.config.get("restart", {}).get("handover", False)
+        yield from self.stop(reason=reason, restart=True, handover=handover)
 
     @asyncio.coroutine
     def _init_routine(self):
@@ -138,17 +275,56 @@ class ObrBot:
             logger.info("Killed while loading, exiting")
             return
 
-        # Connect to servers
-        yield from asyncio.gather(*[conn.connect() for conn in self.connections], loop=self.loop)
+        # Start watching for slow hooks and loop lag
+        self.plugin_manager.watchdog.start()
+        self.loop_monitor.start()
+
+        # Start trimming old history
+        self.history_compactor.start()
+
+        # Serve metrics
+        if self.metrics_server is not None:
+            try:
+                yield from self.metrics_server.start()
+            except OSError:
+                logger.exception("Couldn't start metrics server on {}".format(self.metrics_server.describe()))
+
+        # Read what our channels were like before we restarted, then connect to servers, or take over the
+        # connections we were handed
+        yield from asyncio.gather(*[conn.snapshots.load() for conn in self.connections], loop=self.loop)
+        yield from asyncio.gather(*[self._connect(conn) for conn in self.connections], loop=self.loop)
+        for state in self._handed_over.values():
+            close_handover(state)
+        self._handed_over.clear()
+        for conn in self.connections:
+            conn.snapshots.start()
 
         # Run a manual garbage collection cycle, to clean up any unused objects created during initialization
         gc.collect()
 
+    @asyncio.coroutine
+    def _connect(self, conn):
+        """
+        Adopts a connection if it was handed over, otherwise connects it
+        :type conn: obrbot.connection.Connection
+        """
+        state = self._handed_over.pop(conn.name, None)
+        if state is not None:
+            try:
+                yield from conn.adopt(state)
+                return
+            except OSError:
+                logger.exception("[{}] Couldn't adopt handed over connection, reconnecting".format(conn.name))
+                close_handover(state)
+        yield from conn.connect()
+
     @asyncio.coroutine
     def process(self, event):
         """
         :type event: Event
         """
+        if event.trace is not None:
+            event.trace.mark("dispatched")
         first = []
         tasks = []
         command_prefix = event.conn.config.get('command_prefix', '.')
@@ -177,7 +353,8 @@ class ObrBot:
 
         if event.type is EventType.message:
             # Commands
-            if event.chan_name.lower() == event.nick.lower():  # private message, no command prefix
+            casemapping = event.conn.casemapping
+            if casemapping.fold(event.chan_name) == casemapping.fold(event.nick):  # private message, no command prefix
                 command_re = r'(?i)^(?:[{}]?|{}[,;:]+\s+)([\w-]+)(?:$|\s+)(.*)'.format(command_prefix,
                                                                                        event.conn.bot_nick)
             else:
@@ -1,10 +1,16 @@
 from _ssl import PROTOCOL_SSLv23
 import asyncio
+import base64
+import os
 import re
+import socket
 import ssl
 import logging
+import time
 from ssl import SSLContext
 
+from obrbot.clients.isupport import ISupport
+from obrbot.clients.who import WhoQueue
 from obrbot.connection import Connection, Channel
 from obrbot.event import Event, EventType, IrcEvent
 
@@ -15,6 +21,16 @@ irc_noprefix_re = re.compile(r"([^ ]*) (.*)")
 irc_netmask_re = re.compile(r"([^!@]*)!([^@]*)@(.*)")
 irc_param_re = re.compile(r"(?:^|(?<= ))(:.*|[^ ]+)")
 
+# numerics which are replies about a channel, with the channel after our nick
+channel_reply_commands = frozenset(("324", "366", "367", "348", "346"))
+
+# the longest ident and host a server is likely to give us, for when we don't know our own mask yet
+MAX_IDENT_LENGTH = 10
+MAX_HOST_LENGTH = 63
+
+# dispatched in place of 004 after adopting a handed over connection, so connection-scoped setup hooks run again
+CONNECTED_COMMAND = "CONNECTED"
+
 irc_command_to_event_type = {
     'PRIVMSG': EventType.message,
     'JOIN': EventType.join,
@@ -26,9 +42,50 @@ irc_command_to_event_type = {
 }
 
 
+def _truncate_utf8(data, max_bytes):
+    """
+    Cuts UTF-8 data to at most max_bytes bytes, without splitting a character
+    :type data: bytes
+    :type max_bytes: int
+    :rtype: bytes
+    """
+    if len(data) <= max_bytes:
+        return data
+    cut = max_bytes
+    # back up over continuation bytes to the start of the character
+    while cut > 0 and data[cut] & 0xC0 == 0x80:
+        cut -= 1
+    return data[:cut]
+
+
+def split_text(text, max_bytes):
+    """
+    Splits text into pieces of at most max_bytes bytes when encoded as UTF-8, at spaces where possible
+    :type text: str
+    :type max_bytes: int
+    :rtype: list[str]
+    """
+    data = text.encode("utf-8")
+    pieces = []
+    while len(data) > max_bytes:
+        cut = data.rfind(b" ", 0, max_bytes + 1)
+        if cut > 0:
+            pieces.append(data[:cut])
+            data = data[cut + 1:]
+        else:
+            piece = _truncate_utf8(data, max_bytes) or data[:max_bytes]
+            pieces.append(piece)
+            data = data[len(piece):]
+    if data or not pieces:
+        pieces.append(data)
+    return [piece.decode("utf-8", "replace") for piece in pieces]
+
+
 class IrcConnection(Connection):
     """
     An implementation of Connection for IRC.
+    :type isupport: ISupport
+    :type who_queue: WhoQueue
     :type use_ssl: bool
     :type server: str
     :type port: int
@@ -76,6 +133,17 @@ class IrcConnection(Connection):
         self._transport = None
         self._protocol = None
 
+        # what the server supports, from RPL_ISUPPORT
+        self.isupport = ISupport()
+
+        # channels to join, sent together at the end of the current loop iteration
+        self._join_queue = []
+        self._join_handle = None
+
+        # looks up everyone in each channel we join
+        self.who_on_join = config.get("who_on_join", True)
+        self.who_queue = WhoQueue(self, interval=config.get("who_interval", 1), timeout=config.get("who_timeout", 60))
+
     def describe_server(self):
         if self.use_ssl:
             return "+{}:{}".format(self.server, self.port)
@@ -96,6 +164,10 @@ class IrcConnection(Connection):
         if self._connected:
             logger.info("[{}] Reconnecting".format(self.name))
             self._transport.close()
+            # we'll have to rejoin our channels, keep what we know about them to adopt when we do
+            self.snapshots.capture()
+            for name in list(self.channels):
+                self._forget_channel(name)
         else:
             self._connected = True
             logger.info("[{}] Connecting".format(self.name))
@@ -103,6 +175,11 @@ class IrcConnection(Connection):
         self._transport, self._protocol = yield from self.loop.create_connection(
             lambda: _IrcProtocol(self), host=self.server, port=self.port, ssl=self.ssl_context)
 
+        # the server will tell us what it supports again, and it may not be the same server
+        self.isupport = ISupport()
+        self.set_casemapping(self.isupport.casemapping)
+        self.who_queue.clear()
+
         # send the password, nick, and user
         self.set_pass(self.config["connection"].get("password"))
         self.set_nick(self.bot_nick)
@@ -125,118 +202,246 @@ class IrcConnection(Connection):
     def close(self):
         if not self._quit:
             self.quit()
+        self.who_queue.clear()
+        self.waiters.cancel_all()
         if not self._connected:
             return
 
         self._transport.close()
         self._connected = False
 
-    def message(self, target, *messages, log_hide=None):
+    def detach(self):
+        """
+        Lets go of the connection without quitting, so the socket can be handed to the process the bot restarts into.
+        TLS connections can't be handed over, as their session state is in this process, so they're left alone.
+        :return: What the new process needs to adopt the connection, or None if it can't be handed over
+        :rtype: dict | None
+        """
+        if not self._connected or self.use_ssl or self._transport is None:
+            return None
+        sock = self._transport.get_extra_info("socket")
+        if sock is None:
+            return None
+        # the duplicate outlives the transport, which closes the original, and is kept open through exec
+        fd = os.dup(sock.fileno())
+        os.set_inheritable(fd, True)
+        state = {
+            "fd": fd,
+            "family": sock.family,
+            "nick": self.bot_nick,
+            "isupport": self.isupport.tokens,
+            "channels": [channel.name for channel in self.channels.values()],
+            # anything received after the last full line
+            "buffer": base64.b64encode(self._protocol._input_buffer).decode("ascii"),
+        }
+        self._quit = True
+        self.who_queue.clear()
+        self.waiters.cancel_all()
+        self._transport.close()
+        self._connected = False
+        logger.info("[{}] Detached connection to hand over".format(self.name))
+        return state
+
+    @asyncio.coroutine
+    def adopt(self, state):
+        """
+        Takes over a connection handed over by the process we restarted from, instead of connecting. The server sees
+        no change: we're still registered, and still in our channels, whose state is adopted from the snapshot taken
+        before the restart, then reconciled with a NAMES for each. A CONNECTED event is then dispatched, for the hooks
+        which would have run on 004 to set up the connection.
+        :param state: The state returned by detach() before the restart
+        :type state: dict
+        """
+        sock = socket.socket(state["family"], socket.SOCK_STREAM, 0, state["fd"])
+        sock.setblocking(False)
+        self._connected = True
+        self._transport, self._protocol = yield from self.loop.create_connection(lambda: _IrcProtocol(self),
+                                                                                 sock=sock)
+        logger.info("[{}] Adopted connection to {}".format(self.name, self.describe_server()))
+
+        self.bot_nick = state["nick"]
+        self.isupport.restore(state["isupport"])
+        self.set_casemapping(self.isupport.casemapping)
+        for name in state["channels"]:
+            channel = Channel(self.name, name, casemapping=self.casemapping,
+                              history_size=self.recent_history_size(name))
+            self.channels[name] = channel
+            self.snapshots.adopt(channel)
+            self.cmd("NAMES", name)
+
+        buffered = base64.b64decode(state["buffer"])
+        if buffered:
+            self._protocol.data_received(buffered)
+
+        # the server won't send 004 again, so let the hooks which set up the connection know it's ready
+        trace = self.bot.tracer.start(CONNECTED_COMMAND, time.perf_counter())
+        event = IrcEvent(bot=self.bot, conn=self, trace=trace, irc_command=CONNECTED_COMMAND, irc_command_params=[])
+        self.pending_events += 1
+        asyncio.async(self._protocol.process(event))
+
+    def _max_text_bytes(self, command, target):
+        """
+        Gets the most bytes of text which can be sent to a target in one line, after the server adds our mask to the
+        front of it
+        :type command: str
+        :type target: str
+        :rtype: int
+        """
+        user = self.users.get(self.bot_nick)
+        if user is not None and user.mask_known:
+            mask_length = len(user.mask.encode("utf-8"))
+        else:
+            mask_length = len(self.bot_nick) + MAX_IDENT_LENGTH + MAX_HOST_LENGTH + 2
+        # `:mask COMMAND target :text\r\n`
+        overhead = mask_length + len(command) + len(target.encode("utf-8")) + 7
+        return max(self.isupport.linelen - overhead, 64)
+
+    def message(self, target, *messages, log_hide=None, trace=None):
+        max_bytes = self._max_text_bytes("PRIVMSG", target)
         for text in messages:
-            self.cmd("PRIVMSG", target, text, log_hide=log_hide)
+            for piece in split_text(text, max_bytes):
+                self.cmd("PRIVMSG", target, piece, log_hide=log_hide, trace=trace)
 
-    def action(self, target, text, log_hide=None):
-        self.ctcp(target, "ACTION", text, log_hide=log_hide)
+    def action(self, target, text, log_hide=None, trace=None):
+        self.ctcp(target, "ACTION", text, log_hide=log_hide, trace=trace)
 
-    def notice(self, target, text, log_hide=None):
-        self.cmd("NOTICE", target, text, log_hide=log_hide)
+    def notice(self, target, text, log_hide=None, trace=None):
+        for piece in split_text(text, self._max_text_bytes("NOTICE", target)):
+            self.cmd("NOTICE", target, piece, log_hide=log_hide, trace=trace)
 
     def set_nick(self, nick):
+        if len(nick) > self.isupport.nicklen:
+            logger.warning("[{}] Nick {} is longer than the server's limit of {} characters".format(
+                self.name, nick, self.isupport.nicklen))
         self.cmd("NICK", nick)
 
     def join(self, channel):
-        if channel not in self.channels:
-            self.cmd("JOIN", channel)
-            self.channels[channel] = Channel(self.name, channel)
+        """
+        Joins a channel. Channels joined in the same loop iteration are sent together, in as few JOIN lines as the
+        server allows.
+        :type channel: str
+        """
+        if channel in self.channels:
+            return
+        limit = self.isupport.channel_limit(channel)
+        if limit is not None and sum(1 for name in self.channels if name[0] == channel[0]) >= limit:
+            logger.warning("[{}] Not joining {}, we're already in the server's limit of {} {} channels".format(
+                self.name, channel, limit, channel[0]))
+            return
+        self.channels[channel] = Channel(self.name, channel, casemapping=self.casemapping,
+                                         history_size=self.recent_history_size(channel))
+        self._join_queue.append(channel)
+        if self._join_handle is None:
+            self._join_handle = self.loop.call_soon(self._send_joins)
+
+    def _send_joins(self):
+        self._join_handle = None
+        queue, self._join_queue = self._join_queue, []
+        if not self._connected:
+            return
+        max_targets = self.isupport.target_limit("JOIN") or len(queue)
+        # `JOIN :#a,#b\r\n`
+        max_bytes = self.isupport.linelen - 8
+        batch = []
+        batch_bytes = 0
+        for channel in queue:
+            channel_bytes = len(channel.encode("utf-8")) + 1
+            if batch and (len(batch) >= max_targets or batch_bytes + channel_bytes > max_bytes):
+                self.cmd("JOIN", ",".join(batch))
+                batch = []
+                batch_bytes = 0
+            batch.append(channel)
+            batch_bytes += channel_bytes
+        if batch:
+            self.cmd("JOIN", ",".join(batch))
 
     def part(self, channel):
         if channel in self.channels:
             self.cmd("PART", channel)
-            del self.channels[channel]
+            self._forget_channel(channel)
 
     def set_pass(self, password):
         if not password:
             return
         self.cmd("PASS", password)
 
-    def ctcp(self, target, ctcp_type, text, log_hide=None):
+    def ctcp(self, target, ctcp_type, text, log_hide=None, trace=None):
         """
         Makes the bot send a PRIVMSG CTCP of type <ctcp_type> to the target
         :type ctcp_type: str
         :type text: str
         :type target: str
+        :type trace: obrbot.tracing.Trace
         """
-        out = "\x01{} {}\x01".format(ctcp_type, text)
-        self.cmd("PRIVMSG", target, out, log_hide=log_hide)
+        max_bytes = self._max_text_bytes("PRIVMSG", target) - len(ctcp_type) - 3
+        for piece in split_text(text, max_bytes):
+            self.cmd("PRIVMSG", target, "\x01{} {}\x01".format(ctcp_type, piece), log_hide=log_hide, trace=trace)
 
-    def cmd(self, command, *params, log_hide=None):
+    def cmd(self, command, *params, log_hide=None, trace=None):
         """
         Sends a raw IRC command of type <command> with params <params>
         :param command: The IRC command to send
         :param params: The params to the IRC command
+        :param trace: The trace of the event this command is being sent in response to, if any
         :type command: str
         :type params: (str)
+        :type trace: obrbot.tracing.Trace
         """
         params = list(params)  # turn the tuple of parameters into a list
         if params:
             params[-1] = ':' + params[-1]
-            self.send("{} {}".format(command, ' '.join(params)), log_hide=log_hide)
+            self.send("{} {}".format(command, ' '.join(params)), log_hide=log_hide, trace=trace)
         else:
-            self.send(command, log_hide=log_hide)
+            self.send(command, log_hide=log_hide, trace=trace)
 
-    def send(self, line, log_hide=None):
+    def send(self, line, log_hide=None, trace=None):
         """
         Sends a raw IRC line
         :type line: str
+        :type trace: obrbot.tracing.Trace
         """
         if not self._connected:
             raise ValueError("Connection must be connected to irc server to use send")
-        self.loop.call_soon_threadsafe(self._send, line, log_hide)
+        if trace is not None:
+            trace.mark("line queued", command=line.split(' ', 1)[0])
+        self.loop.call_soon_threadsafe(self._send, line, log_hide, trace)
 
-    def _send(self, line, log_hide):
+    def _send(self, line, log_hide, trace=None):
         """
         Sends a raw IRC line unchecked. Doesn't do connected check, and is *not* threadsafe
         :type line: str
+        :type trace: obrbot.tracing.Trace
         """
         if log_hide is not None:
             logger.info("[{}] >> {}".format(self.name, line.replace(log_hide, "<hidden>")))
         else:
             logger.info("[{}] >> {}".format(self.name, line))
-        asyncio.async(self._protocol.send(line), loop=self.loop)
+        asyncio.async(self._protocol.send(line, trace), loop=self.loop)
 
     @property
     def connected(self):
         return self._connected
 
+    @property
+    def outbound_buffer_size(self):
+        if not self._connected or self._transport is None:
+            return 0
+        return self._transport.get_write_buffer_size()
+
     @asyncio.coroutine
     def pre_process_event(self, event):
+        if event.irc_command == "005":
+            # RPL_ISUPPORT, `:server 005 bot_nick TOKEN TOKEN=value ... :are supported by this server`
+            self.isupport.update(event.irc_command_params[1:])
+            self.set_casemapping(self.isupport.casemapping)
+        elif event.irc_command in ("352", "354", "315"):
+            self.who_queue.handle(event)
         yield from super().pre_process_event(event)
-        if event.type is not EventType.message:
-            return
-        finished = []
-        for (nick, chan, regex), futures in self.waiting_messages.items():
-            if all(future.done() for future in futures):
-                finished.append((nick, chan, regex))
-                continue
-            if nick is not None and event.nick.lower() != nick:
-                continue
-            if chan is not None and event.chan_name.lower() != chan:
-                continue
-
-            try:
-                match = regex.search(event.content)
-            except Exception as exc:
-                for future in futures:
-                    future.set_exception(exc)
-                finished.append((nick, chan, regex))
-            else:
-                if match:
-                    for future in futures:
-                        future.set_result(match)
-                    finished.append((nick, chan, regex))
-
-        for key in finished:
-            del self.waiting_messages[key]
+        if (self.who_on_join and event.type is EventType.join and self.is_bot_nick(event.nick)
+                and event.chan_name in self.channels):
+            self.who_queue.request(event.chan_name)
+        if event.type is EventType.message:
+            self.waiters.dispatch(event.nick, event.chan_name, event.content)
 
 
 class _IrcProtocol(asyncio.Protocol):
@@ -296,20 +501,33 @@ class _IrcProtocol(asyncio.Protocol):
         return False
 
     @asyncio.coroutine
-    def send(self, line):
-        # make sure we are connected before sending
-        if not self._connected:
-            yield from self._connected_future
-        line = line.splitlines()[0][:500] + "\r\n"
-        data = line.encode("utf-8", "replace")
-        self._transport.write(data)
+    def send(self, line, trace=None):
+        """
+        :type line: str
+        :type trace: obrbot.tracing.Trace
+        """
+        self.conn.pending_sends += 1
+        try:
+            # make sure we are connected before sending
+            if not self._connected:
+                yield from self._connected_future
+            line = line.splitlines()[0]
+            data = _truncate_utf8(line.encode("utf-8", "replace"), self.conn.isupport.linelen - 2) + b"\r\n"
+            self._transport.write(data)
+            self.conn.lines_sent += 1
+            if trace is not None:
+                trace.mark("line written", command=line.split(' ', 1)[0])
+        finally:
+            self.conn.pending_sends -= 1
 
     def data_received(self, data):
+        received = time.perf_counter()
         self._input_buffer += data
 
         while b"\r\n" in self._input_buffer:
             line_data, self._input_buffer = self._input_buffer.split(b"\r\n", 1)
             line = line_data.decode()
+            self.conn.lines_received += 1
 
             # parse the line into a message
             if line.startswith(":"):
@@ -390,10 +608,13 @@ class _IrcProtocol(asyncio.Protocol):
                 # 353 format is `:network.name 353 bot_nick = #channel :user1 user2`, if we just used the below,
                 # we would think the channel was the bot_nick
                 channel = command_params[2].lower()
+            elif command in channel_reply_commands:
+                # `:network.name 324 bot_nick #channel +nt`, only tracked for channels we're in
+                channel = command_params[1].lower() if command_params[1] in self.conn.channels else None
             elif (command_params and (len(command_params) > 2 or not command_params[0].startswith(":"))
                   and event_type is not EventType.nick):
 
-                if command_params[0].lower() == self.conn.bot_nick.lower():
+                if self.conn.is_bot_nick(command_params[0]):
                     # this is a private message - set the channel to the sender's nick
                     channel = nick.lower()
                 else:
@@ -409,22 +630,41 @@ class _IrcProtocol(asyncio.Protocol):
             elif command == "INVITE":
                 target = command_params[0]
             elif command == "MODE":
-                if len(command_params) > 2:
-                    target = command_params[2]
+                if self.conn.isupport.is_channel(command_params[0]):
+                    # channel modes may have any number of targets, Channel.track_mode parses them
+                    target = command_params[2] if len(command_params) > 2 else None
                 else:
+                    # a mode change on a user, usually us
                     target = command_params[0]
                     channel = None
             else:
                 target = None
 
+            # Start tracing this event
+            if channel is not None:
+                trace = self.bot.tracer.start("{} {}".format(command, channel), received)
+            else:
+                trace = self.bot.tracer.start(command, received)
+            trace.mark("received", received)
+
             # Set up parsed message
             event = IrcEvent(bot=self.bot, conn=self.conn, event_type=event_type, content=content, target=target,
-                             channel_name=channel, nick=nick, user=user, host=host, mask=mask, irc_raw=line,
-                             irc_command=command, irc_command_params=command_params, irc_ctcp_text=ctcp_text)
+                             channel_name=channel, nick=nick, user=user, host=host, mask=mask, trace=trace,
+                             irc_raw=line, irc_command=command, irc_command_params=command_params,
+                             irc_ctcp_text=ctcp_text)
+            trace.mark("parsed")
+            self.conn.pending_events += 1
             asyncio.async(self.process(event))
 
     @asyncio.coroutine
     def process(self, event):
         # handle the message, async
-        yield from self.conn.pre_process_event(event)
-        asyncio.async(self.bot.process(event), loop=self.loop)
+        trace = event.trace
+        try:
+            start = time.perf_counter()
+            yield from self.conn.pre_process_event(event)
+            trace.span("pre_process", start)
+            yield from self.bot.process(event)
+        finally:
+            self.conn.pending_events -= 1
+            self.bot.tracer.finish(trace)
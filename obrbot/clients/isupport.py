@@ -0,0 +1,239 @@
+import logging
+import re
+
+logger = logging.getLogger("obrbot")
+
+# values are escaped as \xHH, for characters like spaces and equals signs
+_escape_re = re.compile(r"\\x([0-9A-Fa-f]{2})")
+_prefix_re = re.compile(r"^\(([^)]*)\)(.*)$")
+
+# what's assumed before the server says otherwise, from RFC 1459 and RFC 2812
+defaults = {
+    "PREFIX": "(ov)@+",
+    "CHANMODES": "beI,k,l,imnpst",
+    "CHANTYPES": "#&",
+    "CASEMAPPING": "rfc1459",
+    "MODES": "3",
+    "NICKLEN": "9",
+    "LINELEN": "512",
+    "TARGMAX": "",
+    "CHANLIMIT": "",
+}
+
+
+def _unescape(value):
+    """
+    :type value: str
+    :rtype: str
+    """
+    return _escape_re.sub(lambda match: chr(int(match.group(1), 16)), value)
+
+
+def _int_or_none(value):
+    """
+    :type value: str
+    :rtype: int | None
+    """
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def _parse_limits(value):
+    """
+    Parses a list of `key:limit` pairs, like TARGMAX's `PRIVMSG:4,JOIN:` or CHANLIMIT's `#&:50`. A missing limit means
+    there isn't one.
+    :type value: str
+    :rtype: dict[str, int | None]
+    """
+    limits = {}
+    for pair in value.split(","):
+        if not pair:
+            continue
+        key, _, limit = pair.partition(":")
+        limits[key] = _int_or_none(limit) if limit else None
+    return limits
+
+
+class ISupport:
+    """
+    What a server has told us about itself in RPL_ISUPPORT (005), with lookup tables built from it when it changes,
+    so names, modes and outgoing lines don't need to guess.
+
+    :type tokens: dict[str, str]
+    :type prefix_modes: str
+    :type prefix_symbols: str
+    :type symbol_to_mode: dict[str, str]
+    :type mode_to_symbol: dict[str, str]
+    :type list_modes: frozenset[str]
+    :type param_modes: frozenset[str]
+    :type set_param_modes: frozenset[str]
+    :type flag_modes: frozenset[str]
+    :type chantypes: str
+    :type casemapping: str
+    :type modes: int
+    :type nicklen: int
+    :type linelen: int
+    :type targmax: dict[str, int | None]
+    :type chanlimit: dict[str, int | None]
+    """
+
+    def __init__(self):
+        # token -> value, as sent by the server, with "" for tokens without a value
+        self.tokens = {}
+        self._build()
+
+    def get(self, token, default=None):
+        """
+        Gets the value of a token, or the default from the RFCs if the server hasn't sent it
+        :type token: str
+        :type default: str
+        :rtype: str
+        """
+        value = self.tokens.get(token)
+        if value is None:
+            return defaults.get(token, default)
+        return value
+
+    def update(self, tokens):
+        """
+        Adds the tokens from an RPL_ISUPPORT line, such as `CHANTYPES=#` or `-EXCEPTS`
+        :type tokens: list[str]
+        """
+        for token in tokens:
+            if token.startswith(":"):
+                # the trailing "are supported by this server"
+                break
+            if token.startswith("-"):
+                self.tokens.pop(token[1:], None)
+                continue
+            name, _, value = token.partition("=")
+            self.tokens[name] = _unescape(value)
+        self._build()
+
+    def restore(self, tokens):
+        """
+        Replaces every token with ones kept from before, such as when a connection is handed over on restart
+        :param tokens: Tokens as in `self.tokens`, already unescaped
+        :type tokens: dict[str, str]
+        """
+        self.tokens = dict(tokens)
+        self._build()
+
+    def _build(self):
+        match = _prefix_re.match(self.get("PREFIX"))
+        if match is None or len(match.group(1)) != len(match.group(2)):
+            logger.warning("Invalid ISUPPORT PREFIX {!r}, using {!r}".format(self.get("PREFIX"), defaults["PREFIX"]))
+            match = _prefix_re.match(defaults["PREFIX"])
+        # ordered from highest to lowest rank
+        self.prefix_modes, self.prefix_symbols = match.groups()
+        self.symbol_to_mode = dict(zip(self.prefix_symbols, self.prefix_modes))
+        self.mode_to_symbol = dict(zip(self.prefix_modes, self.prefix_symbols))
+
+        # type A modes are lists, B always take a parameter, C take one only when set, and D never do
+        chanmodes = self.get("CHANMODES").split(",") + ["", "", "", ""]
+        self.list_modes = frozenset(chanmodes[0])
+        self.param_modes = frozenset(chanmodes[1])
+        self.set_param_modes = frozenset(chanmodes[2])
+        self.flag_modes = frozenset(chanmodes[3])
+
+        self.chantypes = self.get("CHANTYPES")
+        self.casemapping = self.get("CASEMAPPING")
+        # a MODES token without a value means there's no limit
+        self.modes = _int_or_none(self.get("MODES")) if self.get("MODES") else None
+        self.nicklen = _int_or_none(self.get("NICKLEN")) or int(defaults["NICKLEN"])
+        self.linelen = _int_or_none(self.get("LINELEN")) or int(defaults["LINELEN"])
+        self.targmax = {command.upper(): limit for command, limit in _parse_limits(self.get("TARGMAX")).items()}
+        self.chanlimit = {}
+        for prefixes, limit in _parse_limits(self.get("CHANLIMIT")).items():
+            for prefix in prefixes:
+                self.chanlimit[prefix] = limit
+
+    def is_channel(self, name):
+        """
+        :type name: str
+        :rtype: bool
+        """
+        return bool(name) and name[0] in self.chantypes
+
+    def mode_takes_param(self, mode, adding):
+        """
+        Whether a channel mode takes a parameter when it's set (`adding`) or unset
+        :type mode: str
+        :type adding: bool
+        :rtype: bool
+        """
+        if mode in self.mode_to_symbol or mode in self.list_modes or mode in self.param_modes:
+            return True
+        if mode in self.set_param_modes:
+            return adding
+        return False
+
+    def parse_modes(self, params):
+        """
+        Parses a channel mode change, such as `+ooov-b a b c d mask`, pairing each mode with its parameter
+        :param params: The mode string and its parameters, as separate params of the MODE line
+        :type params: list[str]
+        :return: (adding, mode, parameter or None) for each mode, in order
+        :rtype: list[(bool, str, str | None)]
+        """
+        if not params:
+            return []
+        arguments = iter(param[1:] if param.startswith(":") else param for param in params[1:])
+        changes = []
+        adding = True
+        mode_string = params[0][1:] if params[0].startswith(":") else params[0]
+        for mode in mode_string:
+            if mode == "+":
+                adding = True
+            elif mode == "-":
+                adding = False
+            elif self.mode_takes_param(mode, adding):
+                argument = next(arguments, None)
+                if argument is None:
+                    logger.warning("Mode {}{} is missing its parameter in {}".format("+" if adding else "-", mode,
+                                                                                    " ".join(params)))
+                    continue
+                changes.append((adding, mode, argument))
+            else:
+                changes.append((adding, mode, None))
+        return changes
+
+    def sort_prefix_modes(self, modes):
+        """
+        Orders prefix modes from highest to lowest rank, such as "vo" to "ov"
+        :type modes: str
+        :rtype: str
+        """
+        return "".join(mode for mode in self.prefix_modes if mode in modes)
+
+    def target_limit(self, command):
+        """
+        The most targets a command accepts at once, or None if there's no limit
+        :type command: str
+        :rtype: int | None
+        """
+        return self.targmax.get(command.upper())
+
+    def channel_limit(self, channel):
+        """
+        The most channels of the same type as `channel` we can be in, or None if there's no limit
+        :type channel: str
+        :rtype: int | None
+        """
+        if not channel:
+            return None
+        return self.chanlimit.get(channel[0])
+
+    def split_prefix(self, name):
+        """
+        Splits the prefix symbols off a nick in a names reply, such as `@+nick`
+        :type name: str
+        :return: (modes, the rest of the name)
+        :rtype: (str, str)
+        """
+        index = 0
+        while index < len(name) and name[index] in self.symbol_to_mode:
+            index += 1
+        return "".join(self.symbol_to_mode[symbol] for symbol in name[:index]), name[index:]
@@ -0,0 +1,174 @@
+import asyncio
+from collections import deque
+import logging
+
+from obrbot.connection import Membership
+
+logger = logging.getLogger("obrbot")
+
+# the WHOX fields we ask for: token, channel, ident, host, nick, flags and account. The server always replies with
+# them in this order, whatever order they're asked for in
+WHOX_FIELDS = "tcuhnfa"
+
+
+class WhoQueue:
+    """
+    Fills in the ident, host and account of everyone in a channel after we join it, with one WHO per channel, rather
+    than waiting for each user to speak. Uses WHOX when the server supports it, so replies can be told apart from
+    WHOs sent by anything else and include accounts, and falls back to plain WHO when it doesn't.
+
+    Requests are sent one at a time, waiting for the end of the previous reply and then `interval` seconds, so that
+    joining many channels at once doesn't flood the server.
+
+    :type conn: obrbot.clients.irc.IrcConnection
+    :type loop: asyncio.events.AbstractEventLoop
+    :type interval: float
+    :type timeout: float
+    :type requests: int
+    :type replies: int
+    :type timeouts: int
+    """
+
+    def __init__(self, conn, *, interval=1, timeout=60):
+        """
+        :type conn: obrbot.clients.irc.IrcConnection
+        :param interval: Seconds to wait between requests
+        :param timeout: Seconds to wait for the end of a reply before moving on to the next request
+        :type interval: float
+        :type timeout: float
+        """
+        self.conn = conn
+        self.loop = conn.loop
+        self.interval = interval
+        self.timeout = timeout
+
+        self._queue = deque()
+        self._task = None
+        # (channel, WHOX token or None, future resolved at the end of the reply) for the request being answered
+        self._pending = None
+        self._next_token = 0
+
+        self.requests = 0
+        self.replies = 0
+        self.timeouts = 0
+
+    @property
+    def queued(self):
+        """
+        :rtype: int
+        """
+        return len(self._queue)
+
+    def request(self, channel):
+        """
+        Queues a WHO for a channel
+        :type channel: str
+        """
+        if channel in self._queue:
+            return
+        self._queue.append(channel)
+        if self._task is None or self._task.done():
+            self._task = asyncio.async(self._run(), loop=self.loop)
+
+    def clear(self):
+        """
+        Drops every queued request, such as when we've been disconnected
+        """
+        self._queue.clear()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._pending = None
+
+    def _token(self):
+        # WHOX tokens are at most three digits
+        self._next_token = (self._next_token + 1) % 1000
+        return str(self._next_token)
+
+    @asyncio.coroutine
+    def _run(self):
+        while self._queue:
+            channel = self._queue.popleft()
+            if channel not in self.conn.channels or not self.conn.connected:
+                continue
+            future = asyncio.Future(loop=self.loop)
+            if "WHOX" in self.conn.isupport.tokens:
+                token = self._token()
+                self.conn.send("WHO {} %{},{}".format(channel, WHOX_FIELDS, token))
+            else:
+                token = None
+                self.conn.send("WHO {}".format(channel))
+            self._pending = (self.conn.casemapping.fold(channel), token, future)
+            self.requests += 1
+            try:
+                yield from asyncio.wait_for(future, self.timeout, loop=self.loop)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                logger.warning("[{}] No reply to WHO {} after {} seconds".format(self.conn.name, channel,
+                                                                                  self.timeout))
+            finally:
+                self._pending = None
+            yield from asyncio.sleep(self.interval, loop=self.loop)
+
+    def _is_pending(self, channel, token=None):
+        """
+        :type channel: str
+        :type token: str
+        :rtype: bool
+        """
+        if self._pending is None:
+            return False
+        pending_channel, pending_token, future = self._pending
+        return pending_channel == self.conn.casemapping.fold(channel) and pending_token == token
+
+    def handle(self, event):
+        """
+        Applies a WHO reply line, if it's a reply to one of our requests
+        :type event: obrbot.event.IrcEvent
+        """
+        params = event.irc_command_params
+        if event.irc_command == "354" and len(params) >= 8:
+            # `:server 354 bot_nick token #channel ident host nick flags account`
+            token, channel, ident, host, nick, flags, account = params[1:8]
+            if self._is_pending(channel, token):
+                user = self._apply(channel, nick, ident, host, flags)
+                if user is not None:
+                    # an account of 0 means they aren't logged in
+                    user.account = None if account in ("0", ":0") else account.lstrip(":")
+        elif event.irc_command == "352" and len(params) >= 7:
+            # `:server 352 bot_nick #channel ident host server nick flags :hopcount realname`
+            channel, ident, host, server, nick, flags = params[1:7]
+            if self._is_pending(channel):
+                self._apply(channel, nick, ident, host, flags)
+        elif event.irc_command == "315" and len(params) >= 2:
+            # `:server 315 bot_nick #channel :End of /WHO list.`
+            if self._pending is not None and self._pending[0] == self.conn.casemapping.fold(params[1]):
+                future = self._pending[2]
+                if not future.done():
+                    future.set_result(None)
+
+    def _apply(self, channel_name, nick, ident, host, flags):
+        """
+        Applies one user from a WHO reply to a channel, adding them if we didn't know they were in it
+        :type channel_name: str
+        :type nick: str
+        :type ident: str
+        :type host: str
+        :param flags: H or G for here or gone, * for IRC operators, then the user's prefix symbols in the channel
+        :type flags: str
+        :rtype: obrbot.connection.User
+        """
+        channel = self.conn.channels.get(channel_name)
+        if channel is None:
+            return None
+        self.replies += 1
+        user = self.conn.users.add(nick, channel)
+        user.learn(ident, host)
+        isupport = self.conn.isupport
+        mode = isupport.sort_prefix_modes("".join(isupport.symbol_to_mode.get(symbol, "") for symbol in flags))
+        membership = channel.users.get(nick)
+        if membership is None:
+            channel.users[nick] = Membership(user, mode)
+        else:
+            membership.mode = mode
+        return user
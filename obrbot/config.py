@@ -49,6 +49,10 @@ class Config(dict):
                 connection.permissions.reload()
 
     def save_config(self):
-        """saves the contents of the config dict to the config file"""
-        json.dump(self, open(self.path, 'w'), sort_keys=True, indent=4)
+        """
+        saves the contents of the config dict to the config file. This does blocking IO, so coroutines should run it
+        in an executor.
+        """
+        with open(self.path, 'w') as f:
+            json.dump(self, f, sort_keys=True, indent=4)
         logger.info("Config saved to file.")
@@ -1,25 +1,29 @@
 import asyncio
-from collections import deque
 import datetime
 import logging
-import re
 import itertools
+import sys
+import time
 
 from obrbot.event import EventType
+from obrbot.history import HistoryWriter, HistoryCursor, history_key, encode_record, decode_record, next_sequence
 from obrbot.permissions import PermissionManager
-from obrbot.util.dictionaries import CaseInsensitiveDict
+from obrbot.search import indexed_event_types
+from obrbot.seen import SeenTracker
+from obrbot.snapshot import StateSnapshotter
+from obrbot.util.dictionaries import CaseInsensitiveDict, DEFAULT_CASEMAPPING, get_casemapping
+from obrbot.util.ringbuffer import HistoryRing
+from obrbot.waiters import WaiterRegistry
 
 logger = logging.getLogger("obrbot")
 
-mode_re = re.compile(r'([@&~%\+]*)([a-zA-Z0-9_\\\[\]\{\}\^`\|][a-zA-Z0-9_\\\[\]\{\}\^`\|-]*)')
-symbol_to_mode = {
-    '+': 'v',
-    '@': 'o',
-    # TODO: more of these, for half-op and stuff
+# numerics listing the entries of a channel's list modes, to the mode they list
+list_replies = {
+    '367': 'b',  # RPL_BANLIST
+    '348': 'e',  # RPL_EXCEPTLIST
+    '346': 'I',  # RPL_INVITELIST
 }
 
-history_key = "obrbot:connections:{}:channels:{}:history"
-
 
 def grouper(iterable, n, fillvalue=None):
     "Collect data into fixed-length chunks or blocks"
@@ -34,11 +38,20 @@ class Connection:
     :type bot: obrbot.bot.ObrBot
     :type loop: asyncio.events.AbstractEventLoop
     :type name: str
+    :type casemapping: obrbot.util.dictionaries.CaseMapping
     :type channels: dict[str, Channel]
+    :type users: UserRegistry
     :type config: dict[str, str | dict | list]
     :type bot_nick: str
     :type permissions: PermissionManager
-    :type waiting_messages: dict[(str, str, re.__Regex), list(asyncio.Future)]
+    :type history_writer: HistoryWriter
+    :type seen: SeenTracker
+    :type snapshots: StateSnapshotter
+    :type waiters: WaiterRegistry
+    :type lines_received: int
+    :type lines_sent: int
+    :type pending_events: int
+    :type pending_sends: int
     """
 
     def __init__(self, bot, name, bot_nick, *, config):
@@ -53,14 +66,58 @@ class Connection:
         self.name = name
         self.bot_nick = bot_nick
 
-        self.channels = CaseInsensitiveDict()
+        # how the server folds nicks and channel names, rfc1459 until it says otherwise
+        self.casemapping = get_casemapping(DEFAULT_CASEMAPPING)
+        self.channels = CaseInsensitiveDict(casemapping=self.casemapping)
+        # every user in any of our channels, and which channels they're in
+        self.users = UserRegistry(casemapping=self.casemapping)
 
         self.config = config
 
         # create permissions manager
         self.permissions = PermissionManager(self)
 
-        self.waiting_messages = dict()
+        # futures waiting for messages matching a regex, from wait_for()
+        self.waiters = WaiterRegistry(self.loop, self.casemapping)
+
+        # batches channel history writes
+        history_config = bot.config.get("history", {})
+        self.history_writer = HistoryWriter(bot.history_backend, self.loop,
+                                            interval=history_config.get("flush_interval", 0.1),
+                                            max_entries=history_config.get("flush_entries", 500))
+        # how many recent events each channel keeps in memory, overridden for channels in recent_channels by
+        # "connection:#channel"
+        self._recent_entries = history_config.get("recent_entries", 100)
+        self._recent_channels = {name.lower(): size for name, size in
+                                 history_config.get("recent_channels", {}).items()}
+
+        # tracks the last activity from each nick
+        seen_config = bot.config.get("seen", {})
+        self.seen = SeenTracker(bot.db, name, self.loop, casemapping=self.casemapping,
+                                cache_size=seen_config.get("cache_size", 10000),
+                                interval=seen_config.get("flush_interval", 1))
+
+        # saves the state of our channels, to be adopted when they're rejoined after a restart or reconnect
+        snapshot_config = bot.config.get("snapshot", {})
+        self.snapshots = StateSnapshotter(self, bot.db, enabled=snapshot_config.get("enabled", True),
+                                          interval=snapshot_config.get("interval", 60),
+                                          max_age=snapshot_config.get("max_age", 600))
+
+        # counters, for metrics
+        self.lines_received = 0
+        self.lines_sent = 0
+        # events which have been received but not yet fully processed
+        self.pending_events = 0
+        # lines which have been queued to send but not yet written
+        self.pending_sends = 0
+
+    def recent_history_size(self, channel):
+        """
+        The most recent events a channel keeps in memory
+        :type channel: str
+        :rtype: int
+        """
+        return self._recent_channels.get("{}:{}".format(self.name, channel).lower(), self._recent_entries)
 
     def describe_server(self):
         raise NotImplementedError
@@ -84,27 +141,46 @@ class Connection:
         """
         raise NotImplementedError
 
-    def message(self, target, *text):
+    def detach(self):
+        """
+        Lets go of the connection without quitting, to hand it over to the bot after a restart
+        :return: What's needed to adopt() the connection again, or None if it can't be handed over
+        :rtype: dict | None
+        """
+        return None
+
+    @asyncio.coroutine
+    def adopt(self, state):
+        """
+        Takes over a connection which was handed over by detach(), instead of connecting
+        :type state: dict
+        """
+        raise NotImplementedError
+
+    def message(self, target, *text, trace=None):
         """
         Sends a message to the given target
         :type target: str
         :type text: tuple[str]
+        :type trace: obrbot.tracing.Trace
         """
         raise NotImplementedError
 
-    def action(self, target, text):
+    def action(self, target, text, trace=None):
         """
         Sends an action (or /me) to the given target channel
         :type target: str
         :type text: str
+        :type trace: obrbot.tracing.Trace
         """
         raise NotImplementedError
 
-    def notice(self, target, text):
+    def notice(self, target, text, trace=None):
         """
         Sends a notice to the given target
         :type target: str
         :type text: str
+        :type trace: obrbot.tracing.Trace
         """
         raise NotImplementedError
 
@@ -133,71 +209,113 @@ class Connection:
     def connected(self):
         raise NotImplementedError
 
-    def wait_for(self, message, nick=None, chan=None):
+    @property
+    def outbound_buffer_size(self):
+        """
+        The number of bytes which have been written, but not yet sent to the server
+        :rtype: int
+        """
+        return 0
+
+    def wait_for(self, message, nick=None, chan=None, *, timeout=None):
         """
         Waits for a message matching a specific regex
         This returns a future, so it should be treated like a coroutine
-        :type nick: str
+        :param timeout: Seconds to wait before the future fails with asyncio.TimeoutError, or None to wait forever
         :type message: str | re.__Regex
+        :type nick: str
+        :type chan: str
+        :type timeout: float
+        :rtype: asyncio.Future
         """
-        if nick is not None:
-            nick = nick.lower()
-        if chan is not None:
-            chan = chan.lower()
-        future = asyncio.Future(loop=self.bot.loop)
-        if not hasattr(message, "search"):
-            message = re.compile(message)
-
-        key = (nick, chan, message)
-
-        if key in self.waiting_messages:
-            # what?
-            self.waiting_messages[key].append(future)
-
-        self.waiting_messages[key] = [future]
-        return future
+        return self.waiters.add(message, nick, chan, timeout=timeout)
 
     @asyncio.coroutine
     def cancel_wait(self, message, nick=None, chan=None):
-        if nick is not None:
-            nick = nick.lower()
-        if chan is not None:
-            chan = chan.lower()
+        """
+        Cancels every wait_for() with the same regex, nick and channel
+        :type message: str | re.__Regex
+        :type nick: str
+        :type chan: str
+        :return: The number of waits cancelled
+        :rtype: int
+        """
+        return self.waiters.cancel(message, nick, chan)
+
+    def set_casemapping(self, name):
+        """
+        Switches to the casemapping the server uses, refolding the channels and users we already know about
+        :type name: str
+        """
+        casemapping = get_casemapping(name)
+        if casemapping is self.casemapping:
+            return
+        logger.debug("[{}] Using casemapping {}".format(self.name, casemapping.name))
+        self.casemapping = casemapping
+        self.channels.rekey(casemapping, key_of=lambda channel: channel.name)
+        for channel in self.channels.values():
+            channel.users.rekey(casemapping, key_of=lambda membership: membership.nick)
+        self.users.rekey(casemapping)
+        self.waiters.set_casemapping(casemapping)
+        self.snapshots.set_casemapping(casemapping)
+        self.seen.set_casemapping(casemapping)
 
-        for test_nick, test_chan, test_message, future in self.waiting_messages:
-            if test_nick == nick and test_chan == chan and test_message == message:
-                future.cancel()
+    def is_bot_nick(self, nick):
+        """
+        Whether a nick is ours, folded by the server's casemapping
+        :type nick: str
+        :rtype: bool
+        """
+        return self.casemapping.fold(nick) == self.casemapping.fold(self.bot_nick)
+
+    def _forget_channel(self, name):
+        """
+        Stops tracking a channel we've left
+        :type name: str
+        """
+        channel = self.channels.pop(name)
+        if channel is not None:
+            self.users.forget_channel(channel)
 
     @asyncio.coroutine
     def _process_channel(self, event):
-        if event.chan_name is None or event.chan_name.lower() == event.nick.lower():
+        if event.chan_name is None or self.casemapping.fold(event.chan_name) == self.casemapping.fold(event.nick):
             return  # the rest of this just process on channels
 
         channel = self.channels.get(event.chan_name)
         if channel is None:
-            if event.type is EventType.part and event.nick.lower() == self.bot_nick.lower():
+            if event.type is EventType.part and self.is_bot_nick(event.nick):
                 return  # no need to create a channel when we're just leaving it
             elif event.type is not EventType.join:
                 logger.warning("First mention of channel {} was from event type {}".format(event.chan_name, event.type))
-            elif event.nick.lower() != self.bot_nick.lower():
+            elif not self.is_bot_nick(event.nick):
                 logger.warning("First join of channel {} was {}".format(event.chan_name, event.nick))
-            channel = Channel(self.name, event.chan_name)
+            channel = Channel(self.name, event.chan_name, casemapping=self.casemapping,
+                              history_size=self.recent_history_size(event.chan_name))
             self.channels[event.chan_name] = channel
 
         event.channel = channel
         event.channels = [channel]
 
+        if event.type is EventType.join and self.is_bot_nick(event.nick):
+            self.snapshots.adopt(channel)
+
         if event.type is EventType.part:
-            if event.nick.lower() == self.bot_nick.lower():
-                del self.channels[event.chan_name]
+            if self.is_bot_nick(event.nick):
+                self._forget_channel(event.chan_name)
                 return
         elif event.type is EventType.kick:
-            if event.target.lower() == self.bot_nick.lower():
-                del self.channels[event.chan_name]
+            if self.is_bot_nick(event.target):
+                self._forget_channel(event.chan_name)
                 return
 
+        if event.type is EventType.message or event.type is EventType.action:
+            self.bot.channel_stats.record(self.name, channel.name, self.casemapping.fold(event.nick))
+
         if event.type is EventType.message:
             yield from channel.track_message(event)
+        elif event.type is EventType.action:
+            yield from channel.track_action(event)
         elif event.type is EventType.join:
             yield from channel.track_join(event)
         elif event.type is EventType.part:
@@ -208,23 +326,29 @@ class Connection:
             yield from channel.track_topic(event)
         elif event.irc_command == 'MODE':
             channel.track_mode(event)
+        elif event.irc_command == '324':
+            channel.track_324_channel_modes(event)
+        elif event.irc_command in list_replies:
+            channel.track_list_entry(event, list_replies[event.irc_command])
         elif event.irc_command == '353':
             channel.track_353_channel_list(event)
+        elif event.irc_command == '366':
+            channel.track_366_end_of_names(event)
 
     @asyncio.coroutine
     def _process_nick(self, event):
         if event.type is not EventType.nick:
             return
 
-        if event.nick.lower() == self.bot_nick.lower():
+        if self.is_bot_nick(event.nick):
             logger.info("[{}] Bot nick changed from {} to {}.".format(self.name, self.bot_nick, event.content))
             self.bot_nick = event.content
 
         event.channels.clear()  # We will re-set all relevant channels below
-        for channel in self.channels.values():
-            if event.nick in channel.users:
-                yield from channel.track_nick(event)
-                event.channels.append(channel)
+        for channel in self.users.channels_of(event.nick):
+            yield from channel.track_nick(event)
+            event.channels.append(channel)
+        self.users.rename(event.nick, event.content)
 
     @asyncio.coroutine
     def _process_quit(self, event):
@@ -232,10 +356,9 @@ class Connection:
             return
 
         event.channels.clear()  # We will re-set all relevant channels below
-        for channel in self.channels.values():
-            if event.nick in channel.users:
-                channel.track_quit(event)
-                event.channels.append(channel)
+        for channel in self.users.remove_user(event.nick):
+            yield from channel.track_quit(event)
+            event.channels.append(channel)
 
     @asyncio.coroutine
     def pre_process_event(self, event):
@@ -243,75 +366,281 @@ class Connection:
         yield from self._process_channel(event)
         yield from self._process_nick(event)
         yield from self._process_quit(event)
+        self.seen.track(event)
 
 
 class User:
     """
+    A user in one or more of a connection's channels. There's one User per nick on each connection, shared by every
+    channel the user is in; anything specific to one channel is in that channel's Membership instead.
     :param nick: The nickname of this User
-    :param ident: The IRC ident of this User, if applicable
-    :param host: The hostname of this User, if applicable
-    :param mask: The IRC mask (nick!ident@host), if applicable
-    :param mode: The IRC mode, if applicable
+    :param ident: The IRC ident of this User, if known
+    :param host: The hostname of this User, if known
+    :param account: The services account this User is logged in to, if known
     :type nick: str
     :type ident: str
     :type host: str
-    :type mask: str
-    :type mask_known: bool
-    :type mode: str
+    :type account: str
+    :type channels: tuple[Channel]
     """
+    __slots__ = ['nick', 'ident', 'host', 'account', 'channels']
 
-    def __init__(self, nick, *, ident=None, host=None, mask=None, mode=''):
+    def __init__(self, nick, *, ident=None, host=None, account=None):
         self.nick = nick
-        self.ident = ident
-        self.host = host
-        self.mask = mask
-        self.mask_known = mask is not None
+        self.ident = None
+        self.host = None
+        self.account = account
+        # a tuple rather than a set, as most users are in only a few channels, and a set is several times larger
+        self.channels = ()
+        self.learn(ident, host)
+
+    @property
+    def mask_known(self):
+        """
+        :rtype: bool
+        """
+        return self.ident is not None and self.host is not None
+
+    @property
+    def mask(self):
+        """
+        The IRC mask (nick!ident@host), if known
+        :rtype: str
+        """
+        if not self.mask_known:
+            return None
+        return "{}!{}@{}".format(self.nick, self.ident, self.host)
+
+    def learn(self, ident, host):
+        """
+        Records this user's ident and host, if they're known. Hosts are interned, as many users share a few cloaks.
+        :type ident: str
+        :type host: str
+        """
+        if ident is not None and host is not None:
+            self.ident = sys.intern(ident)
+            self.host = sys.intern(host)
+
+
+class Membership:
+    """
+    A user's membership of a channel
+    :param user: The User
+    :param mode: The user's IRC modes in the channel, such as "o" or "v"
+    :type user: User
+    :type mode: str
+    """
+    __slots__ = ['user', 'mode']
+
+    def __init__(self, user, mode=''):
+        self.user = user
         self.mode = mode
 
+    @property
+    def nick(self):
+        """
+        :rtype: str
+        """
+        return self.user.nick
+
+
+class UserRegistry:
+    """
+    Keeps track of every user in any of a connection's channels, and which channels each is in, so that nick changes
+    and quits only need to look at the channels the user is actually in, and so each user has one User however many
+    channels they're in. Kept in sync by the channels' join, part, kick and names tracking, and by the connection for
+    nick changes and quits.
+    """
+
+    def __init__(self, *, casemapping=None):
+        """
+        :type casemapping: str | obrbot.util.dictionaries.CaseMapping
+        """
+        # nick -> User
+        self._users = CaseInsensitiveDict(casemapping=casemapping)
+
+    def __len__(self):
+        return len(self._users)
+
+    def __contains__(self, nick):
+        return nick in self._users
+
+    def get(self, nick):
+        """
+        :type nick: str
+        :rtype: User | None
+        """
+        return self._users.get(nick)
+
+    def channels_of(self, nick):
+        """
+        Gets the channels a nick is in
+        :type nick: str
+        :rtype: list[Channel]
+        """
+        user = self._users.get(nick)
+        if user is None:
+            return []
+        return list(user.channels)
+
+    def add(self, nick, channel, *, ident=None, host=None):
+        """
+        Records that a user is in a channel
+        :type nick: str
+        :type channel: Channel
+        :type ident: str
+        :type host: str
+        :return: The User for the nick, created if the nick wasn't already known
+        :rtype: User
+        """
+        user = self._users.get(nick)
+        if user is None:
+            user = self._users[nick] = User(nick, ident=ident, host=host)
+        elif not user.mask_known:
+            user.learn(ident, host)
+        if channel not in user.channels:
+            user.channels += (channel,)
+        return user
+
+    def remove(self, nick, channel):
+        """
+        Records that a user has left a channel, forgetting them if it was their last one
+        :type nick: str
+        :type channel: Channel
+        """
+        user = self._users.get(nick)
+        if user is None:
+            return
+        user.channels = tuple(other for other in user.channels if other is not channel)
+        if not user.channels:
+            del self._users[nick]
+
+    def remove_user(self, nick):
+        """
+        Forgets a user entirely, such as when they quit
+        :type nick: str
+        :return: The channels the user was in
+        :rtype: list[Channel]
+        """
+        user = self._users.pop(nick)
+        if user is None:
+            return []
+        return list(user.channels)
+
+    def rename(self, old_nick, new_nick):
+        """
+        :type old_nick: str
+        :type new_nick: str
+        """
+        user = self._users.pop(old_nick)
+        if user is None:
+            return
+        user.nick = new_nick
+        self._users[new_nick] = user
+
+    def rekey(self, casemapping):
+        """
+        :type casemapping: str | obrbot.util.dictionaries.CaseMapping
+        """
+        self._users.rekey(casemapping, key_of=lambda user: user.nick)
+
+    def forget_channel(self, channel):
+        """
+        Removes a channel from every user in it, for when we leave the channel
+        :type channel: Channel
+        """
+        for nick in list(channel.users):
+            self.remove(nick, channel)
+
+
+def _to_timestamp(time):
+    """
+    :type time: datetime.datetime
+    :rtype: float
+    """
+    if time is None:
+        return None
+    return (time - datetime.datetime.utcfromtimestamp(0)).total_seconds()
+
 
 def _parse_history_data(data, score=None):
-    split = data.decode().split("\n")
-    try:
-        event_type = getattr(EventType, split[0])
-    except AttributeError:
-        event_type = EventType.other
+    sequence, event_type, fields = decode_record(data)
     if score:
-        return (score, event_type,) + tuple(split[1:])
+        return (score, event_type,) + fields
     else:
-        return (event_type,) + tuple(split[1:])
+        return (event_type,) + fields
 
 
 class Channel:
     """
     name: the name of this channel
-    users: A dict from nickname to User in this channel
-    user_modes: A dict from User to an str containing all of the user's modes in this channel
-    history: A list of (User, timestamp, message content)
+    users: A dict from nickname to the Membership of each user in this channel, which holds their modes
+    modes: A dict from each channel mode which is set to its parameter, or None for modes without one
+    lists: A dict from list modes, such as "b" for bans, to a dict of each mask on the list to who set it and when
+    history: The most recent events in this channel, kept in memory, as opposed to the full history in the database
+    unconfirmed: Memberships adopted from a snapshot which the channel's NAMES reply hasn't listed yet
     :type connection: str
     :type name: str
-    :type users: dict[str, User]
+    :type users: dict[str, Membership]
+    :type modes: dict[str, str | None]
+    :type lists: dict[str, dict[str, (str, float)]]
+    :type history: HistoryRing
+    :type unconfirmed: set[Membership]
     """
 
-    def __init__(self, connection, name):
+    def __init__(self, connection, name, *, casemapping=None, history_size=100):
+        """
+        :type connection: str
+        :type name: str
+        :type casemapping: str | obrbot.util.dictionaries.CaseMapping
+        :param history_size: The most recent events to keep in memory
+        :type history_size: int
+        """
         self.connection = connection
         self.name = name
-        self.users = CaseInsensitiveDict()
-        self.history = deque(maxlen=100)
+        self.users = CaseInsensitiveDict(casemapping=casemapping)
+        self.modes = {}
+        self.lists = {}
+        self.history = HistoryRing(history_size)
         self.topic = ""
+        self.unconfirmed = set()
+
+    def add_provisional(self, nick, user, mode=''):
+        """
+        Adds a user who was in this channel when a snapshot was taken, until the channel's NAMES reply confirms them
+        :type nick: str
+        :type user: User
+        :type mode: str
+        """
+        membership = self.users[nick] = Membership(user, mode)
+        self.unconfirmed.add(membership)
 
     @property
-    def _db_key(self):
-        return history_key.format(self.connection.lower(), self.name.lower())
+    def bans(self):
+        """
+        :rtype: dict[str, (str, float)]
+        """
+        return self.lists.get("b", {})
+
+    def _history_key(self, event):
+        """
+        :type event: obrbot.event.Event
+        :rtype: str
+        """
+        return event.conn.history_writer.backend.key(self.connection, self.name)
 
-    @asyncio.coroutine
     def _add_history(self, event, *variables):
         """
-        Adds an event to this channels history
+        Adds an event to this channels history. The entry is buffered by the connection's HistoryWriter, and written
+        shortly after. Messages, actions and topics are also added to the search index.
         :type event: obrbot.event.Event
         """
-        to_store = '\n'.join(itertools.chain((event.type.name,), (str(v) for v in variables)))
+        sequence = next_sequence()
+        to_store = encode_record(sequence, event.type, (str(v) for v in variables))
         score = (datetime.datetime.utcnow() - datetime.datetime.utcfromtimestamp(0)).total_seconds()
-        yield from event.async(event.db.zadd, self._db_key, **{to_store: score})
+        event.conn.history_writer.add(self._history_key(event), to_store, score)
+        if event.type in indexed_event_types:
+            event.conn.bot.search_index.add(self.connection, self.name, sequence, score, str(variables[-1]))
 
     @asyncio.coroutine
     def get_history(self, event, min_time, with_timestamps=False):
@@ -324,15 +653,36 @@ class Channel:
         :return: List of (Type, nickname, other data),
                     or list of (timestamp, nickname, other data) if with_timestamps=True
         """
-        min_score = (min_time - datetime.datetime.utcfromtimestamp(0)).total_seconds()
-        max_score = "+inf"
-        raw_result = yield from event.async(event.db.zrangebyscore, self._db_key, min_score, max_score,
-                                            withscores=with_timestamps)
+        min_score = _to_timestamp(min_time)
+        history_writer = event.conn.history_writer
+        # make sure any buffered history is included
+        yield from history_writer.flush()
+        raw_result = yield from history_writer.backend.read(self._history_key(event), min_score)
 
         if with_timestamps:
-            return [_parse_history_data(data, score) for data, score in grouper(raw_result, 2)]
+            return [_parse_history_data(data, score) for data, score in raw_result]
         else:
-            return [_parse_history_data(data) for data in raw_result]
+            return [_parse_history_data(data) for data, score in raw_result]
+
+    def history_cursor(self, event, min_time=None, max_time=None, *, reverse=False, limit=None, offset=0,
+                       page_size=100, position=None):
+        """
+        Returns a cursor which reads this channel's history a page at a time, rather than all at once like
+        get_history(). Records are (timestamp, EventType, nickname, other data).
+        :type event: obrbot.event.Event
+        :type min_time: datetime.datetime
+        :type max_time: datetime.datetime
+        :type reverse: bool
+        :type limit: int
+        :type offset: int
+        :type page_size: int
+        :param position: The position of another cursor over this channel with the same bounds, to carry on from
+        :rtype: HistoryCursor
+        """
+        history_writer = event.conn.history_writer
+        return HistoryCursor(history_writer.backend, self._history_key(event), min_time=_to_timestamp(min_time),
+                             max_time=_to_timestamp(max_time), reverse=reverse, limit=limit, offset=offset,
+                             page_size=page_size, position=position, writer=history_writer)
 
     @asyncio.coroutine
     def track_message(self, event):
@@ -340,21 +690,32 @@ class Channel:
         Adds a message to this channel's history, adding user info from the message as well
         :type event: obrbot.event.Event
         """
-        user = self.users[event.nick]
+        user = self.users[event.nick].user
         if not user.mask_known:
-            user.ident = event.user
-            user.host = event.host
-            user.mask = event.mask
-        yield from self._add_history(event, user.nick, event.content)
-        self.history.append((EventType.message, user.nick, datetime.datetime.utcnow(), event.content))
+            user.learn(event.user, event.host)
+        self._add_history(event, user.nick, event.content)
+        self.history.append(EventType.message, user.nick, event.content)
+
+    @asyncio.coroutine
+    def track_action(self, event):
+        """
+        Adds an action to this channel's recent history, adding user info from the action as well
+        :type event: obrbot.event.Event
+        """
+        user = self.users[event.nick].user
+        if not user.mask_known:
+            user.learn(event.user, event.host)
+        self.history.append(EventType.action, user.nick, event.content)
 
     @asyncio.coroutine
     def track_join(self, event):
         """
         :type event: obrbot.event.Event
         """
-        self.users[event.nick] = User(event.nick, ident=event.user, host=event.host, mask=event.mask, mode='')
-        yield from self._add_history(event, event.nick)
+        user = event.conn.users.add(event.nick, self, ident=event.user, host=event.host)
+        self.users[event.nick] = Membership(user)
+        self._add_history(event, event.nick)
+        self.history.append(EventType.join, user.nick)
 
     @asyncio.coroutine
     def track_part(self, event):
@@ -362,7 +723,9 @@ class Channel:
         :type event: obrbot.event.Event
         """
         del self.users[event.nick]
-        yield from self._add_history(event, event.nick, event.content)
+        event.conn.users.remove(event.nick, self)
+        self._add_history(event, event.nick, event.content)
+        self.history.append(EventType.part, event.nick, event.content)
 
     @asyncio.coroutine
     def track_quit(self, event):
@@ -370,7 +733,8 @@ class Channel:
         :type event: obrbot.event.Event
         """
         del self.users[event.nick]
-        yield from self._add_history(event, event.nick, event.content)
+        self._add_history(event, event.nick, event.content)
+        self.history.append(EventType.quit, event.nick, event.content)
 
     @asyncio.coroutine
     def track_kick(self, event):
@@ -378,64 +742,128 @@ class Channel:
         :type event: obrbot.event.Event
         """
         del self.users[event.target]
-        yield from self._add_history(event, event.nick, event.target, event.content)
+        event.conn.users.remove(event.target, self)
+        self._add_history(event, event.nick, event.target, event.content)
+        self.history.append(EventType.kick, event.nick, event.content, event.target)
 
     @asyncio.coroutine
     def track_nick(self, event):
-        user = self.users[event.nick]
-
-        if not user.mask_known:
-            user.ident = event.user
-            user.host = event.host
-            user.mask = event.mask
-
-        user.nick = event.content
-        self.users[event.content] = user
-
-        del self.users[event.nick]
+        """
+        Moves a user's membership to their new nick. The User itself is renamed by the connection's UserRegistry.
+        :type event: obrbot.event.Event
+        """
+        membership = self.users.pop(event.nick)
+        if not membership.user.mask_known:
+            membership.user.learn(event.user, event.host)
+        self.users[event.content] = membership
+        self.history.append(EventType.nick, event.nick, target=event.content)
 
     @asyncio.coroutine
     def track_topic(self, event):
         """
         :type event: obrbot.event.Event
         """
-        user = self.users[event.nick]
+        user = self.users[event.nick].user
         if not user.mask_known:
-            user.ident = event.user
-            user.host = event.host
-            user.mask = event.mask
+            user.learn(event.user, event.host)
         self.topic = event.content
-        yield from self._add_history(event, user.nick, event.content)
+        self._add_history(event, user.nick, event.content)
+        self.history.append(EventType.topic, user.nick, event.content)
 
     def track_mode(self, event):
         """
-        IRC-specific tracking of mode changing
-        :type event: obrbot.event.Event
-        """
-        user = self.users[event.target]
-        mode_change = event.irc_command_params[1]  # in `:Dabo!dabo@dabo.us MODE #obr +v obr`, `+v` is the second param
-        if mode_change[0] == '-':
-            user.mode = user.mode.replace(mode_change[1], '')  # remove the mode from the mode string
-        elif mode_change[0] == '+':
-            if mode_change[1] not in user.mode:
-                user.mode += mode_change[1]  # add the mode to the mode string
-        else:
-            logger.warning("Invalid mode string '" + mode_change + "' found, ignoring.")
+        IRC-specific tracking of a mode change, such as `+ooov-b a b c d mask`, read using the server's ISUPPORT
+        CHANMODES and PREFIX
+        :type event: obrbot.event.IrcEvent
+        """
+        # in `:Dabo!dabo@dabo.us MODE #obr +v-b obr mask`, `+v-b` and its parameters follow the channel
+        self.apply_modes(event.conn.isupport, event.irc_command_params[1:], event.nick)
+
+    def apply_modes(self, isupport, params, setter=None):
+        """
+        Applies a whole mode change to this channel's users, modes and lists
+        :type isupport: obrbot.clients.isupport.ISupport
+        :param params: The mode string and its parameters
+        :param setter: The nick or server which changed the modes
+        :type params: list[str]
+        :type setter: str
+        """
+        for adding, mode, param in isupport.parse_modes(params):
+            if mode in isupport.mode_to_symbol:
+                membership = self.users.get(param)
+                if membership is None:
+                    logger.warning("Mode {} set on {}, who isn't in {}".format(mode, param, self.name))
+                elif adding:
+                    membership.mode = isupport.sort_prefix_modes(membership.mode + mode)
+                else:
+                    membership.mode = membership.mode.replace(mode, '')
+            elif mode in isupport.list_modes:
+                if adding:
+                    self.lists.setdefault(mode, {})[param] = (setter, time.time())
+                elif mode in self.lists:
+                    self.lists[mode].pop(param, None)
+            elif adding:
+                self.modes[mode] = param
+            else:
+                self.modes.pop(mode, None)
+
+    def track_324_channel_modes(self, event):
+        """
+        IRC-specific tracking of the reply to a `MODE #channel` query, which lists every mode set on the channel
+        :type event: obrbot.event.IrcEvent
+        """
+        # `:server 324 bot_nick #channel +ntk key`
+        self.modes.clear()
+        self.apply_modes(event.conn.isupport, event.irc_command_params[2:])
+
+    def track_list_entry(self, event, mode):
+        """
+        IRC-specific tracking of an entry in the reply to a list query, such as `MODE #channel b`
+        :type event: obrbot.event.IrcEvent
+        :type mode: str
+        """
+        # `:server 367 bot_nick #channel mask [setter [timestamp]]`
+        params = event.irc_command_params
+        if len(params) < 3:
+            return
+        setter = params[3] if len(params) > 3 else None
+        try:
+            set_at = float(params[4])
+        except (IndexError, ValueError):
+            set_at = time.time()
+        self.lists.setdefault(mode, {})[params[2]] = (setter, set_at)
 
     def track_353_channel_list(self, event):
-        for user in event.content.split():
-            match = mode_re.match(user)
-            if match is None:
-                logger.warning("User mode {} didn't fit specifications.".format(user))
-            # find mode
-            mode_symbols = match.group(1)
-            mode = ''
-            if mode_symbols is not None:
-                for symbol in mode_symbols:
-                    symbol_mode = symbol_to_mode.get(symbol)
-                    if symbol_mode is not None:
-                        mode += symbol_mode
-            # create user
-            nick = match.group(2)
-            user = User(nick, mode=mode)
-            self.users[nick] = user
\ No newline at end of file
+        """
+        IRC-specific tracking of a names reply, reading prefix symbols using the server's ISUPPORT PREFIX
+        :type event: obrbot.event.IrcEvent
+        """
+        isupport = event.conn.isupport
+        for name in event.content.split():
+            mode, name = isupport.split_prefix(name)
+            if not name:
+                logger.warning("Names entry {} didn't fit specifications.".format(mode))
+                continue
+            # with userhost-in-names, entries are full masks
+            nick, _, userhost = name.partition("!")
+            ident, _, host = userhost.partition("@")
+            # add the user, sharing their User with any other channels they're in
+            user = event.conn.users.add(nick, self, ident=ident or None, host=host or None)
+            if ident and host and self.users.get(nick) in self.unconfirmed:
+                # the mask from the snapshot may be out of date
+                user.learn(ident, host)
+            self.users[nick] = Membership(user, mode)
+
+    def track_366_end_of_names(self, event):
+        """
+        IRC-specific tracking of the end of a names reply, which drops any users adopted from a snapshot who weren't
+        in it, as they've left since the snapshot was taken
+        :type event: obrbot.event.IrcEvent
+        """
+        if not self.unconfirmed:
+            return
+        for nick, membership in list(self.users.items()):
+            if membership in self.unconfirmed:
+                del self.users[nick]
+                event.conn.users.remove(nick, self)
+        self.unconfirmed.clear()
\ No newline at end of file
@@ -0,0 +1,38 @@
+import logging
+
+from obrbot.database.base import Database, DatabaseError
+from obrbot.database.memory import MemoryDatabase
+from obrbot.database.redis import RedisClient
+from obrbot.database.sqlite import SQLiteDatabase
+
+logger = logging.getLogger("obrbot")
+
+database_types = ("redis", "sqlite", "memory")
+
+
+def create_database(db_config, *, loop, command_metrics=None):
+    """
+    Creates the database named by the "type" key of the database config
+    :type db_config: dict
+    :type loop: asyncio.events.AbstractEventLoop
+    :type command_metrics: obrbot.metrics.CommandMetrics
+    :rtype: Database
+    """
+    db_type = db_config.get("type", "redis")
+    if db_type == "memory":
+        logger.info("Using an in-memory database, nothing will be saved")
+        return MemoryDatabase(loop=loop, command_metrics=command_metrics)
+    elif db_type == "sqlite":
+        path = db_config.get("path", "data/obrbot.db")
+        logger.info("Opening sqlite database at {}".format(path))
+        return SQLiteDatabase(path, loop=loop, command_metrics=command_metrics)
+    elif db_type != "redis":
+        logger.warning("Unknown database type '{}', valid types are: {}. Using 'redis'.".format(
+            db_type, ", ".join(database_types)))
+
+    host = db_config.get("host", "localhost")
+    port = db_config.get("port", 6379)
+    database = db_config.get("database", 0)
+    logger.info("Connecting to redis at {}:{}/{}".format(host, port, database))
+    return RedisClient(host, port, database, password=db_config.get("password"),
+                       pool_size=db_config.get("pool_size", 2), loop=loop, command_metrics=command_metrics)
@@ -0,0 +1,316 @@
+import asyncio
+import time
+
+from obrbot.util.hyperloglog import HyperLogLog
+
+# The commands every database supports. They follow redis-py 2.x's StrictRedis: the same names, arguments and reply
+# types, so code using bot.db works the same whichever database is configured.
+commands = (
+    # server and keys
+    "ping", "delete", "exists", "type", "scan", "keys", "memory_usage",
+    # strings
+    "get", "set", "incr", "incrby",
+    # hyperloglogs
+    "pfadd", "pfcount",
+    # sets
+    "sadd", "srem", "smembers", "sismember", "scard",
+    # sorted sets
+    "zadd", "zrem", "zcard", "zcount", "zscore", "zincrby", "zrange", "zrevrange", "zrangebyscore",
+    "zrevrangebyscore", "zremrangebyscore", "zremrangebyrank", "zscan",
+    # hashes
+    "hget", "hset", "hmset", "hgetall", "hdel", "hincrby", "hscan",
+)
+
+
+class DatabaseError(Exception):
+    pass
+
+
+class WrongTypeError(DatabaseError):
+    def __init__(self):
+        super().__init__("WRONGTYPE Operation against a key holding the wrong kind of value")
+
+
+def to_bytes(value):
+    """
+    Converts a value to bytes the same way redis-py does when sending it
+    :type value: bytes | str | int | float
+    :rtype: bytes
+    """
+    if isinstance(value, bytes):
+        return value
+    elif isinstance(value, str):
+        return value.encode("utf-8")
+    elif isinstance(value, float):
+        return repr(value).encode("ascii")
+    else:
+        return str(value).encode("utf-8")
+
+
+def to_key(key):
+    """
+    :type key: bytes | str
+    :rtype: str
+    """
+    if isinstance(key, bytes):
+        return key.decode("utf-8")
+    return key
+
+
+def parse_score_bound(value):
+    """
+    Parses a sorted set score bound such as 1.5, "(1.5", "-inf" or "+inf"
+    :type value: float | int | str | bytes
+    :return: The bound, and whether it is exclusive
+    :rtype: (float, bool)
+    """
+    if isinstance(value, (int, float)):
+        return float(value), False
+    if isinstance(value, bytes):
+        value = value.decode("ascii")
+    if value.startswith("("):
+        return float(value[1:]), True
+    return float(value), False
+
+
+def zadd_pairs(args, kwargs):
+    """
+    Converts ZADD's arguments, either score1, name1, score2, name2 as positional arguments or name1=score1 as keyword
+    arguments, to (score, member) pairs
+    :rtype: list[(float, bytes)]
+    """
+    if len(args) % 2 != 0:
+        raise DatabaseError("ZADD requires an equal number of values and scores")
+    pairs = [(float(args[index]), to_bytes(args[index + 1])) for index in range(0, len(args), 2)]
+    pairs.extend((float(score), to_bytes(member)) for member, score in kwargs.items())
+    return pairs
+
+
+def rank_slice(length, start, end):
+    """
+    Converts redis-style inclusive start and end ranks, which may be negative, to a python slice
+    :type length: int
+    :type start: int
+    :type end: int
+    :rtype: slice
+    """
+    if start < 0:
+        start = max(length + start, 0)
+    if end < 0:
+        end += length
+    return slice(start, max(end + 1, start))
+
+
+def with_scores(items, withscores, score_cast_func):
+    """
+    :type items: list[(float, bytes)]
+    :type withscores: bool
+    :rtype: list[bytes] | list[(bytes, float)]
+    """
+    if withscores:
+        return [(member, score_cast_func(score)) for score, member in items]
+    return [member for score, member in items]
+
+
+class Database:
+    """
+    A key-value store with sets, sorted sets and hashes, accessed through coroutines named after the matching redis
+    commands (see `commands`).
+
+    :type name: str
+    :type supports_streams: bool
+    """
+    name = None
+    supports_streams = False
+
+    def pipeline(self, transaction=True):
+        """
+        Returns a pipeline, which buffers commands and runs them together when its execute() coroutine is called
+        :type transaction: bool
+        """
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+
+class LocalPipeline:
+    """
+    A pipeline for databases which run in the bot's process. Commands are queued by calling them, and run in one
+    batch by `execute()`. Command methods return the pipeline, so they can be chained.
+
+    :type db: LocalDatabase
+    :type transaction: bool
+    """
+
+    def __init__(self, db, transaction=True):
+        """
+        :type db: LocalDatabase
+        :type transaction: bool
+        """
+        self.db = db
+        self.transaction = transaction
+        self._calls = []
+
+    def __getattr__(self, name):
+        if name not in commands:
+            raise AttributeError(name)
+
+        def queue(*args, **kwargs):
+            self._calls.append((name, args, kwargs))
+            return self
+
+        return queue
+
+    def __len__(self):
+        return len(self._calls)
+
+    def reset(self):
+        self._calls = []
+
+    @asyncio.coroutine
+    def execute(self, raise_on_error=True):
+        """
+        Runs all queued commands, and returns a list of their replies
+        :param raise_on_error: If True, raise the first error, otherwise return errors in the list of replies
+        :type raise_on_error: bool
+        :rtype: list
+        """
+        calls, self._calls = self._calls, []
+        if not calls:
+            return []
+        results = yield from self.db.run_batch(calls)
+        if raise_on_error:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return results
+
+
+class LocalDatabase(Database):
+    """
+    Base for databases which run in the bot's process. Subclasses implement each command as a blocking method named
+    after it with a leading underscore, and `run`/`run_batch` decide where those methods are called.
+
+    :type loop: asyncio.events.AbstractEventLoop
+    :type command_metrics: obrbot.metrics.CommandMetrics
+    """
+
+    def __init__(self, *, loop, command_metrics=None):
+        """
+        :type loop: asyncio.events.AbstractEventLoop
+        :type command_metrics: obrbot.metrics.CommandMetrics
+        """
+        self.loop = loop
+        self.command_metrics = command_metrics
+
+    def record(self, name, duration):
+        if self.command_metrics is not None:
+            self.command_metrics.record(name, duration)
+
+    def _call(self, name, args, kwargs):
+        """
+        Calls the blocking implementation of a command, recording how long it took
+        """
+        start = time.perf_counter()
+        try:
+            return getattr(self, "_" + name)(*args, **kwargs)
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def _call_batch(self, calls):
+        """
+        Calls the blocking implementation of each command, returning errors in the list of results rather than
+        raising them
+        :type calls: list[(str, tuple, dict)]
+        :rtype: list
+        """
+        results = []
+        for name, args, kwargs in calls:
+            try:
+                results.append(self._call(name, args, kwargs))
+            except DatabaseError as e:
+                results.append(e)
+        return results
+
+    @asyncio.coroutine
+    def run(self, name, args, kwargs):
+        """
+        Runs a single command
+        :type name: str
+        :type args: tuple
+        :type kwargs: dict
+        """
+        raise NotImplementedError
+
+    @asyncio.coroutine
+    def run_batch(self, calls):
+        """
+        Runs a batch of commands from a pipeline
+        :type calls: list[(str, tuple, dict)]
+        :rtype: list
+        """
+        raise NotImplementedError
+
+    def pipeline(self, transaction=True):
+        """
+        :type transaction: bool
+        :rtype: LocalPipeline
+        """
+        return LocalPipeline(self, transaction)
+
+    def _incr(self, name, amount=1):
+        return self._incrby(name, amount)
+
+    def _ping(self):
+        return True
+
+    def _memory_usage(self, name):
+        # there's no meaningful equivalent outside of redis
+        return None
+
+    def _hyperloglog(self, name):
+        """
+        :type name: bytes | str
+        :rtype: HyperLogLog | None
+        """
+        data = self._get(name)
+        if data is None:
+            return None
+        try:
+            return HyperLogLog.from_bytes(data)
+        except ValueError:
+            raise DatabaseError("WRONGTYPE Key is not a valid HyperLogLog string value.") from None
+
+    def _pfadd(self, name, *values):
+        hyperloglog = self._hyperloglog(name)
+        changed = hyperloglog is None
+        if changed:
+            hyperloglog = HyperLogLog()
+        for value in values:
+            changed = hyperloglog.add(to_bytes(value)) or changed
+        if changed:
+            self._set(name, hyperloglog.to_bytes())
+        return int(changed)
+
+    def _pfcount(self, *names):
+        union = HyperLogLog()
+        for name in names:
+            hyperloglog = self._hyperloglog(name)
+            if hyperloglog is not None:
+                union.merge(hyperloglog)
+        return union.count()
+
+
+def _make_command(name):
+    @asyncio.coroutine
+    def command(self, *args, **kwargs):
+        return (yield from self.run(name, args, kwargs))
+
+    command.__name__ = name
+    command.__qualname__ = "LocalDatabase." + name
+    return command
+
+
+for _name in commands:
+    setattr(LocalDatabase, _name, _make_command(_name))
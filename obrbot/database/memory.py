@@ -0,0 +1,385 @@
+import asyncio
+import bisect
+from fnmatch import fnmatchcase
+import itertools
+
+from obrbot.database.base import LocalDatabase, DatabaseError, WrongTypeError, to_bytes, to_key, parse_score_bound, \
+    zadd_pairs, rank_slice, with_scores
+
+
+class _AfterAll:
+    """
+    Compares greater than any member, so that bisecting for (score, _after_all) finds the end of a score's members
+    """
+
+    def __gt__(self, other):
+        return True
+
+    def __lt__(self, other):
+        return False
+
+
+_after_all = _AfterAll()
+
+
+class _SortedSet:
+    """
+    A sorted set: a dict of member to score, and a list of (score, member) kept sorted with bisect, so that ranges by
+    rank or score don't need to sort the whole set.
+    """
+    __slots__ = ("scores", "items")
+
+    def __init__(self):
+        self.scores = {}
+        self.items = []
+
+    def __len__(self):
+        return len(self.scores)
+
+    def add(self, member, score):
+        """
+        :return: True if the member is new
+        :rtype: bool
+        """
+        old_score = self.scores.get(member)
+        if old_score is not None:
+            if old_score == score:
+                return False
+            del self.items[bisect.bisect_left(self.items, (old_score, member))]
+        self.scores[member] = score
+        bisect.insort(self.items, (score, member))
+        return old_score is None
+
+    def remove(self, member):
+        """
+        :rtype: bool
+        """
+        score = self.scores.pop(member, None)
+        if score is None:
+            return False
+        del self.items[bisect.bisect_left(self.items, (score, member))]
+        return True
+
+    def score_range(self, low, high):
+        """
+        Gets the index of the first item within the given score bounds, and the index after the last
+        :type low: float | int | str | bytes
+        :type high: float | int | str | bytes
+        :rtype: (int, int)
+        """
+        low, low_exclusive = parse_score_bound(low)
+        high, high_exclusive = parse_score_bound(high)
+        start = bisect.bisect_left(self.items, (low, _after_all) if low_exclusive else (low,))
+        end = bisect.bisect_left(self.items, (high,) if high_exclusive else (high, _after_all))
+        return start, max(start, end)
+
+
+class MemoryDatabase(LocalDatabase):
+    """
+    A database kept in the bot's memory. Nothing is persisted, so it suits tests and deployments which don't need
+    history or settings to survive a restart. Commands run directly on the event loop.
+
+    :type data: dict[bytes, bytes | set | _SortedSet | dict]
+    """
+    name = "memory"
+
+    def __init__(self, *, loop, command_metrics=None):
+        """
+        :type loop: asyncio.events.AbstractEventLoop
+        :type command_metrics: obrbot.metrics.CommandMetrics
+        """
+        super().__init__(loop=loop, command_metrics=command_metrics)
+        self.data = {}
+        # SCAN cursors are positions in key creation order, so keys deleted during a scan don't make it skip others
+        self._key_ids = {}
+        self._next_id = itertools.count(1)
+
+    @asyncio.coroutine
+    def run(self, name, args, kwargs):
+        return self._call(name, args, kwargs)
+
+    @asyncio.coroutine
+    def run_batch(self, calls):
+        return self._call_batch(calls)
+
+    def close(self):
+        pass
+
+    def _value(self, name, kind, create=False):
+        """
+        Gets the value of a key, checking it has the right type
+        :type name: bytes | str
+        :type kind: type
+        :param create: If True, create an empty value if the key doesn't exist
+        :return: The value, or None if the key doesn't exist
+        """
+        key = to_bytes(name)
+        value = self.data.get(key)
+        if value is None:
+            if create:
+                value = self.data[key] = kind()
+                self._key_ids[key] = next(self._next_id)
+        elif not isinstance(value, kind):
+            raise WrongTypeError()
+        return value
+
+    def _remove_if_empty(self, name, value):
+        if not value:
+            self._delete_key(to_bytes(name))
+
+    def _delete_key(self, key):
+        del self.data[key]
+        del self._key_ids[key]
+
+    # server and keys
+
+    def _delete(self, *names):
+        removed = 0
+        for name in names:
+            key = to_bytes(name)
+            if key in self.data:
+                self._delete_key(key)
+                removed += 1
+        return removed
+
+    def _exists(self, name):
+        return to_bytes(name) in self.data
+
+    def _type(self, name):
+        value = self.data.get(to_bytes(name))
+        if value is None:
+            return b"none"
+        elif isinstance(value, bytes):
+            return b"string"
+        elif isinstance(value, set):
+            return b"set"
+        elif isinstance(value, _SortedSet):
+            return b"zset"
+        else:
+            return b"hash"
+
+    def _keys(self, pattern="*"):
+        pattern = to_key(pattern)
+        return [key for key in self.data if fnmatchcase(key.decode("utf-8", "replace"), pattern)]
+
+    def _scan(self, cursor=0, match=None, count=None):
+        pattern = to_key(match) if match is not None else None
+        count = count or 10
+        remaining = sorted((key_id, key) for key, key_id in self._key_ids.items() if key_id > int(cursor))
+        page = remaining[:count]
+        keys = [key for key_id, key in page
+                if pattern is None or fnmatchcase(key.decode("utf-8", "replace"), pattern)]
+        if len(remaining) <= count:
+            return 0, keys
+        return page[-1][0], keys
+
+    # strings
+
+    def _get(self, name):
+        return self._value(name, bytes)
+
+    def _set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        if ex is not None or px is not None:
+            raise DatabaseError("Expiring keys isn't supported by the memory database")
+        key = to_bytes(name)
+        exists = key in self.data
+        if (nx and exists) or (xx and not exists):
+            return None
+        if not exists:
+            self._key_ids[key] = next(self._next_id)
+        self.data[key] = to_bytes(value)
+        return True
+
+    def _incrby(self, name, amount=1):
+        value = self._value(name, bytes)
+        try:
+            value = int(value or 0) + amount
+        except ValueError:
+            raise DatabaseError("value is not an integer or out of range") from None
+        self._set(name, value)
+        return value
+
+    # sets
+
+    def _sadd(self, name, *values):
+        members = self._value(name, set, create=True)
+        size = len(members)
+        members.update(to_bytes(value) for value in values)
+        return len(members) - size
+
+    def _srem(self, name, *values):
+        members = self._value(name, set)
+        if members is None:
+            return 0
+        size = len(members)
+        members.difference_update(to_bytes(value) for value in values)
+        self._remove_if_empty(name, members)
+        return size - len(members)
+
+    def _smembers(self, name):
+        return set(self._value(name, set) or ())
+
+    def _sismember(self, name, value):
+        return to_bytes(value) in (self._value(name, set) or ())
+
+    def _scard(self, name):
+        return len(self._value(name, set) or ())
+
+    # sorted sets
+
+    def _zadd(self, name, *args, **kwargs):
+        pairs = zadd_pairs(args, kwargs)
+        zset = self._value(name, _SortedSet, create=True)
+        return sum(zset.add(member, score) for score, member in pairs)
+
+    def _zrem(self, name, *values):
+        zset = self._value(name, _SortedSet)
+        if zset is None:
+            return 0
+        removed = sum(zset.remove(to_bytes(value)) for value in values)
+        self._remove_if_empty(name, zset)
+        return removed
+
+    def _zcard(self, name):
+        return len(self._value(name, _SortedSet) or ())
+
+    def _zcount(self, name, min, max):
+        zset = self._value(name, _SortedSet)
+        if zset is None:
+            return 0
+        start, end = zset.score_range(min, max)
+        return end - start
+
+    def _zscore(self, name, value):
+        zset = self._value(name, _SortedSet)
+        if zset is None:
+            return None
+        return zset.scores.get(to_bytes(value))
+
+    def _zincrby(self, name, value, amount=1):
+        zset = self._value(name, _SortedSet, create=True)
+        member = to_bytes(value)
+        score = zset.scores.get(member, 0) + float(amount)
+        zset.add(member, score)
+        return score
+
+    def _zrange(self, name, start, end, desc=False, withscores=False, score_cast_func=float):
+        zset = self._value(name, _SortedSet)
+        if zset is None:
+            return []
+        items = zset.items[::-1] if desc else zset.items
+        return with_scores(items[rank_slice(len(items), start, end)], withscores, score_cast_func)
+
+    def _zrevrange(self, name, start, end, withscores=False, score_cast_func=float):
+        return self._zrange(name, start, end, True, withscores, score_cast_func)
+
+    def _zrangebyscore(self, name, min, max, start=None, num=None, withscores=False, score_cast_func=float,
+                       reverse=False):
+        if (start is None) != (num is None):
+            raise DatabaseError("``start`` and ``num`` must both be specified")
+        zset = self._value(name, _SortedSet)
+        if zset is None:
+            return []
+        low, high = zset.score_range(min, max)
+        items = zset.items[low:high]
+        if reverse:
+            items.reverse()
+        if start is not None:
+            items = items[start:] if num < 0 else items[start:start + num]
+        return with_scores(items, withscores, score_cast_func)
+
+    def _zrevrangebyscore(self, name, max, min, start=None, num=None, withscores=False, score_cast_func=float):
+        return self._zrangebyscore(name, min, max, start, num, withscores, score_cast_func, reverse=True)
+
+    def _zremrangebyscore(self, name, min, max):
+        zset = self._value(name, _SortedSet)
+        if zset is None:
+            return 0
+        low, high = zset.score_range(min, max)
+        return self._remove_items(name, zset, low, high)
+
+    def _zremrangebyrank(self, name, min, max):
+        zset = self._value(name, _SortedSet)
+        if zset is None:
+            return 0
+        ranks = rank_slice(len(zset), min, max)
+        return self._remove_items(name, zset, *ranks.indices(len(zset))[:2])
+
+    def _remove_items(self, name, zset, start, end):
+        for score, member in zset.items[start:end]:
+            del zset.scores[member]
+        del zset.items[start:end]
+        self._remove_if_empty(name, zset)
+        return max(end - start, 0)
+
+    def _zscan(self, name, cursor=0, match=None, count=None, score_cast_func=float):
+        zset = self._value(name, _SortedSet)
+        if zset is None:
+            return 0, []
+        # members are scanned in score order, so like redis a member whose score changes may be returned twice
+        cursor = int(cursor)
+        count = count or 10
+        page = zset.items[cursor:cursor + count]
+        if match is not None:
+            pattern = to_key(match)
+            page = [(score, member) for score, member in page
+                    if fnmatchcase(member.decode("utf-8", "replace"), pattern)]
+        next_cursor = cursor + count if cursor + count < len(zset) else 0
+        return next_cursor, with_scores(page, True, score_cast_func)
+
+    # hashes
+
+    def _hget(self, name, key):
+        return (self._value(name, dict) or {}).get(to_bytes(key))
+
+    def _hset(self, name, key, value):
+        fields = self._value(name, dict, create=True)
+        key = to_bytes(key)
+        new = key not in fields
+        fields[key] = to_bytes(value)
+        return int(new)
+
+    def _hmset(self, name, mapping):
+        if not mapping:
+            raise DatabaseError("'hmset' with 'mapping' of length 0")
+        fields = self._value(name, dict, create=True)
+        fields.update((to_bytes(key), to_bytes(value)) for key, value in mapping.items())
+        return True
+
+    def _hgetall(self, name):
+        return dict(self._value(name, dict) or {})
+
+    def _hdel(self, name, *keys):
+        fields = self._value(name, dict)
+        if fields is None:
+            return 0
+        removed = 0
+        for key in keys:
+            if fields.pop(to_bytes(key), None) is not None:
+                removed += 1
+        self._remove_if_empty(name, fields)
+        return removed
+
+    def _hscan(self, name, cursor=0, match=None, count=None):
+        fields = self._value(name, dict)
+        if fields is None:
+            return 0, {}
+        # fields are scanned in insertion order, so like redis a field removed during a scan may make it skip others
+        cursor = int(cursor)
+        count = count or 10
+        page = list(itertools.islice(fields.items(), cursor, cursor + count))
+        if match is not None:
+            pattern = to_key(match)
+            page = [(field, value) for field, value in page if fnmatchcase(field.decode("utf-8", "replace"), pattern)]
+        next_cursor = cursor + count if cursor + count < len(fields) else 0
+        return next_cursor, dict(page)
+
+    def _hincrby(self, name, key, amount=1):
+        fields = self._value(name, dict, create=True)
+        key = to_bytes(key)
+        try:
+            value = int(fields.get(key, 0)) + amount
+        except ValueError:
+            raise DatabaseError("hash value is not an integer") from None
+        fields[key] = to_bytes(value)
+        return value
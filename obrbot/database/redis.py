@@ -0,0 +1,718 @@
+import asyncio
+from collections import deque
+import logging
+import time
+
+from obrbot.database.base import Database, DatabaseError
+
+logger = logging.getLogger("obrbot")
+
+
+class RedisError(DatabaseError):
+    pass
+
+
+class ReplyError(RedisError):
+    """
+    An error reply sent by the server in response to a command
+    """
+    pass
+
+
+class ConnectionClosedError(RedisError, ConnectionError):
+    pass
+
+
+def encode_command(args):
+    """
+    Encodes a command as a RESP array of bulk strings, converting arguments the same way redis-py does
+    :type args: collections.Sequence[bytes | str | int | float]
+    :rtype: bytes
+    """
+    parts = ["*{}\r\n".format(len(args)).encode("ascii")]
+    for arg in args:
+        if isinstance(arg, bytes):
+            data = arg
+        elif isinstance(arg, str):
+            data = arg.encode("utf-8")
+        elif isinstance(arg, float):
+            data = repr(arg).encode("ascii")
+        else:
+            data = str(arg).encode("utf-8")
+        parts.append("${}\r\n".format(len(data)).encode("ascii"))
+        parts.append(data)
+        parts.append(b"\r\n")
+    return b"".join(parts)
+
+
+@asyncio.coroutine
+def read_reply(reader):
+    """
+    Reads a single RESP reply. Error replies are returned as ReplyError instances rather than raised, so that one
+    failed command doesn't affect the replies to commands pipelined after it.
+    :type reader: asyncio.StreamReader
+    :rtype: bytes | int | list | None | ReplyError
+    """
+    line = yield from reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionClosedError("Connection closed by server")
+    prefix, data = line[:1], line[1:-2]
+    if prefix == b"$":
+        length = int(data)
+        if length < 0:
+            return None
+        return (yield from reader.readexactly(length + 2))[:-2]
+    elif prefix == b":":
+        return int(data)
+    elif prefix == b"+":
+        return data
+    elif prefix == b"-":
+        return ReplyError(data.decode("utf-8", "replace"))
+    elif prefix == b"*":
+        length = int(data)
+        if length < 0:
+            return None
+        result = []
+        for _ in range(length):
+            result.append((yield from read_reply(reader)))
+        return result
+    else:
+        raise RedisError("Protocol error, got {!r} as reply type byte".format(prefix))
+
+
+class RedisConnection:
+    """
+    A single connection to a redis server. Commands are sent as soon as they are issued, without waiting for the
+    replies to earlier commands, and all commands issued in the same loop iteration are written together. Replies are
+    read in order by a background task and handed to the future of the matching command.
+
+    :type host: str
+    :type port: int
+    :type db: int
+    :type password: str
+    :type loop: asyncio.events.AbstractEventLoop
+    :type closed: bool
+    """
+
+    def __init__(self, host, port, *, db=0, password=None, loop):
+        """
+        :type host: str
+        :type port: int
+        :type db: int
+        :type password: str
+        :type loop: asyncio.events.AbstractEventLoop
+        """
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.loop = loop
+        self.closed = True
+
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        self._buffer = []
+        self._flush_scheduled = False
+        # futures waiting for replies, in the order their commands were sent
+        self._waiting = deque()
+
+    @property
+    def pending(self):
+        """
+        The number of commands sent which haven't had a reply yet
+        :rtype: int
+        """
+        return len(self._waiting)
+
+    @asyncio.coroutine
+    def connect(self):
+        self._reader, self._writer = yield from asyncio.open_connection(self.host, self.port, loop=self.loop)
+        self.closed = False
+        self._read_task = asyncio.async(self._read_replies(), loop=self.loop)
+        try:
+            if self.password:
+                yield from self.execute("AUTH", self.password)
+            if self.db:
+                yield from self.execute("SELECT", self.db)
+        except Exception:
+            self.close()
+            raise
+
+    def execute(self, *args):
+        """
+        Sends a command, returning a future which will be given its reply
+        :rtype: asyncio.Future
+        """
+        if self.closed:
+            raise ConnectionClosedError("Connection to {}:{} is closed".format(self.host, self.port))
+        future = asyncio.Future(loop=self.loop)
+        self._waiting.append(future)
+        self._buffer.append(encode_command(args))
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.loop.call_soon(self._flush)
+        return future
+
+    def _flush(self):
+        self._flush_scheduled = False
+        if self._buffer and not self.closed:
+            self._writer.write(b"".join(self._buffer))
+        self._buffer.clear()
+
+    @asyncio.coroutine
+    def _read_replies(self):
+        error = None
+        try:
+            while True:
+                reply = yield from read_reply(self._reader)
+                future = self._waiting.popleft()
+                if future.cancelled():
+                    continue
+                if isinstance(reply, ReplyError):
+                    future.set_exception(reply)
+                else:
+                    future.set_result(reply)
+        except asyncio.CancelledError:
+            error = ConnectionClosedError("Connection to {}:{} was closed".format(self.host, self.port))
+        except (ConnectionError, asyncio.IncompleteReadError, RedisError) as e:
+            logger.warning("Lost connection to redis at {}:{}: {}".format(self.host, self.port, e))
+            error = ConnectionClosedError("Lost connection to {}:{}".format(self.host, self.port))
+        except Exception:
+            logger.exception("Error reading from redis at {}:{}".format(self.host, self.port))
+            error = ConnectionClosedError("Lost connection to {}:{}".format(self.host, self.port))
+        finally:
+            self._read_task = None
+            self.close(error)
+
+    def close(self, error=None):
+        """
+        Closes the connection, failing any commands still waiting for replies
+        :type error: Exception
+        """
+        if self.closed and not self._waiting:
+            return
+        self.closed = True
+        if self._writer is not None:
+            self._writer.close()
+        if self._read_task is not None and not self._read_task.done():
+            self._read_task.cancel()
+        if error is None:
+            error = ConnectionClosedError("Connection to {}:{} was closed".format(self.host, self.port))
+        while self._waiting:
+            future = self._waiting.popleft()
+            if not future.done():
+                future.set_exception(error)
+
+
+def _to_bool(reply):
+    return bool(reply)
+
+
+def _ok(reply):
+    return reply == b"OK"
+
+
+def _to_float(reply):
+    if reply is None:
+        return None
+    return float(reply)
+
+
+def _to_set(reply):
+    if reply is None:
+        return set()
+    return set(reply)
+
+
+def _to_dict(reply):
+    if not reply:
+        return {}
+    it = iter(reply)
+    return dict(zip(it, it))
+
+
+def _scan_reply(reply):
+    cursor, keys = reply
+    return int(cursor), keys
+
+
+def _sorted_set_reply(withscores, score_cast_func=float):
+    if not withscores:
+        return None
+
+    def callback(reply):
+        it = iter(reply)
+        return [(member, score_cast_func(score)) for member, score in zip(it, it)]
+
+    return callback
+
+
+def _set_reply(reply):
+    # SET with NX or XX replies with a null bulk string when the key wasn't set
+    if reply is None:
+        return None
+    return reply == b"OK"
+
+
+def _stream_entries(reply):
+    if reply is None:
+        return []
+    return [(entry_id, _to_dict(fields)) for entry_id, fields in reply]
+
+
+class RedisCommands:
+    """
+    Redis commands, with the same signatures and reply types as redis-py 2.x's StrictRedis, so plugins can switch
+    between clients without changes. Each method hands its arguments to `execute_command`, along with a callback to
+    convert the raw reply.
+    """
+
+    def execute_command(self, *args, callback=None):
+        raise NotImplementedError
+
+    # server
+
+    def ping(self):
+        return self.execute_command("PING", callback=lambda reply: reply == b"PONG")
+
+    def info(self, section=None):
+        if section is None:
+            return self.execute_command("INFO")
+        return self.execute_command("INFO", section)
+
+    # keys
+
+    def delete(self, *names):
+        return self.execute_command("DEL", *names)
+
+    def exists(self, name):
+        return self.execute_command("EXISTS", name, callback=_to_bool)
+
+    def expire(self, name, time):
+        return self.execute_command("EXPIRE", name, time, callback=_to_bool)
+
+    def keys(self, pattern="*"):
+        return self.execute_command("KEYS", pattern)
+
+    def scan(self, cursor=0, match=None, count=None):
+        pieces = [cursor]
+        if match is not None:
+            pieces.extend(("MATCH", match))
+        if count is not None:
+            pieces.extend(("COUNT", count))
+        return self.execute_command("SCAN", *pieces, callback=_scan_reply)
+
+    def type(self, name):
+        return self.execute_command("TYPE", name)
+
+    def memory_usage(self, name):
+        """
+        Returns the number of bytes a key and its value use, or None if the key doesn't exist. Requires redis 4.0+.
+        """
+        return self.execute_command("MEMORY", "USAGE", name)
+
+    # strings
+
+    def get(self, name):
+        return self.execute_command("GET", name)
+
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        pieces = [name, value]
+        if ex is not None:
+            pieces.extend(("EX", ex))
+        if px is not None:
+            pieces.extend(("PX", px))
+        if nx:
+            pieces.append("NX")
+        if xx:
+            pieces.append("XX")
+        return self.execute_command("SET", *pieces, callback=_set_reply)
+
+    def incr(self, name, amount=1):
+        return self.incrby(name, amount)
+
+    def incrby(self, name, amount=1):
+        return self.execute_command("INCRBY", name, amount)
+
+    # hyperloglogs
+
+    def pfadd(self, name, *values):
+        return self.execute_command("PFADD", name, *values)
+
+    def pfcount(self, *names):
+        return self.execute_command("PFCOUNT", *names)
+
+    # hashes
+
+    def hget(self, name, key):
+        return self.execute_command("HGET", name, key)
+
+    def hset(self, name, key, value):
+        return self.execute_command("HSET", name, key, value)
+
+    def hmset(self, name, mapping):
+        pieces = []
+        for pair in mapping.items():
+            pieces.extend(pair)
+        return self.execute_command("HMSET", name, *pieces, callback=_ok)
+
+    def hgetall(self, name):
+        return self.execute_command("HGETALL", name, callback=_to_dict)
+
+    def hdel(self, name, *keys):
+        return self.execute_command("HDEL", name, *keys)
+
+    def hincrby(self, name, key, amount=1):
+        return self.execute_command("HINCRBY", name, key, amount)
+
+    def hscan(self, name, cursor=0, match=None, count=None):
+        pieces = [name, cursor]
+        if match is not None:
+            pieces.extend(("MATCH", match))
+        if count is not None:
+            pieces.extend(("COUNT", count))
+        return self.execute_command("HSCAN", *pieces, callback=lambda reply: (int(reply[0]), _to_dict(reply[1])))
+
+    # lists
+
+    def lpush(self, name, *values):
+        return self.execute_command("LPUSH", name, *values)
+
+    def rpush(self, name, *values):
+        return self.execute_command("RPUSH", name, *values)
+
+    def lrange(self, name, start, end):
+        return self.execute_command("LRANGE", name, start, end)
+
+    def ltrim(self, name, start, end):
+        return self.execute_command("LTRIM", name, start, end, callback=_ok)
+
+    # sets
+
+    def sadd(self, name, *values):
+        return self.execute_command("SADD", name, *values)
+
+    def srem(self, name, *values):
+        return self.execute_command("SREM", name, *values)
+
+    def smembers(self, name):
+        return self.execute_command("SMEMBERS", name, callback=_to_set)
+
+    def sismember(self, name, value):
+        return self.execute_command("SISMEMBER", name, value, callback=_to_bool)
+
+    def scard(self, name):
+        return self.execute_command("SCARD", name)
+
+    # sorted sets
+
+    def zadd(self, name, *args, **kwargs):
+        """
+        Takes either score1, name1, score2, name2 as positional arguments, or name1=score1 as keyword arguments
+        """
+        if len(args) % 2 != 0:
+            raise RedisError("ZADD requires an equal number of values and scores")
+        pieces = list(args)
+        for pair in kwargs.items():
+            pieces.append(pair[1])
+            pieces.append(pair[0])
+        return self.execute_command("ZADD", name, *pieces)
+
+    def zrem(self, name, *values):
+        return self.execute_command("ZREM", name, *values)
+
+    def zcard(self, name):
+        return self.execute_command("ZCARD", name)
+
+    def zcount(self, name, min, max):
+        return self.execute_command("ZCOUNT", name, min, max)
+
+    def zscore(self, name, value):
+        return self.execute_command("ZSCORE", name, value, callback=_to_float)
+
+    def zincrby(self, name, value, amount=1):
+        return self.execute_command("ZINCRBY", name, amount, value, callback=_to_float)
+
+    def zrange(self, name, start, end, desc=False, withscores=False, score_cast_func=float):
+        if desc:
+            return self.zrevrange(name, start, end, withscores, score_cast_func)
+        pieces = [name, start, end]
+        if withscores:
+            pieces.append("WITHSCORES")
+        return self.execute_command("ZRANGE", *pieces, callback=_sorted_set_reply(withscores, score_cast_func))
+
+    def zrevrange(self, name, start, end, withscores=False, score_cast_func=float):
+        pieces = [name, start, end]
+        if withscores:
+            pieces.append("WITHSCORES")
+        return self.execute_command("ZREVRANGE", *pieces, callback=_sorted_set_reply(withscores, score_cast_func))
+
+    def zrangebyscore(self, name, min, max, start=None, num=None, withscores=False, score_cast_func=float):
+        if (start is None) != (num is None):
+            raise RedisError("``start`` and ``num`` must both be specified")
+        pieces = [name, min, max]
+        if start is not None:
+            pieces.extend(("LIMIT", start, num))
+        if withscores:
+            pieces.append("WITHSCORES")
+        return self.execute_command("ZRANGEBYSCORE", *pieces,
+                                    callback=_sorted_set_reply(withscores, score_cast_func))
+
+    def zrevrangebyscore(self, name, max, min, start=None, num=None, withscores=False, score_cast_func=float):
+        if (start is None) != (num is None):
+            raise RedisError("``start`` and ``num`` must both be specified")
+        pieces = [name, max, min]
+        if start is not None:
+            pieces.extend(("LIMIT", start, num))
+        if withscores:
+            pieces.append("WITHSCORES")
+        return self.execute_command("ZREVRANGEBYSCORE", *pieces,
+                                    callback=_sorted_set_reply(withscores, score_cast_func))
+
+    def zscan(self, name, cursor=0, match=None, count=None, score_cast_func=float):
+        pieces = [name, cursor]
+        if match is not None:
+            pieces.extend(("MATCH", match))
+        if count is not None:
+            pieces.extend(("COUNT", count))
+        members_callback = _sorted_set_reply(True, score_cast_func)
+        return self.execute_command("ZSCAN", *pieces,
+                                    callback=lambda reply: (int(reply[0]), members_callback(reply[1])))
+
+    def zremrangebyscore(self, name, min, max):
+        return self.execute_command("ZREMRANGEBYSCORE", name, min, max)
+
+    def zremrangebyrank(self, name, min, max):
+        return self.execute_command("ZREMRANGEBYRANK", name, min, max)
+
+    # streams, which redis-py 2.x doesn't have, so these follow redis-py 3.x. Require redis 5.0+.
+
+    def xadd(self, name, fields, id="*", maxlen=None, approximate=True):
+        """
+        :type fields: dict
+        """
+        pieces = []
+        if maxlen is not None:
+            pieces.append("MAXLEN")
+            if approximate:
+                pieces.append("~")
+            pieces.append(maxlen)
+        pieces.append(id)
+        for pair in fields.items():
+            pieces.extend(pair)
+        return self.execute_command("XADD", name, *pieces)
+
+    def xrange(self, name, min="-", max="+", count=None):
+        pieces = [name, min, max]
+        if count is not None:
+            pieces.extend(("COUNT", count))
+        return self.execute_command("XRANGE", *pieces, callback=_stream_entries)
+
+    def xrevrange(self, name, max="+", min="-", count=None):
+        pieces = [name, max, min]
+        if count is not None:
+            pieces.extend(("COUNT", count))
+        return self.execute_command("XREVRANGE", *pieces, callback=_stream_entries)
+
+    def xlen(self, name):
+        return self.execute_command("XLEN", name)
+
+    def xtrim(self, name, maxlen, approximate=True):
+        pieces = [name, "MAXLEN"]
+        if approximate:
+            pieces.append("~")
+        pieces.append(maxlen)
+        return self.execute_command("XTRIM", *pieces)
+
+
+class Pipeline(RedisCommands):
+    """
+    Buffers commands, then sends them all at once when `execute()` is called. If `transaction` is True, the commands
+    are wrapped in MULTI/EXEC. Command methods return the pipeline, so they can be chained.
+
+    :type client: RedisClient
+    :type transaction: bool
+    """
+
+    def __init__(self, client, transaction=True):
+        """
+        :type client: RedisClient
+        :type transaction: bool
+        """
+        self.client = client
+        self.transaction = transaction
+        self._commands = []
+
+    def __len__(self):
+        return len(self._commands)
+
+    def execute_command(self, *args, callback=None):
+        self._commands.append((args, callback))
+        return self
+
+    def reset(self):
+        self._commands = []
+
+    @asyncio.coroutine
+    def execute(self, raise_on_error=True):
+        """
+        Sends all buffered commands, and returns a list of their replies
+        :param raise_on_error: If True, raise the first error reply, otherwise return errors in the list of replies
+        :type raise_on_error: bool
+        :rtype: list
+        """
+        commands, self._commands = self._commands, []
+        if not commands:
+            return []
+
+        connection = yield from self.client.acquire()
+        start = time.perf_counter()
+        # every command is given to the connection without yielding, so they're written together and in order
+        if self.transaction:
+            futures = [connection.execute("MULTI")]
+            futures.extend(connection.execute(*args) for args, callback in commands)
+            exec_future = connection.execute("EXEC")
+        else:
+            futures = [connection.execute(*args) for args, callback in commands]
+            exec_future = None
+
+        try:
+            replies = yield from asyncio.gather(*futures, loop=self.client.loop, return_exceptions=True)
+            if exec_future is not None:
+                # errors queuing commands abort the transaction, so report those rather than the EXEC error
+                for reply in replies:
+                    if isinstance(reply, ReplyError):
+                        exec_future.cancel()
+                        raise reply
+                replies = yield from exec_future
+                if replies is None:
+                    raise RedisError("Transaction aborted")
+        finally:
+            self.client.record("pipeline", time.perf_counter() - start)
+
+        results = []
+        for (args, callback), reply in zip(commands, replies):
+            if isinstance(reply, Exception):
+                if raise_on_error:
+                    raise reply
+            elif callback is not None:
+                reply = callback(reply)
+            results.append(reply)
+        return results
+
+
+class RedisClient(RedisCommands, Database):
+    """
+    An asyncio redis client. Every command method is a coroutine. Commands are automatically pipelined: concurrent
+    commands are sent together without waiting for each other's replies. Up to `pool_size` connections are opened,
+    with another only being opened when every open connection is waiting on replies.
+
+    :type host: str
+    :type port: int
+    :type db: int
+    :type password: str
+    :type pool_size: int
+    :type loop: asyncio.events.AbstractEventLoop
+    :type command_metrics: obrbot.metrics.CommandMetrics
+    :type connections: list[RedisConnection]
+    """
+    name = "redis"
+    supports_streams = True
+
+    def __init__(self, host="localhost", port=6379, db=0, *, password=None, pool_size=2, loop,
+                 command_metrics=None):
+        """
+        :type host: str
+        :type port: int
+        :type db: int
+        :type password: str
+        :type pool_size: int
+        :type loop: asyncio.events.AbstractEventLoop
+        :type command_metrics: obrbot.metrics.CommandMetrics
+        """
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.pool_size = max(pool_size, 1)
+        self.loop = loop
+        self.command_metrics = command_metrics
+        self.connections = []
+        self._opening = None
+
+    def record(self, name, duration):
+        if self.command_metrics is not None:
+            self.command_metrics.record(name, duration)
+
+    @asyncio.coroutine
+    def _open(self):
+        connection = RedisConnection(self.host, self.port, db=self.db, password=self.password, loop=self.loop)
+        yield from connection.connect()
+        self.connections.append(connection)
+        logger.debug("Opened redis connection {} to {}:{}/{}".format(len(self.connections), self.host, self.port,
+                                                                      self.db))
+        return connection
+
+    @asyncio.coroutine
+    def acquire(self):
+        """
+        Gets the connection with the fewest commands waiting on replies, opening a new one if all are busy and the
+        pool isn't full
+        :rtype: RedisConnection
+        """
+        while True:
+            self.connections = [connection for connection in self.connections if not connection.closed]
+            best = None
+            if self.connections:
+                best = min(self.connections, key=lambda connection: connection.pending)
+            if best is not None and (best.pending == 0 or self._opening is not None or
+                                     len(self.connections) >= self.pool_size):
+                return best
+
+            if self._opening is None:
+                self._opening = asyncio.async(self._open(), loop=self.loop)
+            opening = self._opening
+            try:
+                yield from asyncio.shield(opening, loop=self.loop)
+            finally:
+                if self._opening is opening and opening.done():
+                    self._opening = None
+
+    @asyncio.coroutine
+    def execute_command(self, *args, callback=None):
+        connection = yield from self.acquire()
+        start = time.perf_counter()
+        try:
+            reply = yield from connection.execute(*args)
+        finally:
+            self.record(args[0].lower(), time.perf_counter() - start)
+        if callback is not None:
+            return callback(reply)
+        return reply
+
+    def pipeline(self, transaction=True):
+        """
+        :type transaction: bool
+        :rtype: Pipeline
+        """
+        return Pipeline(self, transaction)
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+
+
+def _coroutine_commands(cls):
+    """
+    Makes each of RedisCommands's methods a coroutine function on the given class, so that callers such as
+    Event.async can tell that they shouldn't be run in an executor
+    """
+    for name, value in vars(RedisCommands).items():
+        if not name.startswith("_") and name != "execute_command" and callable(value):
+            setattr(cls, name, asyncio.coroutine(value))
+    return cls
+
+
+RedisClient = _coroutine_commands(RedisClient)
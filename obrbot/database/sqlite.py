@@ -0,0 +1,380 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sqlite3
+
+from obrbot.database.base import LocalDatabase, DatabaseError, WrongTypeError, to_bytes, to_key, parse_score_bound, \
+    zadd_pairs, rank_slice, with_scores
+
+_schema = """
+CREATE TABLE IF NOT EXISTS keys (key TEXT PRIMARY KEY, type TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sets (key TEXT, member BLOB, PRIMARY KEY (key, member)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS zsets (key TEXT, member BLOB, score REAL NOT NULL, PRIMARY KEY (key, member))
+    WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS zsets_score ON zsets (key, score, member);
+CREATE TABLE IF NOT EXISTS hashes (key TEXT, field BLOB, value BLOB NOT NULL, PRIMARY KEY (key, field))
+    WITHOUT ROWID;
+"""
+
+# the table holding each type's values
+_tables = {"string": "kv", "set": "sets", "zset": "zsets", "hash": "hashes"}
+
+
+def _score_condition(value, inclusive, exclusive):
+    """
+    :type value: float | int | str | bytes
+    :param inclusive: The comparison operator to use if the bound is inclusive
+    :param exclusive: The comparison operator to use if the bound is exclusive
+    :rtype: (str, float)
+    """
+    bound, is_exclusive = parse_score_bound(value)
+    return "score {} ?".format(exclusive if is_exclusive else inclusive), bound
+
+
+def _limit(start, num):
+    """
+    :rtype: (str, tuple)
+    """
+    if (start is None) != (num is None):
+        raise DatabaseError("``start`` and ``num`` must both be specified")
+    if start is None:
+        return "", ()
+    return " LIMIT ? OFFSET ?", (num, start)
+
+
+class SQLiteDatabase(LocalDatabase):
+    """
+    A database stored in an SQLite file. The file uses write-ahead logging, so writes only append to the log and
+    don't block reads. SQLite calls block, so they all run on a single thread of their own, and each pipeline runs in
+    one transaction.
+
+    :type path: str
+    :type executor: ThreadPoolExecutor
+    """
+    name = "sqlite"
+
+    def __init__(self, path, *, loop, command_metrics=None):
+        """
+        :type path: str
+        :type loop: asyncio.events.AbstractEventLoop
+        :type command_metrics: obrbot.metrics.CommandMetrics
+        """
+        super().__init__(loop=loop, command_metrics=command_metrics)
+        self.path = path
+        self.executor = ThreadPoolExecutor(1)
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # only used on the executor's thread, after this
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # with WAL, NORMAL only risks losing the last transactions on power loss, never corrupting the database
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(_schema)
+
+    def _transaction(self, calls):
+        try:
+            self.connection.execute("BEGIN")
+            try:
+                results = self._call_batch(calls)
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+        except sqlite3.Error as e:
+            raise DatabaseError("SQLite error: {}".format(e)) from e
+        return results
+
+    def _run_one(self, name, args, kwargs):
+        result = self._transaction([(name, args, kwargs)])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    @asyncio.coroutine
+    def run(self, name, args, kwargs):
+        return (yield from self.loop.run_in_executor(self.executor, self._run_one, name, args, kwargs))
+
+    @asyncio.coroutine
+    def run_batch(self, calls):
+        return (yield from self.loop.run_in_executor(self.executor, self._transaction, calls))
+
+    def close(self):
+        self.executor.submit(self.connection.close)
+        self.executor.shutdown(wait=True)
+
+    def _query(self, sql, *params):
+        return self.connection.execute(sql, params)
+
+    def _key_type(self, key):
+        row = self._query("SELECT type FROM keys WHERE key = ?", key).fetchone()
+        return row[0] if row is not None else None
+
+    def _check(self, name, kind, create=False):
+        """
+        Checks the type of a key
+        :type name: bytes | str
+        :type kind: str
+        :param create: If True, create the key if it doesn't exist
+        :return: The key, as stored in the database, and whether it exists
+        :rtype: (str, bool)
+        """
+        key = to_key(name)
+        key_type = self._key_type(key)
+        if key_type is None:
+            if create:
+                self._query("INSERT INTO keys (key, type) VALUES (?, ?)", key, kind)
+            return key, create
+        elif key_type != kind:
+            raise WrongTypeError()
+        return key, True
+
+    def _remove_if_empty(self, key, kind):
+        table = _tables[kind]
+        if self._query("SELECT 1 FROM {} WHERE key = ? LIMIT 1".format(table), key).fetchone() is None:
+            self._query("DELETE FROM keys WHERE key = ?", key)
+
+    # server and keys
+
+    def _delete(self, *names):
+        removed = 0
+        for name in names:
+            key = to_key(name)
+            key_type = self._key_type(key)
+            if key_type is not None:
+                self._query("DELETE FROM {} WHERE key = ?".format(_tables[key_type]), key)
+                self._query("DELETE FROM keys WHERE key = ?", key)
+                removed += 1
+        return removed
+
+    def _exists(self, name):
+        return self._key_type(to_key(name)) is not None
+
+    def _type(self, name):
+        return (self._key_type(to_key(name)) or "none").encode("ascii")
+
+    def _keys(self, pattern="*"):
+        rows = self._query("SELECT key FROM keys WHERE key GLOB ?", to_key(pattern))
+        return [row[0].encode("utf-8") for row in rows]
+
+    def _scan(self, cursor=0, match=None, count=None):
+        # the cursor is the rowid of the last key looked at, so keys deleted during a scan don't make it skip others
+        count = count or 10
+        rows = self._query("SELECT rowid, key, key GLOB ? FROM keys WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                           to_key(match or "*"), int(cursor), count).fetchall()
+        keys = [key.encode("utf-8") for rowid, key, matches in rows if matches]
+        if len(rows) < count:
+            return 0, keys
+        return rows[-1][0], keys
+
+    # strings
+
+    def _get(self, name):
+        key, exists = self._check(name, "string")
+        if not exists:
+            return None
+        return self._query("SELECT value FROM kv WHERE key = ?", key).fetchone()[0]
+
+    def _set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        if ex is not None or px is not None:
+            raise DatabaseError("Expiring keys isn't supported by the sqlite database")
+        key = to_key(name)
+        key_type = self._key_type(key)
+        if (nx and key_type is not None) or (xx and key_type is None):
+            return None
+        if key_type is not None and key_type != "string":
+            # SET replaces a value of any type
+            self._delete(key)
+        self._query("INSERT OR IGNORE INTO keys (key, type) VALUES (?, 'string')", key)
+        self._query("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", key, to_bytes(value))
+        return True
+
+    def _incrby(self, name, amount=1):
+        value = self._get(name)
+        try:
+            value = int(value or 0) + amount
+        except ValueError:
+            raise DatabaseError("value is not an integer or out of range") from None
+        self._set(name, value)
+        return value
+
+    # sets
+
+    def _sadd(self, name, *values):
+        key, exists = self._check(name, "set", create=True)
+        cursor = self.connection.executemany("INSERT OR IGNORE INTO sets (key, member) VALUES (?, ?)",
+                                             [(key, to_bytes(value)) for value in values])
+        return cursor.rowcount
+
+    def _srem(self, name, *values):
+        key, exists = self._check(name, "set")
+        if not exists:
+            return 0
+        cursor = self.connection.executemany("DELETE FROM sets WHERE key = ? AND member = ?",
+                                             [(key, to_bytes(value)) for value in values])
+        self._remove_if_empty(key, "set")
+        return cursor.rowcount
+
+    def _smembers(self, name):
+        key, exists = self._check(name, "set")
+        return {row[0] for row in self._query("SELECT member FROM sets WHERE key = ?", key)}
+
+    def _sismember(self, name, value):
+        key, exists = self._check(name, "set")
+        return self._query("SELECT 1 FROM sets WHERE key = ? AND member = ?", key, to_bytes(value)).fetchone() \
+            is not None
+
+    def _scard(self, name):
+        key, exists = self._check(name, "set")
+        return self._query("SELECT COUNT(*) FROM sets WHERE key = ?", key).fetchone()[0]
+
+    # sorted sets
+
+    def _zadd(self, name, *args, **kwargs):
+        pairs = zadd_pairs(args, kwargs)
+        key, exists = self._check(name, "zset", create=True)
+        added = 0
+        for score, member in pairs:
+            cursor = self._query("UPDATE zsets SET score = ? WHERE key = ? AND member = ?", score, key, member)
+            if cursor.rowcount == 0:
+                self._query("INSERT INTO zsets (key, member, score) VALUES (?, ?, ?)", key, member, score)
+                added += 1
+        return added
+
+    def _zrem(self, name, *values):
+        key, exists = self._check(name, "zset")
+        if not exists:
+            return 0
+        cursor = self.connection.executemany("DELETE FROM zsets WHERE key = ? AND member = ?",
+                                             [(key, to_bytes(value)) for value in values])
+        self._remove_if_empty(key, "zset")
+        return cursor.rowcount
+
+    def _zcard(self, name):
+        key, exists = self._check(name, "zset")
+        return self._query("SELECT COUNT(*) FROM zsets WHERE key = ?", key).fetchone()[0]
+
+    def _score_range(self, select, name, min, max, suffix="", params=()):
+        key, exists = self._check(name, "zset")
+        low, low_bound = _score_condition(min, ">=", ">")
+        high, high_bound = _score_condition(max, "<=", "<")
+        return key, self._query("{} FROM zsets WHERE key = ? AND {} AND {}{}".format(select, low, high, suffix),
+                                key, low_bound, high_bound, *params)
+
+    def _zcount(self, name, min, max):
+        return self._score_range("SELECT COUNT(*)", name, min, max)[1].fetchone()[0]
+
+    def _zscore(self, name, value):
+        key, exists = self._check(name, "zset")
+        row = self._query("SELECT score FROM zsets WHERE key = ? AND member = ?", key, to_bytes(value)).fetchone()
+        return row[0] if row is not None else None
+
+    def _zincrby(self, name, value, amount=1):
+        score = (self._zscore(name, value) or 0) + float(amount)
+        self._zadd(name, score, value)
+        return score
+
+    def _zrange(self, name, start, end, desc=False, withscores=False, score_cast_func=float):
+        key, exists = self._check(name, "zset")
+        if not exists:
+            return []
+        ranks = rank_slice(self._zcard(key), start, end)
+        order = "DESC" if desc else "ASC"
+        rows = self._query("SELECT score, member FROM zsets WHERE key = ? ORDER BY score {0}, member {0} "
+                           "LIMIT ? OFFSET ?".format(order), key, ranks.stop - ranks.start, ranks.start)
+        return with_scores(rows.fetchall(), withscores, score_cast_func)
+
+    def _zrevrange(self, name, start, end, withscores=False, score_cast_func=float):
+        return self._zrange(name, start, end, True, withscores, score_cast_func)
+
+    def _zrangebyscore(self, name, min, max, start=None, num=None, withscores=False, score_cast_func=float,
+                       order="ASC"):
+        limit, params = _limit(start, num)
+        rows = self._score_range("SELECT score, member", name, min, max,
+                                 " ORDER BY score {0}, member {0}{1}".format(order, limit), params)[1]
+        return with_scores(rows.fetchall(), withscores, score_cast_func)
+
+    def _zrevrangebyscore(self, name, max, min, start=None, num=None, withscores=False, score_cast_func=float):
+        return self._zrangebyscore(name, min, max, start, num, withscores, score_cast_func, order="DESC")
+
+    def _zremrangebyscore(self, name, min, max):
+        key, cursor = self._score_range("DELETE", name, min, max)
+        self._remove_if_empty(key, "zset")
+        return cursor.rowcount
+
+    def _zremrangebyrank(self, name, min, max):
+        key, exists = self._check(name, "zset")
+        if not exists:
+            return 0
+        ranks = rank_slice(self._zcard(key), min, max)
+        cursor = self._query("DELETE FROM zsets WHERE key = ? AND member IN (SELECT member FROM zsets WHERE key = ? "
+                             "ORDER BY score, member LIMIT ? OFFSET ?)", key, key, ranks.stop - ranks.start,
+                             ranks.start)
+        self._remove_if_empty(key, "zset")
+        return cursor.rowcount
+
+    def _zscan(self, name, cursor=0, match=None, count=None, score_cast_func=float):
+        key, exists = self._check(name, "zset")
+        if not exists:
+            return 0, []
+        # members are scanned in member order, which a changing score doesn't affect
+        cursor = int(cursor)
+        count = count or 10
+        rows = self._query("SELECT score, member, CAST(member AS TEXT) GLOB ? FROM zsets WHERE key = ? "
+                           "ORDER BY member LIMIT ? OFFSET ?", to_key(match or "*"), key, count, cursor).fetchall()
+        items = [(score, member) for score, member, matches in rows if matches]
+        return cursor + count if len(rows) == count else 0, with_scores(items, True, score_cast_func)
+
+    # hashes
+
+    def _hget(self, name, field):
+        key, exists = self._check(name, "hash")
+        row = self._query("SELECT value FROM hashes WHERE key = ? AND field = ?", key, to_bytes(field)).fetchone()
+        return row[0] if row is not None else None
+
+    def _hset(self, name, field, value):
+        key, exists = self._check(name, "hash", create=True)
+        new = self._hget(key, field) is None
+        self._query("INSERT OR REPLACE INTO hashes (key, field, value) VALUES (?, ?, ?)", key, to_bytes(field),
+                    to_bytes(value))
+        return int(new)
+
+    def _hmset(self, name, mapping):
+        if not mapping:
+            raise DatabaseError("'hmset' with 'mapping' of length 0")
+        key, exists = self._check(name, "hash", create=True)
+        self.connection.executemany("INSERT OR REPLACE INTO hashes (key, field, value) VALUES (?, ?, ?)",
+                                    [(key, to_bytes(field), to_bytes(value)) for field, value in mapping.items()])
+        return True
+
+    def _hgetall(self, name):
+        key, exists = self._check(name, "hash")
+        return dict(self._query("SELECT field, value FROM hashes WHERE key = ?", key).fetchall())
+
+    def _hdel(self, name, *fields):
+        key, exists = self._check(name, "hash")
+        if not exists:
+            return 0
+        cursor = self.connection.executemany("DELETE FROM hashes WHERE key = ? AND field = ?",
+                                             [(key, to_bytes(field)) for field in fields])
+        self._remove_if_empty(key, "hash")
+        return cursor.rowcount
+
+    def _hscan(self, name, cursor=0, match=None, count=None):
+        key, exists = self._check(name, "hash")
+        if not exists:
+            return 0, {}
+        cursor = int(cursor)
+        count = count or 10
+        rows = self._query("SELECT field, value, CAST(field AS TEXT) GLOB ? FROM hashes WHERE key = ? "
+                           "ORDER BY field LIMIT ? OFFSET ?", to_key(match or "*"), key, count, cursor).fetchall()
+        return cursor + count if len(rows) == count else 0, {field: value for field, value, matches in rows if matches}
+
+    def _hincrby(self, name, field, amount=1):
+        try:
+            value = int(self._hget(name, field) or 0) + amount
+        except ValueError:
+            raise DatabaseError("hash value is not an integer") from None
+        self._hset(name, field, value)
+        return value
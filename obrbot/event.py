@@ -32,12 +32,13 @@ class Event:
     :type user: str
     :type host: str
     :type mask: str
+    :type trace: obrbot.tracing.Trace
     :param: channels: A list of channels which the event affects. Only used for events which affect multiple channels,
             such as NICK or QUIT events.
     """
 
     def __init__(self, *, bot=None, conn=None, event_type=EventType.other, content=None,
-                 target=None, channel_name=None, nick=None, user=None, host=None, mask=None):
+                 target=None, channel_name=None, nick=None, user=None, host=None, mask=None, trace=None):
         """
         All of these parameters except for `bot`  are optional.
         The irc_* parameters should only be specified for IRC events.
@@ -52,6 +53,7 @@ class Event:
         :param user: The user of the sender that triggered this event
         :param host: The host of the sender that triggered this event
         :param mask: The mask of the sender that triggered this event (nick!user@host)
+        :param trace: The trace recording this event's progress, if any
         :type bot: obrbot.bot.ObrBot
         :type conn: obrbot.connection.Connection
         :type content: str
@@ -61,6 +63,7 @@ class Event:
         :type user: str
         :type host: str
         :type mask: str
+        :type trace: obrbot.tracing.Trace
         """
         self.bot = bot
         self.conn = conn
@@ -72,6 +75,7 @@ class Event:
         self.user = user
         self.host = host
         self.mask = mask
+        self.trace = trace
         # channel and channels are assigned in Connection.pre_process_event
         self.channel = None
         self.channels = []
@@ -110,7 +114,7 @@ class Event:
             if self.chan_name is None:
                 raise ValueError("Target must be specified when chan is not assigned")
             target = self.chan_name
-        self.conn.message(target, *messages)
+        self.conn.message(target, *messages, trace=self.trace)
 
     def reply(self, *messages, target=None):
         """sends a message to the current channel/user with a prefix
@@ -126,9 +130,9 @@ class Event:
             return
 
         if target == self.nick:
-            self.conn.message(target, *messages)
+            self.conn.message(target, *messages, trace=self.trace)
         else:
-            self.conn.message(target, "({}) {}".format(self.nick, messages[0]), *messages[1:])
+            self.conn.message(target, "({}) {}".format(self.nick, messages[0]), *messages[1:], trace=self.trace)
 
     def action(self, message, target=None):
         """sends an action to the current channel/user or a specific channel/user
@@ -140,7 +144,7 @@ class Event:
                 raise ValueError("Target must be specified when chan is not assigned")
             target = self.chan_name
 
-        self.conn.action(target, message)
+        self.conn.action(target, message, trace=self.trace)
 
     def ctcp(self, message, ctcp_type, target=None):
         """sends an ctcp to the current channel/user or a specific channel/user
@@ -155,7 +159,7 @@ class Event:
         if not hasattr(self.conn, "ctcp"):
             raise ValueError("CTCP can only be used on IRC connections")
         # noinspection PyUnresolvedReferences
-        self.conn.ctcp(target, ctcp_type, message)
+        self.conn.ctcp(target, ctcp_type, message, trace=self.trace)
 
     def notice(self, message, target=None):
         """sends a notice to the current channel/user or a specific channel/user
@@ -167,7 +171,7 @@ class Event:
                 raise ValueError("Target must be specified when nick is not assigned")
             target = self.nick
 
-        self.conn.notice(target, message)
+        self.conn.notice(target, message, trace=self.trace)
 
     def has_permission(self, permission, notice=True):
         """ returns whether or not the current user has a given permission
@@ -180,6 +184,11 @@ class Event:
 
     @asyncio.coroutine
     def async(self, function, *args, **kwargs):
+        """
+        Runs a blocking function in an executor. Coroutine functions, such as the commands of bot.db, are run directly.
+        """
+        if asyncio.iscoroutinefunction(function):
+            return (yield from function(*args, **kwargs))
         return (yield from self.loop.run_in_executor(None, lambda: function(*args, **kwargs)))
 
 
@@ -192,8 +201,8 @@ class IrcEvent(Event):
     """
 
     def __init__(self, *, bot=None, conn=None, event_type=EventType.other, content=None,
-                 target=None, channel_name=None, nick=None, user=None, host=None, mask=None, irc_raw=None,
-                 irc_command=None, irc_command_params=None, irc_ctcp_text=None):
+                 target=None, channel_name=None, nick=None, user=None, host=None, mask=None, trace=None,
+                 irc_raw=None, irc_command=None, irc_command_params=None, irc_ctcp_text=None):
         """
         All of these parameters except for `bot`  are optional.
 
@@ -208,7 +217,7 @@ class IrcEvent(Event):
         :type irc_ctcp_text: str
         """
         super().__init__(bot=bot, conn=conn, event_type=event_type, content=content, target=target,
-                         channel_name=channel_name, nick=nick, user=user, host=host, mask=mask)
+                         channel_name=channel_name, nick=nick, user=user, host=host, mask=mask, trace=trace)
         # irc-specific parameters
         self.irc_raw = irc_raw
         self.irc_command = irc_command
@@ -249,7 +258,7 @@ class IrcEvent(Event):
             if self.chan_name is None:
                 raise ValueError("Target must be specified when chan is not assigned")
             target = self.chan_name
-        self.conn.message(target, *messages)
+        self.conn.message(target, *messages, trace=self.trace)
 
     def reply(self, *messages, target=None):
         """sends a message to the current channel/user with a prefix
@@ -265,9 +274,9 @@ class IrcEvent(Event):
             return
 
         if target == self.nick:
-            self.conn.message(target, *messages)
+            self.conn.message(target, *messages, trace=self.trace)
         else:
-            self.conn.message(target, "({}) {}".format(self.nick, messages[0]), *messages[1:])
+            self.conn.message(target, "({}) {}".format(self.nick, messages[0]), *messages[1:], trace=self.trace)
 
     def action(self, message, target=None):
         """sends an action to the current channel/user or a specific channel/user
@@ -279,7 +288,7 @@ class IrcEvent(Event):
                 raise ValueError("Target must be specified when chan is not assigned")
             target = self.chan_name
 
-        self.conn.action(target, message)
+        self.conn.action(target, message, trace=self.trace)
 
     def ctcp(self, message, ctcp_type, target=None):
         """sends an ctcp to the current channel/user or a specific channel/user
@@ -294,7 +303,7 @@ class IrcEvent(Event):
         if not hasattr(self.conn, "ctcp"):
             raise ValueError("CTCP can only be used on IRC connections")
         # noinspection PyUnresolvedReferences
-        self.conn.ctcp(target, ctcp_type, message)
+        self.conn.ctcp(target, ctcp_type, message, trace=self.trace)
 
     def notice(self, message, target=None):
         """sends a notice to the current channel/user or a specific channel/user
@@ -306,7 +315,7 @@ class IrcEvent(Event):
                 raise ValueError("Target must be specified when nick is not assigned")
             target = self.nick
 
-        self.conn.notice(target, message)
+        self.conn.notice(target, message, trace=self.trace)
 
     def has_permission(self, permission, notice=True):
         """ returns whether or not the current user has a given permission
@@ -319,6 +328,11 @@ class IrcEvent(Event):
 
     @asyncio.coroutine
     def async(self, function, *args, **kwargs):
+        """
+        Runs a blocking function in an executor. Coroutine functions, such as the commands of bot.db, are run directly.
+        """
+        if asyncio.iscoroutinefunction(function):
+            return (yield from function(*args, **kwargs))
         return (yield from self.loop.run_in_executor(None, lambda: function(*args, **kwargs)))
 
 
@@ -0,0 +1,55 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger("obrbot")
+
+# the environment variable connections are handed to the restarted bot in
+HANDOVER_ENV = "OBRBOT_HANDOVER"
+
+
+def export_handover(states):
+    """
+    Puts the state of connections being handed over into the environment, for the process we're about to exec. The
+    sockets themselves are passed as inheritable file descriptors, which are named in each state.
+    :param states: The state of each connection handed over, by connection name
+    :type states: dict[str, dict]
+    """
+    os.environ[HANDOVER_ENV] = json.dumps(states, separators=(",", ":"))
+
+
+def take_handover():
+    """
+    Reads the connections handed over by the process we were restarted from, removing them from the environment so
+    they aren't handed over again by mistake. File descriptors which aren't open are left out.
+    :return: The state of each connection handed over, by connection name
+    :rtype: dict[str, dict]
+    """
+    data = os.environ.pop(HANDOVER_ENV, None)
+    if not data:
+        return {}
+    try:
+        states = json.loads(data)
+    except ValueError:
+        logger.warning("Ignoring unreadable connection handover")
+        return {}
+    handed_over = {}
+    for name, state in states.items():
+        try:
+            os.fstat(state["fd"])
+        except (KeyError, TypeError, OSError):
+            logger.warning("[{}] Handed over socket isn't open, will reconnect instead".format(name))
+            continue
+        handed_over[name] = state
+    return handed_over
+
+
+def close_handover(state):
+    """
+    Closes the socket of a connection which was handed over, but won't be adopted
+    :type state: dict
+    """
+    try:
+        os.close(state["fd"])
+    except OSError:
+        pass
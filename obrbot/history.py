@@ -0,0 +1,903 @@
+import asyncio
+from collections import OrderedDict, deque
+import itertools
+import logging
+import re
+import time
+
+from obrbot.event import EventType
+from obrbot.metrics import Histogram
+from obrbot.database import DatabaseError
+from obrbot.seen import trim_sightings
+
+logger = logging.getLogger("obrbot")
+
+history_key = "obrbot:connections:{}:channels:{}:history"
+history_key_re = re.compile(r"^obrbot:connections:(.+?):channels:(.+):history(?:_stream)?$")
+history_stream_key = "obrbot:connections:{}:channels:{}:history_stream"
+
+# The first byte of a compact record. Legacy records start with an event type name, so never start with this.
+RECORD_VERSION = 1
+
+# Record sequence ids start from the time in microseconds, so they keep increasing across restarts
+_sequence = itertools.count(int(time.time() * 1000000))
+
+
+def next_sequence():
+    """
+    :rtype: int
+    """
+    return next(_sequence)
+
+
+def _write_varint(out, value):
+    """
+    :type out: bytearray
+    :type value: int
+    """
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, position):
+    """
+    :type data: bytes
+    :type position: int
+    :return: The value, and the position after it
+    :rtype: (int, int)
+    """
+    result = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, position
+        shift += 7
+
+
+def encode_record(sequence, event_type, fields):
+    """
+    Encodes a history record as: the version byte, the sequence id and event type value as varints, then each field as
+    a varint length followed by its UTF-8 bytes. The sequence id makes every record unique, so identical messages
+    aren't collapsed into one sorted set member.
+    :type sequence: int
+    :type event_type: EventType
+    :type fields: collections.Iterable[str]
+    :rtype: bytes
+    """
+    out = bytearray((RECORD_VERSION,))
+    _write_varint(out, sequence)
+    _write_varint(out, event_type.value)
+    for field in fields:
+        data = field.encode("utf-8")
+        _write_varint(out, len(data))
+        out += data
+    return bytes(out)
+
+
+def decode_record(data):
+    """
+    Decodes a history record in either the compact format, or the legacy "type\nfield\nfield" format
+    :type data: bytes
+    :return: The sequence id (None for legacy records), event type, and fields
+    :rtype: (int, EventType, tuple[str])
+    """
+    if data[:1] != b"\x01":
+        split = data.decode("utf-8", "replace").split("\n")
+        try:
+            event_type = getattr(EventType, split[0])
+        except AttributeError:
+            event_type = EventType.other
+        return None, event_type, tuple(split[1:])
+
+    sequence, position = _read_varint(data, 1)
+    type_value, position = _read_varint(data, position)
+    try:
+        event_type = EventType(type_value)
+    except ValueError:
+        event_type = EventType.other
+    fields = []
+    end = len(data)
+    while position < end:
+        length, position = _read_varint(data, position)
+        fields.append(data[position:position + length].decode("utf-8", "replace"))
+        position += length
+    return sequence, event_type, tuple(fields)
+
+
+def parse_history_key(key):
+    """
+    Returns the connection and channel names from a history key, or None if it isn't a history key
+    :type key: str | bytes
+    :rtype: (str, str) | None
+    """
+    if isinstance(key, bytes):
+        key = key.decode("utf-8", "replace")
+    match = history_key_re.match(key)
+    if match is None:
+        return None
+    return match.group(1), match.group(2)
+
+
+class ZSetHistoryBackend:
+    """
+    Stores each channel's history in a sorted set, with records as members and timestamps as scores.
+
+    :type db: obrbot.database.Database
+    """
+    name = "zset"
+
+    def __init__(self, db):
+        """
+        :type db: obrbot.database.Database
+        """
+        self.db = db
+
+    def key(self, connection, channel):
+        """
+        :type connection: str
+        :type channel: str
+        :rtype: str
+        """
+        return history_key.format(connection.lower(), channel.lower())
+
+    def queue_writes(self, pipeline, key, entries):
+        """
+        Adds commands writing the given entries to a pipeline
+        :type pipeline: obrbot.database.redis.Pipeline | obrbot.database.base.LocalPipeline
+        :type key: str
+        :param entries: Alternating timestamps and encoded records
+        :type entries: list[float | bytes]
+        """
+        pipeline.zadd(key, *entries)
+
+    @asyncio.coroutine
+    def read(self, key, min_time, max_time=None):
+        """
+        Reads the records with timestamps between min_time and max_time, inclusive, oldest first
+        :type key: str
+        :type min_time: float
+        :type max_time: float
+        :rtype: list[(bytes, float)]
+        """
+        return (yield from self.db.zrangebyscore(key, min_time, "+inf" if max_time is None else max_time,
+                                                 withscores=True))
+
+    @asyncio.coroutine
+    def read_page(self, key, position, count, *, min_time=None, max_time=None, reverse=False):
+        """
+        Reads up to `count` records after `position`. Positions are (score, number of records with that score
+        already read), so pages never skip or repeat records which share a timestamp.
+        :type key: str
+        :param position: The position returned with the previous page, or None to start from the beginning
+        :type position: (float, int)
+        :type count: int
+        :type min_time: float
+        :type max_time: float
+        :type reverse: bool
+        :return: The records and their timestamps, and the position to read the next page from, or None if there are
+                    no more records
+        :rtype: (list[(bytes, float)], (float, int))
+        """
+        low = "-inf" if min_time is None else min_time
+        high = "+inf" if max_time is None else max_time
+        if position is None:
+            bound, skip = (high if reverse else low), 0
+        else:
+            bound, skip = position
+
+        if reverse:
+            entries = yield from self.db.zrevrangebyscore(key, bound, low, start=skip, num=count, withscores=True)
+        else:
+            entries = yield from self.db.zrangebyscore(key, bound, high, start=skip, num=count, withscores=True)
+        if len(entries) < count:
+            return entries, None
+
+        last_score = entries[-1][1]
+        ties = 0
+        for member, score in reversed(entries):
+            if score != last_score:
+                break
+            ties += 1
+        if position is not None and last_score == bound:
+            ties += skip
+        return entries, (last_score, ties)
+
+
+class StreamHistoryBackend:
+    """
+    Stores each channel's history in a redis stream, capped at roughly `maxlen` entries with XADD MAXLEN ~. Each
+    entry holds the encoded record and its timestamp. Entry ids are assigned by redis when the entry is written, which
+    is never before the event happened, so reads use XRANGE starting from an id derived from min_time, then filter on
+    the stored timestamps. Requires redis 5.0+.
+
+    :type db: obrbot.database.Database
+    :type maxlen: int
+    """
+    name = "stream"
+    # entries are read this many seconds past max_time, in case they were written late
+    max_write_delay = 60
+
+    def __init__(self, db, maxlen=10000):
+        """
+        :type db: obrbot.database.Database
+        :type maxlen: int
+        """
+        self.db = db
+        self.maxlen = maxlen
+
+    def key(self, connection, channel):
+        """
+        :type connection: str
+        :type channel: str
+        :rtype: str
+        """
+        return history_stream_key.format(connection.lower(), channel.lower())
+
+    def queue_writes(self, pipeline, key, entries):
+        """
+        Adds commands writing the given entries to a pipeline
+        :type pipeline: obrbot.database.redis.Pipeline | obrbot.database.base.LocalPipeline
+        :type key: str
+        :param entries: Alternating timestamps and encoded records
+        :type entries: list[float | bytes]
+        """
+        for index in range(0, len(entries), 2):
+            fields = OrderedDict((("r", entries[index + 1]), ("t", repr(entries[index]))))
+            pipeline.xadd(key, fields, maxlen=self.maxlen or None)
+
+    @asyncio.coroutine
+    def read(self, key, min_time, max_time=None):
+        """
+        Reads the records with timestamps between min_time and max_time, inclusive, oldest first
+        :type key: str
+        :type min_time: float
+        :type max_time: float
+        :rtype: list[(bytes, float)]
+        """
+        entries = yield from self.db.xrange(key, min=int(min_time * 1000))
+        return self._filter(entries, min_time, max_time)
+
+    @asyncio.coroutine
+    def read_page(self, key, position, count, *, min_time=None, max_time=None, reverse=False):
+        """
+        Reads up to `count` entries after `position`, which is the id of the last entry read. Fewer than `count`
+        records may be returned even when there are more to read, as entries written shortly after min_time or
+        max_time may be for events outside of them.
+        :type key: str
+        :param position: The position returned with the previous page, or None to start from the beginning
+        :type position: bytes
+        :type count: int
+        :type min_time: float
+        :type max_time: float
+        :type reverse: bool
+        :return: The records and their timestamps, and the position to read the next page from, or None if there are
+                    no more records
+        :rtype: (list[(bytes, float)], bytes)
+        """
+        low = "-" if min_time is None else int(min_time * 1000)
+        high = "+" if max_time is None else int((max_time + self.max_write_delay) * 1000)
+        if reverse:
+            if position is not None:
+                high = _previous_stream_id(position)
+            entries = yield from self.db.xrevrange(key, high, low, count=count)
+        else:
+            if position is not None:
+                low = _next_stream_id(position)
+            entries = yield from self.db.xrange(key, low, high, count=count)
+
+        records = self._filter(entries, min_time, max_time)
+        if len(entries) < count:
+            return records, None
+        return records, entries[-1][0]
+
+    @staticmethod
+    def _filter(entries, min_time, max_time):
+        """
+        :type entries: list[(bytes, dict[bytes, bytes])]
+        :type min_time: float
+        :type max_time: float
+        :rtype: list[(bytes, float)]
+        """
+        result = []
+        for entry_id, fields in entries:
+            timestamp = float(fields[b"t"])
+            if (min_time is None or timestamp >= min_time) and (max_time is None or timestamp <= max_time):
+                result.append((fields[b"r"], timestamp))
+        return result
+
+
+def _next_stream_id(entry_id):
+    """
+    :type entry_id: bytes
+    :rtype: str
+    """
+    milliseconds, sequence = entry_id.decode().split("-")
+    return "{}-{}".format(milliseconds, int(sequence) + 1)
+
+
+def _previous_stream_id(entry_id):
+    """
+    :type entry_id: bytes
+    :rtype: str
+    """
+    milliseconds, sequence = (int(part) for part in entry_id.decode().split("-"))
+    if sequence:
+        return "{}-{}".format(milliseconds, sequence - 1)
+    return "{}-{}".format(milliseconds - 1, 2 ** 64 - 1)
+
+
+history_backends = {
+    ZSetHistoryBackend.name: ZSetHistoryBackend,
+    StreamHistoryBackend.name: StreamHistoryBackend,
+}
+
+
+def create_history_backend(db, db_config):
+    """
+    Creates the history backend named by the "history_backend" key of the database config
+    :type db: obrbot.database.Database
+    :type db_config: dict
+    :rtype: ZSetHistoryBackend | StreamHistoryBackend
+    """
+    name = db_config.get("history_backend", ZSetHistoryBackend.name)
+    if name == StreamHistoryBackend.name:
+        if db.supports_streams:
+            return StreamHistoryBackend(db, maxlen=db_config.get("history_stream_maxlen", 10000))
+        logger.warning("The {} database doesn't support streams. Using the '{}' history backend.".format(
+            db.name, ZSetHistoryBackend.name))
+    elif name != ZSetHistoryBackend.name:
+        logger.warning("Unknown history backend '{}', valid backends are: {}. Using '{}'.".format(
+            name, ", ".join(history_backends), ZSetHistoryBackend.name))
+    return ZSetHistoryBackend(db)
+
+
+class HistoryCursor:
+    """
+    Reads a channel's history a page at a time, so it can be gone through in constant memory. Records are decoded as
+    they are read.
+
+    Records are (timestamp, EventType, field, ...), oldest first unless `reverse` is True. `next()` returns one record
+    at a time, and `fetch_page()` returns a whole page. On python 3.5+, cursors can also be used with `async for`.
+
+    The `position` after any page can be passed to a new cursor to carry on from there.
+
+    :type backend: ZSetHistoryBackend | StreamHistoryBackend
+    :type key: str
+    :type min_time: float
+    :type max_time: float
+    :type reverse: bool
+    :type limit: int
+    :type page_size: int
+    :type position: (float, int) | bytes
+    :type exhausted: bool
+    """
+
+    def __init__(self, backend, key, *, min_time=None, max_time=None, reverse=False, limit=None, offset=0,
+                 page_size=100, position=None, writer=None):
+        """
+        :param min_time: Timestamp of the oldest records to read, or None to read from the start
+        :param max_time: Timestamp of the newest records to read, or None to read to the end
+        :param reverse: Whether to read the newest records first
+        :param limit: Maximum number of records to read, or None to read them all
+        :param offset: Number of records to skip
+        :param page_size: Number of records to request at once
+        :param position: A position from a previous cursor with the same key and bounds, to carry on from
+        :param writer: A HistoryWriter to flush before reading, so that buffered records are included
+        :type backend: ZSetHistoryBackend | StreamHistoryBackend
+        :type key: str
+        :type min_time: float
+        :type max_time: float
+        :type reverse: bool
+        :type limit: int
+        :type offset: int
+        :type page_size: int
+        :type position: (float, int) | bytes
+        :type writer: HistoryWriter
+        """
+        self.backend = backend
+        self.key = key
+        self.min_time = min_time
+        self.max_time = max_time
+        self.reverse = reverse
+        self.limit = limit
+        self.page_size = max(page_size, 1)
+        self.position = position
+        self.exhausted = limit is not None and limit <= 0
+
+        self._skip = offset
+        self._writer = writer
+        self._page = deque()
+
+    @asyncio.coroutine
+    def _read_raw_page(self):
+        """
+        :rtype: list[(bytes, float)]
+        """
+        if self._writer is not None:
+            yield from self._writer.flush()
+            self._writer = None
+
+        while not self.exhausted:
+            records, self.position = yield from self.backend.read_page(
+                self.key, self.position, self.page_size, min_time=self.min_time, max_time=self.max_time,
+                reverse=self.reverse)
+            if self.position is None:
+                self.exhausted = True
+            if self._skip:
+                skipped = min(self._skip, len(records))
+                records = records[skipped:]
+                self._skip -= skipped
+            if self.limit is not None:
+                records = records[:self.limit]
+                self.limit -= len(records)
+                if self.limit <= 0:
+                    self.exhausted = True
+            if records:
+                return records
+        return []
+
+    @asyncio.coroutine
+    def fetch_page(self):
+        """
+        Returns the next page of records, or an empty list when there are none left. Records already returned by
+        `next()` aren't included.
+        :rtype: list[tuple]
+        """
+        if self._page:
+            page, self._page = self._page, deque()
+        else:
+            page = yield from self._read_raw_page()
+        return [decode_entry(member, timestamp) for member, timestamp in page]
+
+    @asyncio.coroutine
+    def next(self):
+        """
+        Returns the next record, or None when there are none left
+        :rtype: tuple
+        """
+        if not self._page:
+            self._page.extend((yield from self._read_raw_page()))
+            if not self._page:
+                return None
+        return decode_entry(*self._page.popleft())
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        # only used by `async for`, so StopAsyncIteration always exists when this runs
+        entry = yield from self.next()
+        if entry is None:
+            raise StopAsyncIteration
+        return entry
+
+
+def decode_entry(member, timestamp):
+    """
+    :type member: bytes
+    :type timestamp: float
+    :rtype: tuple
+    """
+    sequence, event_type, fields = decode_record(member)
+    return (timestamp, event_type) + fields
+
+
+class HistoryWriter:
+    """
+    Buffers channel history entries for a connection, and writes them in batches, with all of a batch's writes sent
+    in a single pipeline. A batch is written `interval` seconds after the first entry is buffered, or as soon as
+    `max_entries` are buffered, whichever happens first.
+
+    :type backend: ZSetHistoryBackend | StreamHistoryBackend
+    :type loop: asyncio.events.AbstractEventLoop
+    :type interval: float
+    :type max_entries: int
+    :type max_buffered: int
+    :type flushes: int
+    :type entries_written: int
+    :type max_flush_size: int
+    :type errors: int
+    :type dropped: int
+    :type flush_time: Histogram
+    """
+
+    def __init__(self, backend, loop, *, interval=0.1, max_entries=500, retry_interval=5, max_buffered=50000):
+        """
+        :param interval: Seconds to wait after an entry is buffered before writing it
+        :param max_entries: Number of buffered entries which will cause a write immediately
+        :param retry_interval: Seconds to wait before retrying a failed write
+        :param max_buffered: Number of entries to keep buffered while writes are failing, before dropping the oldest
+        :type backend: ZSetHistoryBackend | StreamHistoryBackend
+        :type loop: asyncio.events.AbstractEventLoop
+        :type interval: float
+        :type max_entries: int
+        :type retry_interval: float
+        :type max_buffered: int
+        """
+        self.backend = backend
+        self.loop = loop
+        self.interval = interval
+        self.max_entries = max_entries
+        self.retry_interval = retry_interval
+        self.max_buffered = max_buffered
+
+        # key -> list of timestamp, record pairs, in the order they were added
+        self._pending = OrderedDict()
+        self._buffered = 0
+        self._timer = None
+        # whether the last write failed, in which case only the retry timer will write
+        self._failing = False
+        self._flush_lock = asyncio.Lock(loop=loop)
+
+        self.flushes = 0
+        self.entries_written = 0
+        self.max_flush_size = 0
+        self.errors = 0
+        self.dropped = 0
+        self.flush_time = Histogram()
+
+    @property
+    def buffered(self):
+        """
+        The number of entries waiting to be written
+        :rtype: int
+        """
+        return self._buffered
+
+    def add(self, key, member, score):
+        """
+        Buffers an entry to be written to `key`
+        :type key: str
+        :type member: bytes
+        :type score: float
+        """
+        entries = self._pending.get(key)
+        if entries is None:
+            entries = []
+            self._pending[key] = entries
+        entries.append(score)
+        entries.append(member)
+        self._buffered += 1
+
+        if self._buffered >= self.max_entries and not self._failing:
+            self._flush_soon()
+        elif self._timer is None:
+            self._timer = self.loop.call_later(self.interval, self._flush_soon)
+
+    def _flush_soon(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        asyncio.async(self.flush(), loop=self.loop)
+
+    @asyncio.coroutine
+    def flush(self):
+        """
+        Writes all buffered entries. Waits for any write already in progress first, so once this returns, everything
+        added before it was called has been written.
+        """
+        with (yield from self._flush_lock):
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._pending:
+                return
+
+            pending, self._pending = self._pending, OrderedDict()
+            count, self._buffered = self._buffered, 0
+
+            pipeline = self.backend.db.pipeline(transaction=False)
+            for key, entries in pending.items():
+                self.backend.queue_writes(pipeline, key, entries)
+
+            start = time.perf_counter()
+            try:
+                yield from pipeline.execute()
+            except (DatabaseError, ConnectionError, OSError) as e:
+                self.errors += 1
+                self._failing = True
+                logger.warning("Couldn't write {} history entries, will retry: {}".format(count, e))
+                self._requeue(pending, count)
+                return
+            finally:
+                self.flush_time.record(time.perf_counter() - start)
+
+            self._failing = False
+            self.flushes += 1
+            self.entries_written += count
+            self.max_flush_size = max(self.max_flush_size, count)
+
+    def _requeue(self, pending, count):
+        """
+        Puts entries from a failed write back in front of anything buffered since, dropping the oldest entries if
+        there are more than max_buffered
+        :type pending: OrderedDict[str, list]
+        :type count: int
+        """
+        for key, entries in self._pending.items():
+            if key in pending:
+                pending[key].extend(entries)
+            else:
+                pending[key] = entries
+        self._pending = pending
+        self._buffered += count
+
+        while self._buffered > self.max_buffered and self._pending:
+            key, entries = next(iter(self._pending.items()))
+            excess = min(self._buffered - self.max_buffered, len(entries) // 2)
+            del entries[:excess * 2]
+            if not entries:
+                del self._pending[key]
+            self._buffered -= excess
+            self.dropped += excess
+
+        if self._pending and self._timer is None:
+            self._timer = self.loop.call_later(self.retry_interval, self._flush_soon)
+
+    @asyncio.coroutine
+    def close(self):
+        """
+        Writes everything still buffered
+        """
+        yield from self.flush()
+
+
+class HistoryCompactor:
+    """
+    Periodically trims channel history to its retention limits. Keys are found incrementally with SCAN, and entries
+    are removed at most `batch_size` at a time, so no single command keeps redis busy for long.
+
+    Limits can be set globally, and overridden per channel with keys in the form "connection:#channel". Only sorted
+    set history is compacted, history in streams is capped by XADD MAXLEN instead. Each run also removes sightings
+    older than `seen_max_age` from the seen hashes.
+
+    :type db: obrbot.database.Database
+    :type loop: asyncio.events.AbstractEventLoop
+    :type interval: float
+    :type scan_count: int
+    :type batch_size: int
+    :type max_age: float
+    :type max_entries: int
+    :type channels: dict[str, dict[str, float | int]]
+    :type search_index: obrbot.search.SearchIndex
+    :type seen_max_age: float
+    :type runs: int
+    :type keys_scanned: int
+    :type removed: int
+    :type last_removed: int
+    :type last_duration: float
+    :type sightings_removed: int
+    """
+
+    def __init__(self, db, loop, *, interval=600, scan_count=100, batch_size=1000, max_age=0, max_entries=0,
+                 channels=None, search_index=None, seen_max_age=0):
+        """
+        :param interval: Seconds between compaction runs, or 0 to disable compaction
+        :param scan_count: COUNT hint given to each SCAN
+        :param batch_size: Maximum number of entries to remove with a single command
+        :param max_age: Seconds to keep history for, or 0 to keep it regardless of age
+        :param max_entries: Number of entries to keep per channel, or 0 for no limit
+        :param channels: Limits for specific channels, overriding max_age and max_entries
+        :param search_index: A search index whose postings are trimmed along with the history they point to
+        :param seen_max_age: Seconds to keep each nick's and mask's last activity for, or 0 to keep it regardless of age
+        :type db: obrbot.database.Database
+        :type loop: asyncio.events.AbstractEventLoop
+        :type interval: float
+        :type scan_count: int
+        :type batch_size: int
+        :type max_age: float
+        :type max_entries: int
+        :type channels: dict[str, dict[str, float | int]]
+        :type search_index: obrbot.search.SearchIndex
+        :type seen_max_age: float
+        """
+        self.db = db
+        self.loop = loop
+        self.interval = interval
+        self.scan_count = scan_count
+        self.batch_size = max(batch_size, 1)
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.channels = {name.lower(): limits for name, limits in (channels or {}).items()}
+        self.search_index = search_index
+        self.seen_max_age = seen_max_age
+
+        self._handle = None
+        self._task = None
+
+        self.runs = 0
+        self.keys_scanned = 0
+        self.removed = 0
+        self.last_removed = 0
+        self.last_duration = 0.0
+        self.sightings_removed = 0
+
+    @property
+    def enabled(self):
+        return bool(self.interval)
+
+    def retention_for(self, connection, channel):
+        """
+        Returns the maximum age and number of entries to keep for a channel. 0 means no limit.
+        :type connection: str
+        :type channel: str
+        :rtype: (float, int)
+        """
+        limits = self.channels.get("{}:{}".format(connection, channel).lower())
+        if limits is None:
+            return self.max_age, self.max_entries
+        return limits.get("max_age", self.max_age), limits.get("max_entries", self.max_entries)
+
+    def start(self):
+        if self.enabled and self._handle is None:
+            self._handle = self.loop.call_later(self.interval, self._run)
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _run(self):
+        self._task = asyncio.async(self.compact(), loop=self.loop)
+        self._task.add_done_callback(self._finished)
+
+    def _finished(self, task):
+        """
+        :type task: asyncio.Task
+        """
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            logger.error("Error compacting history", exc_info=task.exception())
+        self._task = None
+        if self._handle is not None:
+            self._handle = self.loop.call_later(self.interval, self._run)
+
+    @asyncio.coroutine
+    def compact(self):
+        """
+        Trims every channel's history to its limits
+        :return: The number of entries removed
+        :rtype: int
+        """
+        start = time.perf_counter()
+        removed = 0
+        cursor = 0
+        pattern = history_key.format("*", "*")
+        while True:
+            cursor, keys = yield from self.db.scan(cursor, match=pattern, count=self.scan_count)
+            for key in keys:
+                self.keys_scanned += 1
+                removed += yield from self.compact_key(key)
+            if cursor == 0:
+                break
+        if self.search_index is not None and self.search_index.enabled:
+            yield from self.search_index.compact(self)
+        if self.seen_max_age:
+            self.sightings_removed += yield from trim_sightings(self.db, self.seen_max_age, scan_count=self.scan_count,
+                                                                batch_size=self.batch_size)
+
+        self.runs += 1
+        self.removed += removed
+        self.last_removed = removed
+        self.last_duration = time.perf_counter() - start
+        if removed:
+            logger.info("Removed {} old history entries in {:.2f}s".format(removed, self.last_duration))
+        return removed
+
+    @asyncio.coroutine
+    def compact_key(self, key):
+        """
+        Trims a single history key to its limits
+        :type key: str | bytes
+        :return: The number of entries removed
+        :rtype: int
+        """
+        names = parse_history_key(key)
+        if names is None:
+            return 0
+        max_age, max_entries = self.retention_for(*names)
+        removed = 0
+
+        if max_age:
+            removed += yield from remove_before(self.db, key, time.time() - max_age, batch_size=self.batch_size)
+
+        if max_entries:
+            excess = (yield from self.db.zcard(key)) - max_entries
+            while excess > 0:
+                count = min(excess, self.batch_size)
+                removed += yield from self.db.zremrangebyrank(key, 0, count - 1)
+                excess -= count
+
+        return removed
+
+
+@asyncio.coroutine
+def remove_before(db, key, cutoff, *, batch_size=1000):
+    """
+    Removes every entry of a sorted set with a score lower than `cutoff`, at most `batch_size` at a time
+    :type db: obrbot.database.Database
+    :type key: str | bytes
+    :type cutoff: float
+    :type batch_size: int
+    :return: The number of entries removed
+    :rtype: int
+    """
+    removed = 0
+    cutoff = "({!r}".format(cutoff)
+    while True:
+        # find the score of the batch_size'th oldest expired entry, so each removal is bounded
+        boundary = yield from db.zrangebyscore(key, "-inf", cutoff, start=batch_size - 1, num=1, withscores=True)
+        if not boundary:
+            removed += yield from db.zremrangebyscore(key, "-inf", cutoff)
+            return removed
+        removed += yield from db.zremrangebyscore(key, "-inf", boundary[0][1])
+
+
+@asyncio.coroutine
+def migrate_history_key(db, key, *, batch_size=500):
+    """
+    Converts every legacy record in a history key to the compact format, keeping its score. Records are converted in
+    batches with ZSCAN, each batch replaced atomically.
+    :type db: obrbot.database.Database
+    :type key: str | bytes
+    :type batch_size: int
+    :return: The number of records converted
+    :rtype: int
+    """
+    converted = 0
+    cursor = 0
+    while True:
+        cursor, entries = yield from db.zscan(key, cursor, count=batch_size)
+        legacy = [(member, score) for member, score in entries if member[:1] != b"\x01"]
+        if legacy:
+            pipeline = db.pipeline()
+            pipeline.zrem(key, *(member for member, score in legacy))
+            new_entries = []
+            for member, score in legacy:
+                sequence, event_type, fields = decode_record(member)
+                new_entries.append(score)
+                new_entries.append(encode_record(next_sequence(), event_type, fields))
+            pipeline.zadd(key, *new_entries)
+            yield from pipeline.execute()
+            converted += len(legacy)
+        if cursor == 0:
+            return converted
+
+
+@asyncio.coroutine
+def migrate_history(db, *, scan_count=100, batch_size=500):
+    """
+    Converts every legacy history record to the compact format. Safe to run while the bot is writing history, and to
+    run more than once.
+    :type db: obrbot.database.Database
+    :type scan_count: int
+    :type batch_size: int
+    :return: The number of keys and records converted
+    :rtype: (int, int)
+    """
+    keys_converted = 0
+    records_converted = 0
+    cursor = 0
+    pattern = history_key.format("*", "*")
+    while True:
+        cursor, keys = yield from db.scan(cursor, match=pattern, count=scan_count)
+        for key in keys:
+            converted = yield from migrate_history_key(db, key, batch_size=batch_size)
+            if converted:
+                keys_converted += 1
+                records_converted += converted
+        if cursor == 0:
+            break
+    logger.info("Converted {} history records in {} keys to the compact format".format(records_converted,
+                                                                                      keys_converted))
+    return keys_converted, records_converted
@@ -0,0 +1,414 @@
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import threading
+import time
+
+# Values are recorded in microseconds, with 2^_sub_bucket_bits buckets per power of two (~3% relative precision)
+_unit = 1e-6
+_sub_bucket_bits = 6
+
+# Hook outcomes
+OUTCOME_SUCCESS = "success"
+OUTCOME_ERROR = "error"
+OUTCOME_BLOCKED = "blocked"
+OUTCOME_HELP = "help"
+
+# Keys that HookMetrics.top() can sort by
+sort_keys = ("p50", "p99", "max", "mean", "calls", "errors")
+
+
+def _bucket_index(ticks):
+    """
+    :type ticks: int
+    :rtype: int
+    """
+    shift = ticks.bit_length() - _sub_bucket_bits
+    if shift <= 0:
+        return ticks
+    return (shift << (_sub_bucket_bits - 1)) + (ticks >> shift)
+
+
+def _bucket_upper_bound(index):
+    """
+    Returns the highest value (in ticks) that would be stored in the bucket at the given index
+    :type index: int
+    :rtype: int
+    """
+    if index < (1 << _sub_bucket_bits):
+        return index
+    shift = (index >> (_sub_bucket_bits - 1)) - 1
+    mantissa = index - (shift << (_sub_bucket_bits - 1))
+    return ((mantissa + 1) << shift) - 1
+
+
+def format_duration(seconds):
+    """
+    :type seconds: float
+    :rtype: str
+    """
+    if seconds >= 1:
+        return "{:.2f}s".format(seconds)
+    elif seconds >= 0.001:
+        return "{:.1f}ms".format(seconds * 1000)
+    else:
+        return "{:.0f}us".format(seconds * 1000000)
+
+
+class Histogram:
+    """
+    A log-linear bucketed histogram of durations, in the style of HdrHistogram.
+
+    Recording is O(1) and memory is bounded by the value range rather than the number of values recorded, so these
+    can be kept for every hook for the whole lifetime of the bot.
+
+    :type count: int
+    :type total: float
+    :type min: float
+    :type max: float
+    """
+    __slots__ = ['_counts', 'count', 'total', 'min', 'max']
+
+    def __init__(self):
+        self._counts = []
+        self.count = 0
+        self.total = 0.0
+        self.min = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        """
+        Records a single duration, in seconds
+        :type value: float
+        """
+        if value < 0:
+            value = 0.0
+        index = _bucket_index(int(value / _unit))
+        counts = self._counts
+        if index >= len(counts):
+            counts.extend([0] * (index + 1 - len(counts)))
+        counts[index] += 1
+
+        if self.count == 0 or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.count += 1
+        self.total += value
+
+    @property
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+    def percentile(self, percent):
+        """
+        Returns the value at the given percentile, accurate to the precision of the bucket it's found in
+        :type percent: float
+        :rtype: float
+        """
+        if not self.count:
+            return 0.0
+        rank = max(1, int(round(self.count * percent / 100.0)))
+        seen = 0
+        for index, bucket_count in enumerate(self._counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(_bucket_upper_bound(index) * _unit, self.max)
+        return self.max
+
+    def count_at_or_below(self, value):
+        """
+        Returns how many recorded values were at or below the given value, to the precision of the buckets
+        :type value: float
+        :rtype: int
+        """
+        if value >= self.max:
+            return self.count
+        limit = int(value / _unit)
+        seen = 0
+        for index, bucket_count in enumerate(self._counts):
+            if _bucket_upper_bound(index) > limit:
+                break
+            seen += bucket_count
+        return seen
+
+    def buckets(self):
+        """
+        Yields (upper_bound, cumulative_count) for each non-empty bucket, in increasing order
+        :rtype: collections.Iterable[(float, int)]
+        """
+        seen = 0
+        for index, bucket_count in enumerate(self._counts):
+            if bucket_count:
+                seen += bucket_count
+                yield (_bucket_upper_bound(index) + 1) * _unit, seen
+
+    def merge(self, other):
+        """
+        Adds all values recorded in another histogram to this one
+        :type other: Histogram
+        """
+        if not other.count:
+            return
+        counts = self._counts
+        if len(other._counts) > len(counts):
+            counts.extend([0] * (len(other._counts) - len(counts)))
+        for index, bucket_count in enumerate(other._counts):
+            counts[index] += bucket_count
+        if self.count == 0 or other.min < self.min:
+            self.min = other.min
+        if other.max > self.max:
+            self.max = other.max
+        self.count += other.count
+        self.total += other.total
+
+    def reset(self):
+        self._counts = []
+        self.count = 0
+        self.total = 0.0
+        self.min = 0.0
+        self.max = 0.0
+
+
+class HookStats:
+    """
+    Counters and latency histograms for a single hook.
+
+    :type description: str
+    :type created: float
+    :type outcomes: collections.Counter
+    :type wall_time: Histogram
+    :type wait_time: Histogram
+    :type sieve_time: Histogram
+    """
+    __slots__ = ['description', 'created', 'outcomes', 'wall_time', 'wait_time', 'sieve_time']
+
+    def __init__(self, description):
+        """
+        :type description: str
+        """
+        self.description = description
+        self.created = time.monotonic()
+        self.outcomes = collections.Counter()
+        # time from launch() being called to launch() returning
+        self.wall_time = Histogram()
+        # time spent waiting for the single_instance lock, or for an executor thread
+        self.wait_time = Histogram()
+        # time spent running sieves
+        self.sieve_time = Histogram()
+
+    @property
+    def calls(self):
+        return self.wall_time.count
+
+    @property
+    def errors(self):
+        return self.outcomes[OUTCOME_ERROR]
+
+    @property
+    def throughput(self):
+        """
+        Average calls per second since this hook was first launched
+        :rtype: float
+        """
+        elapsed = time.monotonic() - self.created
+        if elapsed <= 0:
+            return 0.0
+        return self.calls / elapsed
+
+    def sort_value(self, key):
+        """
+        :type key: str
+        :rtype: float
+        """
+        if key == "p50":
+            return self.wall_time.percentile(50)
+        elif key == "p99":
+            return self.wall_time.percentile(99)
+        elif key == "max":
+            return self.wall_time.max
+        elif key == "mean":
+            return self.wall_time.mean
+        elif key == "calls":
+            return self.calls
+        elif key == "errors":
+            return self.errors
+        else:
+            raise ValueError("Unknown sort key '{}'".format(key))
+
+    def summary(self):
+        """
+        :rtype: str
+        """
+        return ("{}: {} calls ({:.2f}/s), {} errors, {} blocked - "
+                "p50 {}, p99 {}, max {}, wait p99 {}, sieve p99 {}").format(
+            self.description, self.calls, self.throughput, self.errors, self.outcomes[OUTCOME_BLOCKED],
+            format_duration(self.wall_time.percentile(50)), format_duration(self.wall_time.percentile(99)),
+            format_duration(self.wall_time.max), format_duration(self.wait_time.percentile(99)),
+            format_duration(self.sieve_time.percentile(99)))
+
+
+class HookRun:
+    """
+    Timing information for a single launch of a hook. Filled in by PluginManager.launch as the hook progresses.
+
+    :type hook: obrbot.plugin.Hook
+    :type event: obrbot.event.Event
+    :type started: float
+    :type wait: float
+    :type sieve: float
+    :type coroutine: collections.Iterator
+    :type thread_id: int
+    :type reported: bool
+    """
+    __slots__ = ['hook', 'event', 'started', 'wait', 'sieve', 'coroutine', 'thread_id', 'reported']
+
+    def __init__(self, hook, event):
+        """
+        :type hook: obrbot.plugin.Hook
+        :type event: obrbot.event.Event
+        """
+        self.hook = hook
+        self.event = event
+        self.started = time.perf_counter()
+        self.wait = 0.0
+        self.sieve = 0.0
+        # the hook's coroutine object, or the ident of the thread running it, for as long as it's running
+        self.coroutine = None
+        self.thread_id = None
+        # whether the watchdog has reported this run as slow
+        self.reported = False
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+class HookMetrics:
+    """
+    Holds HookStats for every hook which has been launched.
+
+    :type hooks: dict[str, HookStats]
+    """
+
+    def __init__(self):
+        self.hooks = {}
+
+    def get(self, hook):
+        """
+        Gets the stats for a hook, creating them if they don't exist yet
+        :type hook: obrbot.plugin.Hook
+        :rtype: HookStats
+        """
+        description = hook.description
+        stats = self.hooks.get(description)
+        if stats is None:
+            stats = HookStats(description)
+            self.hooks[description] = stats
+        return stats
+
+    def record(self, run, outcome):
+        """
+        Records a finished hook run
+        :type run: HookRun
+        :type outcome: str
+        """
+        stats = self.get(run.hook)
+        stats.outcomes[outcome] += 1
+        stats.wall_time.record(time.perf_counter() - run.started)
+        stats.wait_time.record(run.wait)
+        stats.sieve_time.record(run.sieve)
+
+    def top(self, count=10, key="p99"):
+        """
+        Returns the <count> slowest hooks, sorted by <key> (one of p50, p99, max, mean, calls or errors)
+        :type count: int
+        :type key: str
+        :rtype: list[HookStats]
+        """
+        if key not in sort_keys:
+            raise ValueError("Unknown sort key '{}'".format(key))
+        return sorted(self.hooks.values(), key=lambda stats: stats.sort_value(key), reverse=True)[:count]
+
+    def reset(self):
+        self.hooks.clear()
+
+
+class CommandMetrics:
+    """
+    Latency histograms keyed by command name, safe to record into from multiple threads.
+
+    :type histograms: dict[str, Histogram]
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, duration):
+        """
+        :type name: str
+        :type duration: float
+        """
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = Histogram()
+                self.histograms[name] = histogram
+            histogram.record(duration)
+
+
+class MeteredThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    A ThreadPoolExecutor which keeps track of how many of its workers are busy, and how much work is queued.
+
+    :type max_workers: int
+    :type active: int
+    :type queued: int
+    :type completed: int
+    """
+
+    def __init__(self, max_workers):
+        """
+        :type max_workers: int
+        """
+        super().__init__(max_workers)
+        self.max_workers = max_workers
+        self.active = 0
+        self.queued = 0
+        self.completed = 0
+        self._counter_lock = threading.Lock()
+
+    @property
+    def utilization(self):
+        """
+        The fraction of workers which are currently busy
+        :rtype: float
+        """
+        return self.active / self.max_workers
+
+    def submit(self, fn, *args, **kwargs):
+        with self._counter_lock:
+            self.queued += 1
+
+        def run():
+            with self._counter_lock:
+                self.queued -= 1
+                self.active += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._counter_lock:
+                    self.active -= 1
+                    self.completed += 1
+
+        def done(future):
+            if future.cancelled():
+                # cancelled before it started running
+                with self._counter_lock:
+                    self.queued -= 1
+
+        future = super().submit(run)
+        future.add_done_callback(done)
+        return future
@@ -0,0 +1,345 @@
+import asyncio
+import logging
+
+logger = logging.getLogger("obrbot")
+
+# Bucket boundaries, in seconds, used when exporting histograms
+export_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape_label(value):
+    """
+    :type value: str
+    :rtype: str
+    """
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    """
+    :type labels: dict[str, str]
+    :rtype: str
+    """
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, _escape_label(value)) for key, value in labels.items()) + "}"
+
+
+def _format_value(value):
+    """
+    :type value: float | int
+    :rtype: str
+    """
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class Exposition:
+    """
+    Builds a page of metrics in the Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        self._lines = []
+        self._declared = set()
+
+    def _declare(self, name, metric_type, doc):
+        if name not in self._declared:
+            self._declared.add(name)
+            self._lines.append("# HELP {} {}".format(name, doc))
+            self._lines.append("# TYPE {} {}".format(name, metric_type))
+
+    def _sample(self, name, labels, value):
+        self._lines.append("{}{} {}".format(name, _format_labels(labels), _format_value(value)))
+
+    def counter(self, name, doc, value, **labels):
+        """
+        :type name: str
+        :type doc: str
+        :type value: int | float
+        """
+        self._declare(name, "counter", doc)
+        self._sample(name, labels, value)
+
+    def gauge(self, name, doc, value, **labels):
+        """
+        :type name: str
+        :type doc: str
+        :type value: int | float
+        """
+        self._declare(name, "gauge", doc)
+        self._sample(name, labels, value)
+
+    def histogram(self, name, doc, histogram, **labels):
+        """
+        :type name: str
+        :type doc: str
+        :type histogram: obrbot.metrics.Histogram
+        """
+        self._declare(name, "histogram", doc)
+        for bound in export_buckets:
+            bucket_labels = dict(labels, le=_format_value(bound))
+            self._sample(name + "_bucket", bucket_labels, histogram.count_at_or_below(bound))
+        self._sample(name + "_bucket", dict(labels, le="+Inf"), histogram.count)
+        self._sample(name + "_sum", labels, histogram.total)
+        self._sample(name + "_count", labels, histogram.count)
+
+    def render(self):
+        """
+        :rtype: str
+        """
+        return "\n".join(self._lines) + "\n"
+
+
+def collect(bot):
+    """
+    Collects all of the bot's metrics
+    :type bot: obrbot.bot.ObrBot
+    :rtype: Exposition
+    """
+    out = Exposition()
+
+    # samples of each metric need to be grouped together, so loop over the connections once per metric
+    for conn in bot.connections:
+        out.gauge("obrbot_connected", "Whether the connection is currently connected", int(conn.connected),
+                  connection=conn.name)
+    for conn in bot.connections:
+        out.counter("obrbot_lines_received_total", "Lines received from the server", conn.lines_received,
+                    connection=conn.name)
+    for conn in bot.connections:
+        out.counter("obrbot_lines_sent_total", "Lines sent to the server", conn.lines_sent, connection=conn.name)
+    for conn in bot.connections:
+        out.gauge("obrbot_event_queue_depth", "Events received but not yet fully processed", conn.pending_events,
+                  connection=conn.name)
+    for conn in bot.connections:
+        out.gauge("obrbot_outbound_queue_depth", "Lines queued to send but not yet written", conn.pending_sends,
+                  connection=conn.name)
+    for conn in bot.connections:
+        out.gauge("obrbot_outbound_buffer_bytes", "Bytes written but not yet sent to the server",
+                  conn.outbound_buffer_size, connection=conn.name)
+    for conn in bot.connections:
+        out.gauge("obrbot_channels", "Channels the bot is in", len(conn.channels), connection=conn.name)
+    for conn in bot.connections:
+        out.gauge("obrbot_channel_users", "Sum of the users in each channel the bot is in",
+                  sum(len(channel.users) for channel in conn.channels.values()), connection=conn.name)
+    for conn in bot.connections:
+        out.gauge("obrbot_history_buffered", "History entries waiting to be written",
+                  conn.history_writer.buffered, connection=conn.name)
+    for conn in bot.connections:
+        out.counter("obrbot_history_flushes_total", "Batches of history entries written",
+                    conn.history_writer.flushes, connection=conn.name)
+    for conn in bot.connections:
+        out.counter("obrbot_history_entries_written_total", "History entries written",
+                    conn.history_writer.entries_written, connection=conn.name)
+    for conn in bot.connections:
+        out.gauge("obrbot_history_max_flush_size", "Largest number of history entries written in one batch",
+                  conn.history_writer.max_flush_size, connection=conn.name)
+    for conn in bot.connections:
+        out.counter("obrbot_history_flush_errors_total", "Batches of history entries which failed to be written",
+                    conn.history_writer.errors, connection=conn.name)
+    for conn in bot.connections:
+        out.counter("obrbot_history_dropped_total", "History entries dropped after writes kept failing",
+                    conn.history_writer.dropped, connection=conn.name)
+    for conn in bot.connections:
+        out.histogram("obrbot_history_flush_seconds", "Time taken to write a batch of history entries",
+                      conn.history_writer.flush_time, connection=conn.name)
+    for conn in bot.connections:
+        out.gauge("obrbot_seen_cached", "Nicks whose last activity is cached in memory", conn.seen.cached,
+                  connection=conn.name)
+    for conn in bot.connections:
+        out.gauge("obrbot_seen_buffered", "Nicks whose last activity is waiting to be written", conn.seen.buffered,
+                  connection=conn.name)
+    for conn in bot.connections:
+        out.counter("obrbot_seen_lookups_total", "Last activity lookups", conn.seen.lookups, connection=conn.name)
+    for conn in bot.connections:
+        out.counter("obrbot_seen_cache_hits_total", "Last activity lookups answered from memory",
+                    conn.seen.cache_hits, connection=conn.name)
+    for conn in bot.connections:
+        out.counter("obrbot_seen_dropped_total", "Last activity dropped while too many nicks waited to be written",
+                    conn.seen.dropped, connection=conn.name)
+
+    for conn in bot.connections:
+        out.gauge("obrbot_who_queued", "Channels waiting to be looked up with WHO", conn.who_queue.queued,
+                  connection=conn.name)
+    for conn in bot.connections:
+        out.counter("obrbot_who_requests_total", "WHO lookups of channels sent", conn.who_queue.requests,
+                    connection=conn.name)
+    for conn in bot.connections:
+        out.counter("obrbot_who_timeouts_total", "WHO lookups of channels which weren't answered in time",
+                    conn.who_queue.timeouts, connection=conn.name)
+
+    for conn in bot.connections:
+        out.gauge("obrbot_waiters", "Futures waiting for a message from wait_for()", len(conn.waiters),
+                  connection=conn.name)
+    for conn in bot.connections:
+        out.counter("obrbot_waiters_matched_total", "Waits resolved by a matching message", conn.waiters.matched,
+                    connection=conn.name)
+    for conn in bot.connections:
+        out.counter("obrbot_waiters_timeouts_total", "Waits which timed out before a matching message",
+                    conn.waiters.timeouts, connection=conn.name)
+
+    for conn in bot.connections:
+        out.counter("obrbot_snapshot_saves_total", "Snapshots of channel state written", conn.snapshots.saves,
+                    connection=conn.name)
+    for conn in bot.connections:
+        out.counter("obrbot_snapshot_adopted_total", "Channels filled in from a snapshot when rejoined",
+                    conn.snapshots.adopted, connection=conn.name)
+    for conn in bot.connections:
+        out.gauge("obrbot_snapshot_restored", "Channels from a snapshot waiting to be rejoined",
+                  conn.snapshots.restored, connection=conn.name)
+
+    compactor = bot.history_compactor
+    out.counter("obrbot_history_compaction_runs_total", "Completed history compaction runs", compactor.runs)
+    out.counter("obrbot_history_compaction_removed_total", "History entries removed by compaction",
+                compactor.removed)
+    out.gauge("obrbot_history_compaction_last_duration_seconds", "Time taken by the last history compaction run",
+              compactor.last_duration)
+    out.counter("obrbot_seen_trimmed_total", "Last activity of nicks and masks removed for being too old",
+                compactor.sightings_removed)
+
+    search_index = bot.search_index
+    out.gauge("obrbot_search_postings_buffered", "Search postings waiting to be written",
+              search_index.writer.buffered)
+    out.counter("obrbot_search_postings_written_total", "Search postings written",
+                search_index.writer.entries_written)
+    out.counter("obrbot_search_flush_errors_total", "Batches of search postings which failed to be written",
+                search_index.writer.errors)
+    out.counter("obrbot_search_postings_removed_total", "Search postings removed by compaction",
+                search_index.postings_removed)
+    out.counter("obrbot_searches_total", "History searches run", search_index.searches)
+
+    channel_stats = bot.channel_stats
+    out.counter("obrbot_stats_messages_counted_total", "Messages counted in channel statistics",
+                channel_stats.messages_counted)
+    out.counter("obrbot_stats_flushes_total", "Batches of channel statistics written", channel_stats.flushes)
+    out.counter("obrbot_stats_flush_errors_total", "Batches of channel statistics which failed to be written",
+                channel_stats.errors)
+
+    hook_metrics = bot.plugin_manager.hook_metrics
+    for description, stats in hook_metrics.hooks.items():
+        for outcome, count in stats.outcomes.items():
+            out.counter("obrbot_hook_runs_total", "Hook runs, by outcome", count, hook=description, outcome=outcome)
+    for description, stats in hook_metrics.hooks.items():
+        out.histogram("obrbot_hook_duration_seconds", "Time from a hook being launched to it finishing",
+                      stats.wall_time, hook=description)
+    for description, stats in hook_metrics.hooks.items():
+        out.histogram("obrbot_hook_wait_seconds", "Time hooks spent waiting for a lock or executor thread",
+                      stats.wait_time, hook=description)
+    for description, stats in hook_metrics.hooks.items():
+        out.histogram("obrbot_hook_sieve_seconds", "Time spent running sieves before a hook",
+                      stats.sieve_time, hook=description)
+
+    executor = bot.executor
+    out.gauge("obrbot_executor_workers", "Maximum number of executor threads", executor.max_workers)
+    out.gauge("obrbot_executor_active", "Executor threads currently running a task", executor.active)
+    out.gauge("obrbot_executor_queued", "Tasks waiting for an executor thread", executor.queued)
+    out.gauge("obrbot_executor_utilization", "Fraction of executor threads currently busy", executor.utilization)
+    out.counter("obrbot_executor_completed_total", "Tasks completed by the executor", executor.completed)
+
+    for command, histogram in sorted(bot.db_metrics.histograms.items()):
+        out.histogram("obrbot_db_command_seconds", "Database command latency", histogram, command=command)
+
+    out.histogram("obrbot_loop_lag_seconds", "How late periodic event loop callbacks ran",
+                  bot.loop_monitor.histogram)
+    out.counter("obrbot_loop_stalls_total", "Times the event loop was blocked past the lag threshold",
+                bot.loop_monitor.stalls)
+
+    return out
+
+
+class MetricsServer:
+    """
+    A minimal HTTP server, running on the bot's event loop, which serves the bot's metrics in the Prometheus text
+    format at /metrics. Listens on either a TCP host and port, or a unix socket.
+
+    :type bot: obrbot.bot.ObrBot
+    :type host: str
+    :type port: int
+    :type unix_socket: str
+    """
+
+    def __init__(self, bot, *, host="127.0.0.1", port=9197, unix_socket=None, timeout=10):
+        """
+        :type bot: obrbot.bot.ObrBot
+        :type host: str
+        :type port: int
+        :type unix_socket: str
+        :type timeout: float
+        """
+        self.bot = bot
+        self.loop = bot.loop
+        self.host = host
+        self.port = port
+        self.unix_socket = unix_socket
+        self.timeout = timeout
+        self._server = None
+
+    def describe(self):
+        if self.unix_socket:
+            return "unix:{}".format(self.unix_socket)
+        return "{}:{}".format(self.host, self.port)
+
+    @asyncio.coroutine
+    def start(self):
+        if self.unix_socket:
+            self._server = yield from asyncio.start_unix_server(self._handle_client, path=self.unix_socket,
+                                                                loop=self.loop)
+        else:
+            self._server = yield from asyncio.start_server(self._handle_client, host=self.host, port=self.port,
+                                                           loop=self.loop)
+        logger.info("Serving metrics on {}".format(self.describe()))
+
+    def stop(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    @asyncio.coroutine
+    def _handle_client(self, reader, writer):
+        """
+        :type reader: asyncio.StreamReader
+        :type writer: asyncio.StreamWriter
+        """
+        try:
+            request_line = yield from asyncio.wait_for(reader.readline(), self.timeout, loop=self.loop)
+            # read and discard the headers
+            while True:
+                header = yield from asyncio.wait_for(reader.readline(), self.timeout, loop=self.loop)
+                if header in (b"\r\n", b"\n", b""):
+                    break
+
+            split = request_line.decode("ascii", "replace").split()
+            if len(split) < 2:
+                self._respond(writer, "400 Bad Request", "Bad request\n")
+                return
+            method, path = split[0], split[1].split("?", 1)[0]
+
+            if method not in ("GET", "HEAD"):
+                self._respond(writer, "405 Method Not Allowed", "Method not allowed\n")
+            elif path != "/metrics":
+                self._respond(writer, "404 Not Found", "Metrics are served at /metrics\n")
+            else:
+                self._respond(writer, "200 OK", collect(self.bot).render(), head=method == "HEAD")
+            yield from writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception:
+            logger.exception("Error serving metrics")
+        finally:
+            writer.close()
+
+    def _respond(self, writer, status, body, head=False):
+        """
+        :type writer: asyncio.StreamWriter
+        :type status: str
+        :type body: str
+        :type head: bool
+        """
+        data = body.encode("utf-8")
+        writer.write("HTTP/1.0 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(
+            status, content_type, len(data)).encode("ascii"))
+        if not head:
+            writer.write(data)
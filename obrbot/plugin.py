@@ -7,8 +7,12 @@ import logging
 import os
 import re
 import itertools
+import threading
+import time
 
 from obrbot.event import Event, HookEvent
+from obrbot.metrics import HookMetrics, HookRun, OUTCOME_SUCCESS, OUTCOME_ERROR, OUTCOME_BLOCKED, OUTCOME_HELP
+from obrbot.watchdog import HookWatchdog
 
 logger = logging.getLogger("obrbot")
 
@@ -110,6 +114,8 @@ class PluginManager:
     :type event_type_hooks: dict[obrbot.event.EventType, list[EventHook]]
     :type regex_hooks: list[(re.__Regex, RegexHook)]
     :type sieves: list[SieveHook]
+    :type hook_metrics: HookMetrics
+    :type watchdog: HookWatchdog
     """
 
     def __init__(self, bot):
@@ -127,6 +133,13 @@ class PluginManager:
         self.sieves = []
         self.shutdown_hooks = []
         self._hook_locks = {}
+        self.hook_metrics = HookMetrics()
+
+        metrics_config = bot.config.get("metrics", {})
+        self.watchdog = HookWatchdog(bot.loop, threshold=metrics_config.get("slow_hook_threshold", 5),
+                                     interval=metrics_config.get("slow_hook_check_interval", 1),
+                                     report_burst=metrics_config.get("slow_hook_report_burst", 5),
+                                     reports_per_minute=metrics_config.get("slow_hook_reports_per_minute", 6))
 
     @asyncio.coroutine
     def load_all(self, plugin_directories):
@@ -233,7 +246,7 @@ class PluginManager:
             logger.debug("Loaded {}".format(repr(hook)))
 
     @asyncio.coroutine
-    def _execute_hook(self, hook, base_event, hook_event):
+    def _execute_hook(self, hook, base_event, hook_event, run):
         """
         Runs the specific hook with the given bot and event.
 
@@ -242,6 +255,7 @@ class PluginManager:
         :type hook: obrbot.plugin.Hook
         :type base_event: obrbot.event.Event
         :type hook_event: obrbot.event.HookEvent
+        :type run: obrbot.metrics.HookRun
         :rtype: bool
         """
         parameters = _prepare_parameters(hook, base_event, hook_event)
@@ -252,9 +266,24 @@ class PluginManager:
             # _internal_run_threaded and _internal_run_coroutine prepare the database, and run the hook.
             # _internal_run_* will prepare parameters and the database session, but won't do any error catching.
             if hook.threaded:
-                out = yield from self.bot.loop.run_in_executor(None, hook.function, *parameters)
+                submitted = time.perf_counter()
+
+                def run_threaded():
+                    # record how long we waited for a free executor thread, and which thread we're running on
+                    run.wait += time.perf_counter() - submitted
+                    run.thread_id = threading.get_ident()
+                    try:
+                        return hook.function(*parameters)
+                    finally:
+                        run.thread_id = None
+
+                out = yield from self.bot.loop.run_in_executor(None, run_threaded)
             else:
-                out = yield from hook.function(*parameters)
+                run.coroutine = hook.function(*parameters)
+                try:
+                    out = yield from run.coroutine
+                finally:
+                    run.coroutine = None
         except Exception:
             logger.exception("Error in hook {}".format(hook.description))
             base_event.message("Error in plugin '{}'.".format(hook.plugin))
@@ -277,6 +306,7 @@ class PluginManager:
         :type hook_event: obrbot.event.HookEvent
         :rtype: obrbot.event.Event
         """
+        start = time.perf_counter()
         try:
             if sieve.threaded:
                 result = yield from self.bot.loop.run_in_executor(None, sieve.function, event, hook_event)
@@ -287,6 +317,9 @@ class PluginManager:
             return None
         else:
             return result
+        finally:
+            if event.trace is not None:
+                event.trace.span("sieve " + sieve.description, start, hook=hook_event.hook.description)
 
     @asyncio.coroutine
     def launch(self, hook, base_event, hevent=None):
@@ -300,19 +333,53 @@ class PluginManager:
         :type hook: obrbot.plugin.Hook | obrbot.plugin.CommandHook
         :rtype: bool
         """
+        run = HookRun(hook, base_event)
+        outcome = OUTCOME_ERROR
+        self.watchdog.watch(run)
+        try:
+            result = yield from self._launch(hook, base_event, hevent, run)
+            if result is None:
+                outcome = OUTCOME_BLOCKED
+                return False
+            elif result == OUTCOME_HELP:
+                outcome = OUTCOME_HELP
+                return False
+            elif result:
+                outcome = OUTCOME_SUCCESS
+            return result
+        finally:
+            self.watchdog.unwatch(run)
+            self.hook_metrics.record(run, outcome)
+            if base_event.trace is not None:
+                base_event.trace.span("hook " + hook.description, run.started, outcome=outcome)
+
+    @asyncio.coroutine
+    def _launch(self, hook, base_event, hevent, run):
+        """
+        Does the work of launch(). Returns None if a sieve blocked the hook, OUTCOME_HELP if help was sent instead of
+        running the hook, and otherwise the result of _execute_hook.
 
+        :type hook: obrbot.plugin.Hook | obrbot.plugin.CommandHook
+        :type base_event: obrbot.event.Event
+        :type hevent: obrbot.event.HookEvent | obrbot.event.CommandHookEvent
+        :type run: obrbot.metrics.HookRun
+        :rtype: bool | str | None
+        """
         if hevent is None:
             hevent = HookEvent(base_event=base_event, hook=hook)
 
         if hook.type not in (HookType.on_start, HookType.on_stop):  # we don't need sieves on on_start or on_stop hooks.
+            sieve_start = time.perf_counter()
             for sieve in self.bot.plugin_manager.sieves:
                 base_event = yield from self._sieve(sieve, base_event, hevent)
                 if base_event is None:
-                    return False
+                    run.sieve = time.perf_counter() - sieve_start
+                    return None
+            run.sieve = time.perf_counter() - sieve_start
 
         if hook.type is HookType.command and hook.auto_help and not hevent.text and hook.doc is not None:
             hevent.notice_doc()
-            return False
+            return OUTCOME_HELP
 
         if hook.single_thread:
             # There should only be once instance of this hook running at a time, so let's use a lock for it.
@@ -321,11 +388,13 @@ class PluginManager:
                 self._hook_locks[key] = asyncio.Lock(loop=self.bot.loop)
 
             # Run the plugin with the message, and wait for it to finish
+            lock_start = time.perf_counter()
             with (yield from self._hook_locks[key]):
-                result = yield from self._execute_hook(hook, base_event, hevent)
+                run.wait += time.perf_counter() - lock_start
+                result = yield from self._execute_hook(hook, base_event, hevent, run)
         else:
             # Run the plugin with the message, and wait for it to finish
-            result = yield from self._execute_hook(hook, base_event, hevent)
+            result = yield from self._execute_hook(hook, base_event, hevent, run)
 
         # Return the result
         return result
@@ -0,0 +1,282 @@
+import asyncio
+import logging
+import re
+import time
+import unicodedata
+
+from obrbot.event import EventType
+from obrbot.history import HistoryWriter, ZSetHistoryBackend, decode_record, remove_before, decode_entry
+
+logger = logging.getLogger("obrbot")
+
+# posting lists: sorted sets of record sequence ids, scored by timestamp, for each token said in each channel. The
+# channel is lowercased with str.lower(), the same as in its history key.
+search_key = "obrbot:connections:{}:search:{}:{}"
+search_key_re = re.compile(r"^obrbot:connections:(.+?):search:(.+):([^:]+)$")
+
+# the events whose content is indexed, which is always the last field of their history record
+indexed_event_types = frozenset((EventType.message, EventType.action, EventType.topic))
+
+_formatting_re = re.compile(r"\x03(?:\d{1,2}(?:,\d{1,2})?)?|[\x02\x0f\x16\x1d\x1f]")
+_token_re = re.compile(r"\w+")
+
+MIN_TOKEN_LENGTH = 2
+MAX_TOKEN_LENGTH = 40
+
+
+def tokenize(text, max_tokens=None):
+    """
+    Splits text into normalized search tokens: words without IRC formatting, NFKC normalized and case folded. Each
+    token is only returned once, in the order it first appears.
+    :type text: str
+    :param max_tokens: The maximum number of tokens to return
+    :type max_tokens: int
+    :rtype: list[str]
+    """
+    text = unicodedata.normalize("NFKC", _formatting_re.sub("", text)).casefold()
+    tokens = []
+    seen = set()
+    for token in _token_re.findall(text):
+        if MIN_TOKEN_LENGTH <= len(token) <= MAX_TOKEN_LENGTH and token not in seen:
+            seen.add(token)
+            tokens.append(token)
+            if max_tokens is not None and len(tokens) >= max_tokens:
+                break
+    return tokens
+
+
+def parse_search_key(key):
+    """
+    Returns the connection, channel and token from a search key, or None if it isn't a search key
+    :type key: str | bytes
+    :rtype: (str, str, str) | None
+    """
+    if isinstance(key, bytes):
+        key = key.decode("utf-8", "replace")
+    match = search_key_re.match(key)
+    if match is None:
+        return None
+    return match.groups()
+
+
+class SearchIndex:
+    """
+    An inverted index over channel history. For every token said in a channel, a posting list holds the sequence ids
+    of the history records containing it, scored by their timestamps. Postings are batched by a HistoryWriter, and
+    trimmed alongside the history they point to when the HistoryCompactor runs.
+
+    A search reads the rarest token's posting list newest first, a page at a time, checks each posting against the
+    other tokens' lists with ZSCORE, and only then looks up the matching history records. Postings whose records
+    have already been removed are skipped.
+
+    :type db: obrbot.database.Database
+    :type history_backend: obrbot.history.ZSetHistoryBackend | obrbot.history.StreamHistoryBackend
+    :type loop: asyncio.events.AbstractEventLoop
+    :type enabled: bool
+    :type max_tokens: int
+    :type page_size: int
+    :type writer: HistoryWriter
+    :type searches: int
+    :type postings_removed: int
+    """
+
+    def __init__(self, db, history_backend, loop, *, enabled=True, max_tokens=32, page_size=200, interval=0.1,
+                 max_entries=500):
+        """
+        :param max_tokens: Maximum number of tokens to index from a single record
+        :param page_size: Number of postings to read at once while searching
+        :param interval: Seconds to wait after a posting is buffered before writing it
+        :param max_entries: Number of buffered postings which will cause a write immediately
+        :type db: obrbot.database.Database
+        :type history_backend: obrbot.history.ZSetHistoryBackend | obrbot.history.StreamHistoryBackend
+        :type loop: asyncio.events.AbstractEventLoop
+        :type enabled: bool
+        :type max_tokens: int
+        :type page_size: int
+        :type interval: float
+        :type max_entries: int
+        """
+        self.db = db
+        self.history_backend = history_backend
+        self.loop = loop
+        self.enabled = enabled
+        self.max_tokens = max_tokens
+        self.page_size = page_size
+        # postings are sorted set entries, just like zset history records
+        self.writer = HistoryWriter(ZSetHistoryBackend(db), loop, interval=interval, max_entries=max_entries)
+
+        self.searches = 0
+        self.postings_removed = 0
+
+    def key(self, connection, channel, token):
+        """
+        :type connection: str
+        :type channel: str
+        :type token: str
+        :rtype: str
+        """
+        return search_key.format(connection.lower(), channel.lower(), token)
+
+    def add(self, connection, channel, sequence, timestamp, text):
+        """
+        Indexes a history record
+        :type connection: str
+        :type channel: str
+        :param sequence: The record's sequence id
+        :type sequence: int
+        :param timestamp: The record's timestamp, as stored in history
+        :type timestamp: float
+        :param text: The content to index
+        :type text: str
+        """
+        if not self.enabled:
+            return
+        posting = str(sequence).encode("ascii")
+        for token in tokenize(text, self.max_tokens):
+            self.writer.add(self.key(connection, channel, token), posting, timestamp)
+
+    @asyncio.coroutine
+    def search(self, connection, channel, text, *, since=None, until=None, limit=20):
+        """
+        Finds the history records in a channel which contain every token in `text`, newest first
+        :type connection: str
+        :type channel: str
+        :type text: str
+        :param since: The earliest timestamp to search from
+        :type since: float
+        :param until: The latest timestamp to search to
+        :type until: float
+        :param limit: The maximum number of records to return
+        :type limit: int
+        :return: Matching records, as (timestamp, EventType, nickname, other data)
+        :rtype: list[tuple]
+        """
+        tokens = tokenize(text)
+        if not tokens or not self.enabled:
+            return []
+        self.searches += 1
+        # make sure buffered postings are included
+        yield from self.writer.flush()
+
+        low = "-inf" if since is None else since
+        high = "+inf" if until is None else until
+        keys = [self.key(connection, channel, token) for token in tokens]
+        pipeline = self.db.pipeline(transaction=False)
+        for key in keys:
+            pipeline.zcount(key, low, high)
+        counts = yield from pipeline.execute()
+        if not all(counts):
+            return []
+        (rarest_count, rarest), *others = sorted(zip(counts, keys))
+        others = [key for count, key in others]
+
+        history_key = self.history_backend.key(connection, channel)
+        results = []
+        start = 0
+        while len(results) < limit and start < rarest_count:
+            postings = yield from self.db.zrevrangebyscore(rarest, high, low, start=start, num=self.page_size,
+                                                           withscores=True)
+            if not postings:
+                break
+            start += len(postings)
+            if others:
+                postings = yield from self._filter(postings, others)
+
+            records = yield from asyncio.gather(*[self._find_record(history_key, int(posting), timestamp)
+                                                  for posting, timestamp in postings[:limit - len(results)]],
+                                                loop=self.loop)
+            results.extend(record for record in records if record is not None)
+        return results
+
+    @asyncio.coroutine
+    def _filter(self, postings, keys):
+        """
+        Returns the postings which are in every one of the given posting lists
+        :type postings: list[(bytes, float)]
+        :type keys: list[str]
+        :rtype: list[(bytes, float)]
+        """
+        pipeline = self.db.pipeline(transaction=False)
+        for posting, timestamp in postings:
+            for key in keys:
+                pipeline.zscore(key, posting)
+        scores = yield from pipeline.execute()
+        return [posting for index, posting in enumerate(postings)
+                if None not in scores[index * len(keys):(index + 1) * len(keys)]]
+
+    @asyncio.coroutine
+    def _find_record(self, history_key, sequence, timestamp):
+        """
+        :type history_key: str
+        :type sequence: int
+        :type timestamp: float
+        :rtype: tuple | None
+        """
+        position = None
+        while True:
+            records, position = yield from self.history_backend.read_page(history_key, position, 100,
+                                                                          min_time=timestamp, max_time=timestamp)
+            for member, score in records:
+                if decode_record(member)[0] == sequence:
+                    return decode_entry(member, score)
+            if position is None:
+                return None
+
+    @asyncio.coroutine
+    def compact(self, compactor):
+        """
+        Removes postings for records older than a channel's retention limit, or older than the oldest record still in
+        its history
+        :type compactor: obrbot.history.HistoryCompactor
+        :return: The number of postings removed
+        :rtype: int
+        """
+        removed = 0
+        cutoffs = {}
+        cursor = 0
+        pattern = search_key.format("*", "*", "*")
+        while True:
+            cursor, keys = yield from self.db.scan(cursor, match=pattern, count=compactor.scan_count)
+            for key in keys:
+                names = parse_search_key(key)
+                if names is None:
+                    continue
+                connection, channel, token = names
+                cutoff = cutoffs.get((connection, channel))
+                if cutoff is None:
+                    cutoff = cutoffs[connection, channel] = yield from self._cutoff(compactor, connection, channel)
+                if cutoff:
+                    removed += yield from remove_before(self.db, key, cutoff, batch_size=compactor.batch_size)
+            if cursor == 0:
+                break
+
+        self.postings_removed += removed
+        if removed:
+            logger.info("Removed {} old search postings".format(removed))
+        return removed
+
+    @asyncio.coroutine
+    def _cutoff(self, compactor, connection, channel):
+        """
+        :type compactor: obrbot.history.HistoryCompactor
+        :type connection: str
+        :type channel: str
+        :return: The timestamp postings older than should be removed, or 0 to keep them all
+        :rtype: float
+        """
+        cutoff = 0
+        max_age = compactor.retention_for(connection, channel)[0]
+        if max_age:
+            cutoff = time.time() - max_age
+        oldest, position = yield from self.history_backend.read_page(self.history_backend.key(connection, channel),
+                                                                     None, 1)
+        if oldest:
+            cutoff = max(cutoff, oldest[0][1])
+        return cutoff
+
+    @asyncio.coroutine
+    def close(self):
+        """
+        Writes every buffered posting
+        """
+        yield from self.writer.close()
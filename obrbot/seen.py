@@ -0,0 +1,357 @@
+import asyncio
+from collections import OrderedDict
+import json
+import logging
+import time
+
+from obrbot.database import DatabaseError
+from obrbot.event import EventType
+from obrbot.util.dictionaries import get_casemapping
+
+logger = logging.getLogger("obrbot")
+
+# hashes of folded nick, or mask, to the last activity seen from it
+seen_nicks_key = "obrbot:connections:{}:seen:nicks"
+seen_masks_key = "obrbot:connections:{}:seen:masks"
+# matches both hashes, for every connection
+seen_keys_pattern = "obrbot:connections:*:seen:*"
+
+# the events which count as activity
+tracked_event_types = frozenset((EventType.message, EventType.action, EventType.join, EventType.part,
+                                 EventType.kick, EventType.topic, EventType.nick, EventType.quit))
+
+SNIPPET_LENGTH = 120
+
+
+class Sighting:
+    """
+    The last activity seen from a nick
+    :type timestamp: float
+    :type nick: str
+    :type mask: str
+    :type channel: str
+    :type event_type: EventType
+    :type content: str
+    """
+    __slots__ = ['timestamp', 'nick', 'mask', 'channel', 'event_type', 'content']
+
+    def __init__(self, timestamp, nick, mask, channel, event_type, content):
+        """
+        :type timestamp: float
+        :type nick: str
+        :type mask: str
+        :type channel: str
+        :type event_type: EventType
+        :type content: str
+        """
+        self.timestamp = timestamp
+        self.nick = nick
+        self.mask = mask
+        self.channel = channel
+        self.event_type = event_type
+        self.content = content
+
+    def encode(self):
+        """
+        :rtype: str
+        """
+        return json.dumps([self.timestamp, self.nick, self.mask, self.channel, self.event_type.name, self.content],
+                          separators=(",", ":"))
+
+    @classmethod
+    def decode(cls, data):
+        """
+        :type data: bytes | str
+        :rtype: Sighting
+        """
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        timestamp, nick, mask, channel, event_type, content = json.loads(data)
+        return cls(timestamp, nick, mask, channel, getattr(EventType, event_type, EventType.other), content)
+
+
+class SeenTracker:
+    """
+    Keeps track of the last activity from each nick on a connection, so it can be found without going through every
+    channel's history.
+
+    The most recently active nicks are cached in memory, up to `cache_size` of them. Sightings are written to the
+    database in batches every `interval` seconds, and a nick seen several times before a batch is written is only
+    written once, with its latest sighting. At most `cache_size` nicks wait to be written, so while the database is
+    unavailable the oldest sightings are dropped rather than kept until it's back.
+
+    :type db: obrbot.database.Database
+    :type connection: str
+    :type loop: asyncio.events.AbstractEventLoop
+    :type casemapping: obrbot.util.dictionaries.CaseMapping
+    :type cache_size: int
+    :type interval: float
+    :type lookups: int
+    :type cache_hits: int
+    :type writes: int
+    :type errors: int
+    :type dropped: int
+    """
+
+    def __init__(self, db, connection, loop, *, casemapping=None, cache_size=10000, interval=1):
+        """
+        :param casemapping: How nicks and masks are folded, rfc1459 if not given
+        :type db: obrbot.database.Database
+        :type connection: str
+        :type loop: asyncio.events.AbstractEventLoop
+        :type casemapping: obrbot.util.dictionaries.CaseMapping
+        :param cache_size: Number of nicks to keep in memory, and to keep waiting to be written
+        :param interval: Seconds to wait after a sighting before writing it
+        :type cache_size: int
+        :type interval: float
+        """
+        self.db = db
+        self.connection = connection
+        self.loop = loop
+        self.cache_size = cache_size
+        self.interval = interval
+        self.casemapping = get_casemapping(casemapping)
+        self.nicks_key = seen_nicks_key.format(connection.lower())
+        self.masks_key = seen_masks_key.format(connection.lower())
+
+        # folded nick -> Sighting, least recently used first
+        self._cache = OrderedDict()
+        # folded nick -> Sighting, waiting to be written, oldest first
+        self._pending = OrderedDict()
+        # folded mask -> Sighting, waiting to be written, oldest first
+        self._pending_masks = OrderedDict()
+        self._timer = None
+        self._flush_lock = asyncio.Lock(loop=loop)
+
+        self.lookups = 0
+        self.cache_hits = 0
+        self.writes = 0
+        self.errors = 0
+        self.dropped = 0
+
+    @property
+    def cached(self):
+        """
+        :rtype: int
+        """
+        return len(self._cache)
+
+    @property
+    def buffered(self):
+        """
+        :rtype: int
+        """
+        return len(self._pending)
+
+    def _remember(self, key, sighting):
+        self._cache[key] = sighting
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _limit_pending(self):
+        """
+        Drops the oldest sightings waiting to be written, beyond `cache_size` of them
+        """
+        while len(self._pending) > self.cache_size:
+            self._pending.popitem(last=False)
+            self.dropped += 1
+        while len(self._pending_masks) > self.cache_size:
+            self._pending_masks.popitem(last=False)
+
+    def add(self, sighting):
+        """
+        Records activity from a nick
+        :type sighting: Sighting
+        """
+        key = self.casemapping.fold(sighting.nick)
+        self._remember(key, sighting)
+        self._pending[key] = sighting
+        self._pending.move_to_end(key)
+        if sighting.mask is not None:
+            mask = self.casemapping.fold(sighting.mask)
+            self._pending_masks[mask] = sighting
+            self._pending_masks.move_to_end(mask)
+        self._limit_pending()
+        if self._timer is None:
+            self._timer = self.loop.call_later(self.interval, self._flush_soon)
+
+    def track(self, event):
+        """
+        Records the activity in an event, if it's activity from a user in a channel
+        :type event: obrbot.event.Event
+        """
+        if event.type not in tracked_event_types or event.nick is None:
+            return
+        if event.channel is not None:
+            channel = event.channel.name
+        elif event.channels:
+            channel = event.channels[0].name
+        else:
+            # private messages, and users we don't share a channel with, aren't tracked
+            return
+        now = time.time()
+        if event.type is EventType.nick:
+            # both nicks were seen, the content says which way the change went
+            self.add(Sighting(now, event.nick, event.mask, channel, event.type, "to " + event.content))
+            mask = None
+            if event.user is not None and event.host is not None:
+                mask = "{}!{}@{}".format(event.content, event.user, event.host)
+            self.add(Sighting(now, event.content, mask, channel, event.type, "from " + event.nick))
+            return
+        content = event.content or ""
+        if len(content) > SNIPPET_LENGTH:
+            content = content[:SNIPPET_LENGTH - 3] + "..."
+        self.add(Sighting(now, event.nick, event.mask, channel, event.type, content))
+
+    @asyncio.coroutine
+    def lookup(self, nick):
+        """
+        Gets the last activity seen from a nick
+        :type nick: str
+        :rtype: Sighting | None
+        """
+        self.lookups += 1
+        key = self.casemapping.fold(nick)
+        sighting = self._cache.get(key)
+        if sighting is not None:
+            self.cache_hits += 1
+            self._cache.move_to_end(key)
+            return sighting
+        sighting = self._pending.get(key)
+        if sighting is not None:
+            self.cache_hits += 1
+            return sighting
+
+        data = yield from self.db.hget(self.nicks_key, key)
+        if data is None:
+            return None
+        sighting = Sighting.decode(data)
+        # a sighting may have been added while waiting for the database
+        newer = self._cache.get(key) or self._pending.get(key)
+        if newer is not None:
+            return newer
+        self._remember(key, sighting)
+        return sighting
+
+    @asyncio.coroutine
+    def lookup_mask(self, mask):
+        """
+        Gets the last activity seen from a nick!user@host mask
+        :type mask: str
+        :rtype: Sighting | None
+        """
+        self.lookups += 1
+        mask = self.casemapping.fold(mask)
+        sighting = self._pending_masks.get(mask)
+        if sighting is not None:
+            self.cache_hits += 1
+            return sighting
+        data = yield from self.db.hget(self.masks_key, mask)
+        if data is None:
+            return None
+        return Sighting.decode(data)
+
+    def set_casemapping(self, casemapping):
+        """
+        Refolds the nicks in memory, after the server's casemapping changes
+        :type casemapping: obrbot.util.dictionaries.CaseMapping
+        """
+        self.casemapping = casemapping
+        self._cache = OrderedDict((casemapping.fold(sighting.nick), sighting) for sighting in self._cache.values())
+        self._pending = OrderedDict((casemapping.fold(sighting.nick), sighting) for sighting in self._pending.values())
+        self._pending_masks = OrderedDict((casemapping.fold(sighting.mask), sighting)
+                                          for sighting in self._pending_masks.values())
+
+    def _flush_soon(self):
+        self._timer = None
+        asyncio.async(self.flush(), loop=self.loop)
+
+    @asyncio.coroutine
+    def flush(self):
+        """
+        Writes every buffered sighting
+        """
+        with (yield from self._flush_lock):
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, OrderedDict()
+            pending_masks, self._pending_masks = self._pending_masks, OrderedDict()
+
+            nicks = {key: sighting.encode() for key, sighting in pending.items()}
+            masks = {mask: sighting.encode() for mask, sighting in pending_masks.items()}
+            pipeline = self.db.pipeline(transaction=False)
+            pipeline.hmset(self.nicks_key, nicks)
+            if masks:
+                pipeline.hmset(self.masks_key, masks)
+            try:
+                yield from pipeline.execute()
+            except (DatabaseError, ConnectionError, OSError) as e:
+                self.errors += 1
+                logger.warning("Couldn't write {} seen nicks, will retry: {}".format(len(pending), e))
+                # keep anything seen since, as it's newer, and no more than we'd buffer otherwise
+                for key, sighting in self._pending.items():
+                    pending[key] = sighting
+                    pending.move_to_end(key)
+                for mask, sighting in self._pending_masks.items():
+                    pending_masks[mask] = sighting
+                    pending_masks.move_to_end(mask)
+                self._pending, self._pending_masks = pending, pending_masks
+                self._limit_pending()
+                if self._timer is None:
+                    self._timer = self.loop.call_later(self.interval * 5, self._flush_soon)
+                return
+            self.writes += len(pending)
+
+    @asyncio.coroutine
+    def close(self):
+        yield from self.flush()
+
+
+@asyncio.coroutine
+def trim_sightings(db, max_age, *, scan_count=100, batch_size=1000):
+    """
+    Removes sightings older than `max_age` from every connection's seen hashes
+    :param max_age: Seconds to keep sightings for
+    :param scan_count: COUNT hint given to each SCAN and HSCAN
+    :param batch_size: Maximum number of sightings to remove with a single command
+    :type db: obrbot.database.Database
+    :type max_age: float
+    :type scan_count: int
+    :type batch_size: int
+    :return: The number of sightings removed
+    :rtype: int
+    """
+    cutoff = time.time() - max_age
+    removed = 0
+    cursor = 0
+    while True:
+        cursor, keys = yield from db.scan(cursor, match=seen_keys_pattern, count=scan_count)
+        for key in keys:
+            expired = []
+            field_cursor = 0
+            while True:
+                field_cursor, sightings = yield from db.hscan(key, field_cursor, count=scan_count)
+                for field, data in sightings.items():
+                    try:
+                        timestamp = Sighting.decode(data).timestamp
+                    except (ValueError, TypeError):
+                        # an unreadable sighting is no use to lookups either
+                        timestamp = 0
+                    if timestamp < cutoff:
+                        expired.append(field)
+                if field_cursor == 0:
+                    break
+            # removed once the hash has been scanned, so removing them doesn't make the scan skip any
+            for start in range(0, len(expired), batch_size):
+                yield from db.hdel(key, *expired[start:start + batch_size])
+            removed += len(expired)
+        if cursor == 0:
+            break
+
+    if removed:
+        logger.info("Removed {} old seen sightings".format(removed))
+    return removed
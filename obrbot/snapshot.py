@@ -0,0 +1,272 @@
+import asyncio
+import json
+import logging
+import time
+import zlib
+
+from obrbot.database import DatabaseError
+
+logger = logging.getLogger("obrbot")
+
+# the latest snapshot of a connection's channels
+snapshot_key = "obrbot:connections:{}:snapshot"
+
+SNAPSHOT_VERSION = 1
+
+
+def encode_snapshot(taken_at, channels):
+    """
+    Encodes the state of a connection's channels. Each user is stored once however many channels they're in, and the
+    whole snapshot is compressed, since most of it is nicks and hosts which repeat.
+    :param taken_at: When the state was captured
+    :param channels: The channels to encode
+    :type taken_at: float
+    :type channels: collections.abc.Iterable[obrbot.connection.Channel]
+    :rtype: bytes
+    """
+    users = []
+    user_indexes = {}
+    encoded_channels = []
+    for channel in channels:
+        members = []
+        for membership in channel.users.values():
+            user = membership.user
+            index = user_indexes.get(id(user))
+            if index is None:
+                index = user_indexes[id(user)] = len(users)
+                users.append([user.nick, user.ident, user.host, user.account])
+            members.append([index, membership.mode])
+        lists = {mode: [[mask, setter, set_at] for mask, (setter, set_at) in entries.items()]
+                 for mode, entries in channel.lists.items()}
+        encoded_channels.append([channel.name, channel.topic, channel.modes, lists, members])
+    data = json.dumps([SNAPSHOT_VERSION, taken_at, users, encoded_channels], separators=(",", ":"))
+    return zlib.compress(data.encode("utf-8"))
+
+
+def decode_snapshot(data):
+    """
+    Decodes a snapshot into when it was taken, and a ChannelState for each channel in it
+    :type data: bytes
+    :rtype: (float, list[ChannelState])
+    """
+    version, taken_at, users, channels = json.loads(zlib.decompress(data).decode("utf-8"))
+    if version != SNAPSHOT_VERSION:
+        raise ValueError("Unknown snapshot version {}".format(version))
+    states = []
+    for name, topic, modes, lists, members in channels:
+        lists = {mode: {mask: (setter, set_at) for mask, setter, set_at in entries} for mode, entries in lists.items()}
+        states.append(ChannelState(name, topic, modes, lists, [tuple(users[index]) + (mode,)
+                                                                for index, mode in members]))
+    return taken_at, states
+
+
+class ChannelState:
+    """
+    A channel as it was when a snapshot was taken
+    :type name: str
+    :type topic: str
+    :type modes: dict[str, str | None]
+    :type lists: dict[str, dict[str, (str, float)]]
+    :type members: list[(str, str, str, str, str)]
+    """
+    __slots__ = ['name', 'topic', 'modes', 'lists', 'members']
+
+    def __init__(self, name, topic, modes, lists, members):
+        """
+        :param members: (nick, ident, host, account, mode) for each user in the channel
+        :type name: str
+        :type topic: str
+        :type modes: dict[str, str | None]
+        :type lists: dict[str, dict[str, (str, float)]]
+        :type members: list[(str, str, str, str, str)]
+        """
+        self.name = name
+        self.topic = topic
+        self.modes = modes
+        self.lists = lists
+        self.members = members
+
+
+class StateSnapshotter:
+    """
+    Saves the state of a connection's channels, their users, masks, modes and topics, so that it's there straight away
+    when they're rejoined after a restart or reconnect, instead of only being rebuilt as NAMES replies arrive and users
+    speak.
+
+    Snapshots are written every `interval` seconds and when the bot stops. When we rejoin a channel, the state from the
+    snapshot is adopted provisionally, then reconciled with the channel's NAMES reply: anyone the reply doesn't list
+    is dropped, and the WHO sent after joining refreshes everyone's masks. Snapshots older than `max_age` are ignored.
+
+    :type conn: obrbot.connection.Connection
+    :type db: obrbot.database.Database
+    :type loop: asyncio.events.AbstractEventLoop
+    :type enabled: bool
+    :type interval: float
+    :type max_age: float
+    :type saves: int
+    :type adopted: int
+    :type errors: int
+    """
+
+    def __init__(self, conn, db, *, enabled=True, interval=60, max_age=600):
+        """
+        :param interval: Seconds between snapshots
+        :param max_age: Seconds after which a snapshot is too old to be used
+        :type conn: obrbot.connection.Connection
+        :type db: obrbot.database.Database
+        :type enabled: bool
+        :type interval: float
+        :type max_age: float
+        """
+        self.conn = conn
+        self.db = db
+        self.loop = conn.loop
+        self.enabled = enabled
+        self.interval = interval
+        self.max_age = max_age
+        self.key = snapshot_key.format(conn.name.lower())
+
+        # when the restored state was captured, and folded channel name -> ChannelState, waiting to be rejoined
+        self._restored_at = None
+        self._restored = {}
+        self._handle = None
+        self._task = None
+
+        self.saves = 0
+        self.adopted = 0
+        self.errors = 0
+
+    @property
+    def restored(self):
+        """
+        The number of channels whose state is waiting for us to rejoin them
+        :rtype: int
+        """
+        return len(self._restored)
+
+    def start(self):
+        if self.enabled and self.interval and self._handle is None:
+            self._handle = self.loop.call_later(self.interval, self._run)
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _run(self):
+        self._task = asyncio.async(self.save(), loop=self.loop)
+        self._task.add_done_callback(self._finished)
+
+    def _finished(self, task):
+        """
+        :type task: asyncio.Task
+        """
+        if task.cancelled():
+            return
+        self._task = None
+        if self._handle is not None:
+            self._handle = self.loop.call_later(self.interval, self._run)
+
+    def capture(self):
+        """
+        Keeps the current state of the connection's channels in memory, to be adopted when they're rejoined, such as
+        before reconnecting
+        """
+        if not self.enabled:
+            return
+        self._restore(time.time(), decode_snapshot(encode_snapshot(time.time(), self.conn.channels.values()))[1])
+
+    @asyncio.coroutine
+    def save(self):
+        """
+        Writes a snapshot of the connection's channels
+        """
+        if not self.enabled or not self.conn.channels:
+            return
+        data = encode_snapshot(time.time(), self.conn.channels.values())
+        try:
+            yield from self.db.set(self.key, data)
+        except DatabaseError as e:
+            self.errors += 1
+            logger.warning("[{}] Couldn't save channel snapshot: {}".format(self.conn.name, e))
+        else:
+            self.saves += 1
+            logger.debug("[{}] Saved snapshot of {} channels in {} bytes".format(self.conn.name,
+                                                                                len(self.conn.channels), len(data)))
+
+    @asyncio.coroutine
+    def load(self):
+        """
+        Reads the last snapshot written, if it isn't too old, to be adopted as channels are rejoined
+        """
+        if not self.enabled:
+            return
+        try:
+            data = yield from self.db.get(self.key)
+        except DatabaseError as e:
+            self.errors += 1
+            logger.warning("[{}] Couldn't load channel snapshot: {}".format(self.conn.name, e))
+            return
+        if data is None:
+            return
+        try:
+            taken_at, states = decode_snapshot(data)
+        except (ValueError, zlib.error) as e:
+            self.errors += 1
+            logger.warning("[{}] Ignoring unreadable channel snapshot: {}".format(self.conn.name, e))
+            return
+        age = time.time() - taken_at
+        if age > self.max_age:
+            logger.info("[{}] Ignoring channel snapshot from {:.0f} seconds ago".format(self.conn.name, age))
+            return
+        self._restore(taken_at, states)
+        logger.info("[{}] Loaded snapshot of {} channels from {:.0f} seconds ago".format(self.conn.name, len(states),
+                                                                                        age))
+
+    def _restore(self, taken_at, states):
+        """
+        :type taken_at: float
+        :type states: list[ChannelState]
+        """
+        self._restored_at = taken_at
+        self._restored = {self.conn.casemapping.fold(state.name): state for state in states}
+
+    def set_casemapping(self, casemapping):
+        """
+        Refolds the names of the channels waiting to be rejoined, after the server's casemapping changes
+        :type casemapping: obrbot.util.dictionaries.CaseMapping
+        """
+        self._restored = {casemapping.fold(state.name): state for state in self._restored.values()}
+
+    def clear(self):
+        """
+        Forgets any state which hasn't been adopted
+        """
+        self._restored.clear()
+
+    def adopt(self, channel):
+        """
+        Fills in a channel we've just joined from the snapshot, if there's one for it. The users are provisional until
+        the channel's NAMES reply confirms them.
+        :type channel: obrbot.connection.Channel
+        """
+        state = self._restored.pop(self.conn.casemapping.fold(channel.name), None)
+        if state is None:
+            return
+        if time.time() - self._restored_at > self.max_age:
+            self._restored.clear()
+            return
+        channel.topic = state.topic
+        channel.modes = dict(state.modes)
+        channel.lists = state.lists
+        for nick, ident, host, account, mode in state.members:
+            user = self.conn.users.add(nick, channel, ident=ident, host=host)
+            if user.account is None:
+                user.account = account
+            channel.add_provisional(nick, user, mode)
+        self.adopted += 1
+        logger.debug("[{}] Adopted {} users in {} from snapshot".format(self.conn.name, len(channel.unconfirmed),
+                                                                        channel.name))
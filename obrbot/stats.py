@@ -0,0 +1,304 @@
+import asyncio
+from collections import Counter
+import logging
+import time
+
+from obrbot.database import DatabaseError
+
+logger = logging.getLogger("obrbot")
+
+# channel names in keys are lowercased with str.lower(), like history keys, rather than folded by a casemapping, so
+# the same channel always has the same keys whichever casemapping its network announces
+
+# a hash of bucket start time to the number of messages in that bucket, for each resolution
+stats_counts_key = "obrbot:connections:{}:stats:{}:{}:messages"
+# a hyperloglog of the nicks who spoke in a bucket
+stats_speakers_key = "obrbot:connections:{}:stats:{}:{}:{}:speakers"
+# a sorted set of folded nick to number of messages in a day
+stats_talkers_key = "obrbot:connections:{}:stats:{}:day:{}:talkers"
+
+# bucket sizes, in seconds
+resolutions = {"minute": 60, "hour": 3600, "day": 86400}
+# the resolutions unique speakers are estimated at, as estimating them per minute wouldn't be useful
+speaker_resolutions = ("hour", "day")
+
+default_retention = {"minute": 2 * 86400, "hour": 90 * 86400, "day": 730 * 86400}
+
+TRIM_INTERVAL = 3600
+
+
+def bucket_start(timestamp, resolution):
+    """
+    :type timestamp: float
+    :type resolution: str
+    :rtype: int
+    """
+    size = resolutions[resolution]
+    return int(timestamp // size * size)
+
+
+class _PendingStats:
+    """
+    Activity in a channel which hasn't been written yet
+    :type counts: Counter
+    :type speakers: dict[(str, int), set[str]]
+    :type talkers: dict[int, Counter]
+    """
+    __slots__ = ['counts', 'speakers', 'talkers']
+
+    def __init__(self):
+        # (resolution, bucket start) -> messages
+        self.counts = Counter()
+        # (resolution, bucket start) -> lowercase nicks
+        self.speakers = {}
+        # day bucket start -> lowercase nick -> messages
+        self.talkers = {}
+
+
+class ChannelStats:
+    """
+    Keeps per-channel message counts in minute, hour and day buckets, estimates of the number of unique speakers in
+    each hour and day with hyperloglogs, and each day's top talkers.
+
+    Messages are counted in memory, and the aggregates are written in one pipeline every `interval` seconds, so
+    counting a message never waits on the database. Queries read the aggregates, never the history.
+
+    :type db: obrbot.database.Database
+    :type loop: asyncio.events.AbstractEventLoop
+    :type enabled: bool
+    :type interval: float
+    :type retention: dict[str, float]
+    :type messages_counted: int
+    :type flushes: int
+    :type errors: int
+    """
+
+    def __init__(self, db, loop, *, enabled=True, interval=10, retention=None):
+        """
+        :param interval: Seconds between writes of the aggregates
+        :param retention: Seconds to keep buckets of each resolution for
+        :type db: obrbot.database.Database
+        :type loop: asyncio.events.AbstractEventLoop
+        :type enabled: bool
+        :type interval: float
+        :type retention: dict[str, float]
+        """
+        self.db = db
+        self.loop = loop
+        self.enabled = enabled
+        self.interval = interval
+        self.retention = dict(default_retention, **(retention or {}))
+
+        # (connection, channel) -> _PendingStats
+        self._pending = {}
+        self._timer = None
+        self._flush_lock = asyncio.Lock(loop=loop)
+        # (connection, channel) -> when old buckets were last removed
+        self._last_trimmed = {}
+
+        self.messages_counted = 0
+        self.flushes = 0
+        self.errors = 0
+
+    def record(self, connection, channel, nick, timestamp=None):
+        """
+        Counts a message
+        :param nick: The nick who sent it, folded by the connection's casemapping
+        :type connection: str
+        :type channel: str
+        :type nick: str
+        :type timestamp: float
+        """
+        if not self.enabled:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        name = (connection.lower(), channel.lower())
+        pending = self._pending.get(name)
+        if pending is None:
+            pending = self._pending[name] = _PendingStats()
+
+        for resolution in resolutions:
+            bucket = (resolution, bucket_start(timestamp, resolution))
+            pending.counts[bucket] += 1
+            if resolution in speaker_resolutions:
+                pending.speakers.setdefault(bucket, set()).add(nick)
+        day = bucket_start(timestamp, "day")
+        pending.talkers.setdefault(day, Counter())[nick] += 1
+        self.messages_counted += 1
+
+        if self._timer is None:
+            self._timer = self.loop.call_later(self.interval, self._flush_soon)
+
+    def _flush_soon(self):
+        self._timer = None
+        asyncio.async(self.flush(), loop=self.loop)
+
+    @asyncio.coroutine
+    def flush(self):
+        """
+        Writes the aggregates of every message counted so far, and removes expired buckets from channels which haven't
+        been trimmed for a while
+        """
+        with (yield from self._flush_lock):
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+
+            pipeline = self.db.pipeline(transaction=False)
+            for (connection, channel), stats in pending.items():
+                for (resolution, bucket), count in stats.counts.items():
+                    pipeline.hincrby(stats_counts_key.format(connection, channel, resolution), bucket, count)
+                for (resolution, bucket), nicks in stats.speakers.items():
+                    pipeline.pfadd(stats_speakers_key.format(connection, channel, resolution, bucket), *nicks)
+                for day, talkers in stats.talkers.items():
+                    key = stats_talkers_key.format(connection, channel, day)
+                    for nick, count in talkers.items():
+                        pipeline.zincrby(key, nick, count)
+            try:
+                yield from pipeline.execute()
+            except (DatabaseError, ConnectionError, OSError) as e:
+                self.errors += 1
+                logger.warning("Couldn't write channel stats, will retry: {}".format(e))
+                self._requeue(pending)
+                return
+            self.flushes += 1
+
+            now = time.time()
+            for name in pending:
+                if now - self._last_trimmed.get(name, 0) >= TRIM_INTERVAL:
+                    self._last_trimmed[name] = now
+                    try:
+                        yield from self.trim(*name)
+                    except (DatabaseError, ConnectionError, OSError) as e:
+                        logger.warning("Couldn't remove old stats for {}: {}".format(name, e))
+
+    def _requeue(self, pending):
+        """
+        Merges stats from a failed write back in with anything counted since
+        :type pending: dict[(str, str), _PendingStats]
+        """
+        for name, stats in pending.items():
+            current = self._pending.get(name)
+            if current is None:
+                self._pending[name] = stats
+                continue
+            current.counts.update(stats.counts)
+            for bucket, nicks in stats.speakers.items():
+                current.speakers.setdefault(bucket, set()).update(nicks)
+            for day, talkers in stats.talkers.items():
+                current.talkers.setdefault(day, Counter()).update(talkers)
+        if self._timer is None:
+            self._timer = self.loop.call_later(self.interval, self._flush_soon)
+
+    @asyncio.coroutine
+    def trim(self, connection, channel):
+        """
+        Removes a channel's buckets which are older than their resolution's retention
+        :type connection: str
+        :type channel: str
+        """
+        connection, channel = connection.lower(), channel.lower()
+        now = time.time()
+        for resolution in resolutions:
+            key = stats_counts_key.format(connection, channel, resolution)
+            cutoff = now - self.retention[resolution]
+            buckets = yield from self.db.hgetall(key)
+            expired = [bucket for bucket in buckets if int(bucket) < cutoff]
+            if not expired:
+                continue
+            pipeline = self.db.pipeline(transaction=False)
+            pipeline.hdel(key, *expired)
+            for bucket in expired:
+                if resolution in speaker_resolutions:
+                    pipeline.delete(stats_speakers_key.format(connection, channel, resolution, int(bucket)))
+                if resolution == "day":
+                    pipeline.delete(stats_talkers_key.format(connection, channel, int(bucket)))
+            yield from pipeline.execute()
+
+    @asyncio.coroutine
+    def message_counts(self, connection, channel, resolution, since, until=None):
+        """
+        Gets the number of messages in each bucket of a resolution between two times. Buckets without messages are
+        included, with a count of 0.
+        :type connection: str
+        :type channel: str
+        :type resolution: str
+        :type since: float
+        :type until: float
+        :return: (bucket start, messages) pairs, oldest first
+        :rtype: list[(int, int)]
+        """
+        yield from self.flush()
+        if until is None:
+            until = time.time()
+        size = resolutions[resolution]
+        counts = yield from self.db.hgetall(stats_counts_key.format(connection.lower(), channel.lower(), resolution))
+        counts = {int(bucket): int(count) for bucket, count in counts.items()}
+        return [(bucket, counts.get(bucket, 0))
+                for bucket in range(bucket_start(since, resolution), bucket_start(until, resolution) + 1, size)]
+
+    @asyncio.coroutine
+    def message_count(self, connection, channel, since, until=None):
+        """
+        Gets the number of messages between two times, to the minute
+        :type connection: str
+        :type channel: str
+        :type since: float
+        :type until: float
+        :rtype: int
+        """
+        counts = yield from self.message_counts(connection, channel, "minute", since, until)
+        return sum(count for bucket, count in counts)
+
+    @asyncio.coroutine
+    def unique_speakers(self, connection, channel, since, until=None):
+        """
+        Estimates the number of different nicks who spoke between two times, to the hour for up to two days, or to
+        the day for longer
+        :type connection: str
+        :type channel: str
+        :type since: float
+        :type until: float
+        :rtype: int
+        """
+        yield from self.flush()
+        if until is None:
+            until = time.time()
+        resolution = "hour" if until - since <= 2 * 86400 else "day"
+        size = resolutions[resolution]
+        keys = [stats_speakers_key.format(connection.lower(), channel.lower(), resolution, bucket)
+                for bucket in range(bucket_start(since, resolution), bucket_start(until, resolution) + 1, size)]
+        return (yield from self.db.pfcount(*keys))
+
+    @asyncio.coroutine
+    def top_talkers(self, connection, channel, since, until=None, *, count=5):
+        """
+        Gets the nicks who sent the most messages between two times, to the day
+        :type connection: str
+        :type channel: str
+        :type since: float
+        :type until: float
+        :type count: int
+        :return: (folded nick, messages) pairs, most messages first
+        :rtype: list[(str, int)]
+        """
+        yield from self.flush()
+        if until is None:
+            until = time.time()
+        pipeline = self.db.pipeline(transaction=False)
+        for day in range(bucket_start(since, "day"), bucket_start(until, "day") + 1, resolutions["day"]):
+            pipeline.zrange(stats_talkers_key.format(connection.lower(), channel.lower(), day), 0, -1,
+                            withscores=True, score_cast_func=int)
+        totals = Counter()
+        for talkers in (yield from pipeline.execute()):
+            for nick, messages in talkers:
+                totals[nick.decode("utf-8", "replace")] += messages
+        return totals.most_common(count)
+
+    @asyncio.coroutine
+    def close(self):
+        yield from self.flush()
@@ -0,0 +1,151 @@
+from collections import deque
+import itertools
+import json
+import os
+import random
+import time
+
+
+class Trace:
+    """
+    Timestamps for a single event, from the socket to the replies sent because of it.
+
+    Each entry in `events` is (name, start, end, args). Instants have an `end` of None. Timestamps are taken from
+    time.perf_counter().
+
+    :type trace_id: int
+    :type name: str
+    :type start: float
+    :type end: float
+    :type sampled: bool
+    :type events: list[(str, float, float, dict)]
+    """
+    __slots__ = ['trace_id', 'name', 'start', 'end', 'sampled', 'events']
+
+    def __init__(self, trace_id, name, start, sampled):
+        """
+        :type trace_id: int
+        :type name: str
+        :type start: float
+        :type sampled: bool
+        """
+        self.trace_id = trace_id
+        self.name = name
+        self.start = start
+        self.end = None
+        self.sampled = sampled
+        self.events = []
+
+    @property
+    def duration(self):
+        if self.end is None:
+            return time.perf_counter() - self.start
+        return self.end - self.start
+
+    def mark(self, name, timestamp=None, **args):
+        """
+        Records an instant
+        :type name: str
+        :type timestamp: float
+        """
+        if timestamp is None:
+            timestamp = time.perf_counter()
+        self.events.append((name, timestamp, None, args or None))
+
+    def span(self, name, start, end=None, **args):
+        """
+        Records something which started at `start` and finished at `end`, or now if `end` isn't given
+        :type name: str
+        :type start: float
+        :type end: float
+        """
+        if end is None:
+            end = time.perf_counter()
+        self.events.append((name, start, end, args or None))
+
+
+class Tracer:
+    """
+    Creates a Trace for each event, and keeps the most recent sampled traces, along with any trace slower than
+    `slow_threshold`, so they can be exported as Chrome trace-event JSON (viewable in chrome://tracing or Perfetto).
+
+    :type sample_rate: float
+    :type slow_threshold: float
+    :type traces: collections.deque[Trace]
+    """
+
+    def __init__(self, *, sample_rate=0.01, slow_threshold=1.0, max_traces=1000):
+        """
+        :param sample_rate: The fraction of traces to keep regardless of how long they took
+        :param slow_threshold: Seconds after which a trace is always kept, or 0 to only keep sampled traces
+        :param max_traces: How many traces to keep
+        :type sample_rate: float
+        :type slow_threshold: float
+        :type max_traces: int
+        """
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.traces = deque(maxlen=max_traces)
+        self._ids = itertools.count(1)
+
+    def start(self, name, timestamp=None):
+        """
+        :type name: str
+        :type timestamp: float
+        :rtype: Trace
+        """
+        if timestamp is None:
+            timestamp = time.perf_counter()
+        sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        return Trace(next(self._ids), name, timestamp, sampled)
+
+    def finish(self, trace):
+        """
+        Marks a trace as finished, keeping it if it was sampled or slow. Lines sent after this will still be recorded
+        in the trace.
+        :type trace: Trace
+        """
+        trace.end = time.perf_counter()
+        if trace.sampled or (self.slow_threshold and trace.end - trace.start >= self.slow_threshold):
+            self.traces.append(trace)
+
+    def export_chrome(self, traces=None):
+        """
+        Returns the given traces, or all kept traces, in Chrome trace-event format. Each trace is shown as its own
+        thread.
+        :type traces: collections.Iterable[Trace]
+        :rtype: dict
+        """
+        if traces is None:
+            traces = list(self.traces)
+        trace_events = []
+        for trace in traces:
+            trace_events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": trace.trace_id,
+                                 "args": {"name": "#{} {}".format(trace.trace_id, trace.name)}})
+            end = trace.end if trace.end is not None else trace.start
+            trace_events.append({"name": trace.name, "cat": "event", "ph": "X", "pid": 1, "tid": trace.trace_id,
+                                 "ts": trace.start * 1000000, "dur": (end - trace.start) * 1000000})
+            for name, start, stop, args in trace.events:
+                if stop is None:
+                    trace_event = {"name": name, "cat": "mark", "ph": "i", "s": "t", "pid": 1, "tid": trace.trace_id,
+                                   "ts": start * 1000000}
+                else:
+                    trace_event = {"name": name, "cat": "span", "ph": "X", "pid": 1, "tid": trace.trace_id,
+                                   "ts": start * 1000000, "dur": (stop - start) * 1000000}
+                if args:
+                    trace_event["args"] = args
+                trace_events.append(trace_event)
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def write_chrome(self, path, traces=None):
+        """
+        Writes traces to a file in Chrome trace-event format. This does blocking IO, so coroutines should run it in an
+        executor.
+        :type path: str
+        :type traces: collections.Iterable[Trace]
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.export_chrome(traces), f)
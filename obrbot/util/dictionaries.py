@@ -1,43 +1,141 @@
+import string
+
+# folds uppercase to lowercase for each IRC CASEMAPPING. rfc1459 also treats []\~ as the uppercase versions of {}|^,
+# and strict-rfc1459 does the same without ~ and ^
+_casemapping_tables = {
+    "ascii": str.maketrans(string.ascii_uppercase, string.ascii_lowercase),
+    "rfc1459": str.maketrans(string.ascii_uppercase + "[]\\~", string.ascii_lowercase + "{}|^"),
+    "strict-rfc1459": str.maketrans(string.ascii_uppercase + "[]\\", string.ascii_lowercase + "{}|"),
+}
+
+DEFAULT_CASEMAPPING = "rfc1459"
+
+
+class CaseMapping:
+    """
+    Folds nicks and channel names to lowercase according to one of the IRC casemappings. Folded keys are cached, so
+    folding a nick or channel which is seen often doesn't create a new string each time.
+
+    Instances are shared, get them with get_casemapping().
+    :type name: str
+    :type max_cached: int
+    """
+    __slots__ = ['name', 'max_cached', 'cache', '_table']
+
+    def __init__(self, name, table, max_cached=50000):
+        """
+        :type name: str
+        :type table: dict[int, int]
+        :type max_cached: int
+        """
+        self.name = name
+        self.max_cached = max_cached
+        # key -> folded key
+        self.cache = {}
+        self._table = table
+
+    def fold(self, key):
+        """
+        :type key: str
+        :rtype: str
+        """
+        folded = self.cache.get(key)
+        if folded is None:
+            if key is None:
+                return None
+            folded = key.translate(self._table)
+            if len(self.cache) >= self.max_cached:
+                # most keys will be folded again soon after, so starting over is cheaper than tracking usage
+                self.cache.clear()
+            self.cache[key] = folded
+        return folded
+
+    def __repr__(self):
+        return "CaseMapping({!r})".format(self.name)
+
+
+_casemappings = {name: CaseMapping(name, table) for name, table in _casemapping_tables.items()}
+
+
+def get_casemapping(name):
+    """
+    Gets a casemapping by its ISUPPORT name, or rfc1459 if the name isn't known
+    :type name: str | CaseMapping
+    :rtype: CaseMapping
+    """
+    if isinstance(name, CaseMapping):
+        return name
+    return _casemappings.get(name.lower() if name else DEFAULT_CASEMAPPING, _casemappings[DEFAULT_CASEMAPPING])
+
+
 class CaseInsensitiveDict(dict):
     """
-    dict() -> new empty dictionary
-    dict(mapping) -> new dictionary initialized from a mapping object's
-        (key, value) pairs
-    dict(iterable) -> new dictionary initialized as if via:
-        d = {}
-        for k, v in iterable:
-            d[k] = v
-    dict(**kwargs) -> new dictionary initialized with the name=value pairs
-        in the keyword argument list.  For example:  dict(one=1, two=2)
+    A dict of nicks or channel names, which folds keys according to an IRC casemapping, rfc1459 by default.
+
+    Keys are stored folded, so iterating gives folded keys. Folding goes through the casemapping's cache, so looking
+    up a nick or channel doesn't allocate a new string.
+    :type casemapping: CaseMapping
     """
+    __slots__ = ['casemapping', '_folded', '_fold']
+
+    def __init__(self, *args, casemapping=DEFAULT_CASEMAPPING, **kwargs):
+        """
+        :type casemapping: str | CaseMapping
+        """
+        super().__init__()
+        self.casemapping = get_casemapping(casemapping)
+        self._folded = self.casemapping.cache
+        self._fold = self.casemapping.fold
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def rekey(self, casemapping, key_of=None):
+        """
+        Switches to a different casemapping, refolding the keys already stored. Stored keys are already folded, and
+        refolding one can't undo what the old casemapping folded, such as rfc1459 folding "[" to "{", which ascii
+        doesn't. So when the values know their original key, pass `key_of` to refold from that instead.
+        :param key_of: Gets the original key of a value, such as a Channel's name
+        :type casemapping: str | CaseMapping
+        :type key_of: (object) -> str
+        """
+        casemapping = get_casemapping(casemapping)
+        if casemapping is self.casemapping:
+            return
+        items = list(dict.items(self))
+        dict.clear(self)
+        self.casemapping = casemapping
+        self._folded = casemapping.cache
+        self._fold = casemapping.fold
+        for key, value in items:
+            self[key_of(value) if key_of is not None else key] = value
 
-    def get(self, k, d=None):  # real signature unknown; restored from __doc__
+    def get(self, k, d=None):
         """ D.get(k[,d]) -> D[k] if k in D, else d.  d defaults to None. """
-        return super().get(k.lower() if k is not None else k, d)
+        return dict.get(self, self._folded.get(k) or self._fold(k), d)
 
-    def pop(self, k, d=None):  # real signature unknown; restored from __doc__
+    def pop(self, k, d=None):
         """
         D.pop(k[,d]) -> v, remove specified key and return the corresponding value.
         If key is not found, d is returned if given, otherwise KeyError is raised
         """
-        return super().pop(k.lower() if k is not None else k, d)
+        return dict.pop(self, self._folded.get(k) or self._fold(k), d)
 
-    def setdefault(self, k, d=None):  # real signature unknown; restored from __doc__
+    def setdefault(self, k, d=None):
         """ D.setdefault(k[,d]) -> D.get(k,d), also set D[k]=d if k not in D """
-        return super().setdefault(k.lower() if k is not None else k, d)
+        return dict.setdefault(self, self._folded.get(k) or self._fold(k), d)
 
-    def __contains__(self, k):  # real signature unknown
+    def __contains__(self, k):
         """ True if D has a key k, else False. """
-        return super().__contains__(k.lower() if k is not None else k)
+        return dict.__contains__(self, self._folded.get(k) or self._fold(k))
 
-    def __delitem__(self, k):  # real signature unknown
+    def __delitem__(self, k):
         """ Delete self[key]. """
-        return super().__delitem__(k.lower() if k is not None else k)
+        return dict.__delitem__(self, self._folded.get(k) or self._fold(k))
 
-    def __getitem__(self, k):  # real signature unknown; restored from __doc__
+    def __getitem__(self, k):
         """ x.__getitem__(y) <==> x[y] """
-        return super().__getitem__(k.lower() if k is not None else k)
+        return dict.__getitem__(self, self._folded.get(k) or self._fold(k))
 
-    def __setitem__(self, k, v):  # real signature unknown
+    def __setitem__(self, k, v):
         """ Set self[key] to value. """
-        return super().__setitem__(k.lower() if k is not None else k, v)
+        return dict.__setitem__(self, self._folded.get(k) or self._fold(k), v)
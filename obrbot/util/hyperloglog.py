@@ -0,0 +1,85 @@
+import hashlib
+import math
+
+# 2 ** 12 one byte registers, for a standard error of about 1.6%
+PRECISION = 12
+REGISTERS = 1 << PRECISION
+HEADER = b"OHLL"
+
+_hash_bits = 64
+_alpha = 0.7213 / (1 + 1.079 / REGISTERS)
+
+
+def _hash(value):
+    """
+    :type value: bytes
+    :rtype: int
+    """
+    return int.from_bytes(hashlib.sha1(value).digest()[:8], "big")
+
+
+class HyperLogLog:
+    """
+    Estimates the number of distinct values added to it in constant memory, using the HyperLogLog algorithm: each
+    value's hash picks a register, which keeps the longest run of leading zeros seen in the rest of the hash.
+
+    Used by the databases which don't have redis's PFADD and PFCOUNT. The serialized form isn't compatible with
+    redis's.
+    """
+    __slots__ = ['registers']
+
+    def __init__(self, registers=None):
+        """
+        :type registers: bytearray
+        """
+        self.registers = registers if registers is not None else bytearray(REGISTERS)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        :type data: bytes
+        :rtype: HyperLogLog
+        :raises ValueError: If the data isn't a serialized HyperLogLog
+        """
+        if data[:len(HEADER)] != HEADER or len(data) != len(HEADER) + REGISTERS:
+            raise ValueError("Not a HyperLogLog")
+        return cls(bytearray(data[len(HEADER):]))
+
+    def to_bytes(self):
+        """
+        :rtype: bytes
+        """
+        return HEADER + bytes(self.registers)
+
+    def add(self, value):
+        """
+        :type value: bytes
+        :return: True if the estimate may have changed
+        :rtype: bool
+        """
+        hashed = _hash(value)
+        index = hashed >> (_hash_bits - PRECISION)
+        rest = hashed & ((1 << (_hash_bits - PRECISION)) - 1)
+        rank = _hash_bits - PRECISION - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+
+    def merge(self, other):
+        """
+        Makes this estimate the union of itself and another
+        :type other: HyperLogLog
+        """
+        self.registers = bytearray(max(pair) for pair in zip(self.registers, other.registers))
+
+    def count(self):
+        """
+        :rtype: int
+        """
+        estimate = _alpha * REGISTERS * REGISTERS / sum(2.0 ** -register for register in self.registers)
+        empty = self.registers.count(0)
+        if estimate <= 2.5 * REGISTERS and empty:
+            # linear counting is more accurate for small cardinalities
+            estimate = REGISTERS * math.log(REGISTERS / empty)
+        return int(round(estimate))
@@ -0,0 +1,140 @@
+from array import array
+from collections import namedtuple
+import sys
+import time
+
+from obrbot.event import EventType
+
+# a record read from a HistoryRing, made as it's read rather than stored
+HistoryRecord = namedtuple("HistoryRecord", ["type", "nick", "timestamp", "content", "target"])
+
+_event_types = list(EventType)
+
+
+class HistoryRing:
+    """
+    A fixed-capacity ring buffer of a channel's most recent events, which overwrites the oldest event once full.
+
+    Rather than a tuple and a datetime per event, each field is kept in its own preallocated array: timestamps as
+    floats, event types as bytes, and nicks interned, so a nick which speaks a lot is stored once. Records are only
+    made when they're read.
+
+    :type capacity: int
+    """
+    __slots__ = ['capacity', '_timestamps', '_types', '_nicks', '_contents', '_targets', '_start', '_size']
+
+    def __init__(self, capacity=100):
+        """
+        :param capacity: The most events to keep
+        :type capacity: int
+        """
+        if capacity < 1:
+            raise ValueError("A HistoryRing needs a capacity of at least 1, not {}".format(capacity))
+        self.capacity = capacity
+        self._timestamps = array('d', [0.0]) * capacity
+        self._types = array('B', [0]) * capacity
+        self._nicks = [None] * capacity
+        self._contents = [None] * capacity
+        self._targets = [None] * capacity
+        # the index of the oldest event, and how many events are stored
+        self._start = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        return self.records()
+
+    def append(self, event_type, nick, content=None, target=None, timestamp=None):
+        """
+        Adds an event, overwriting the oldest one if the ring is full
+        :param target: Who the event was done to, such as the nick kicked, or the new nick in a nick change
+        :param timestamp: When the event happened, defaulting to now
+        :type event_type: EventType
+        :type nick: str
+        :type content: str
+        :type target: str
+        :type timestamp: float
+        """
+        if self._size < self.capacity:
+            index = (self._start + self._size) % self.capacity
+            self._size += 1
+        else:
+            index = self._start
+            self._start = (self._start + 1) % self.capacity
+        self._timestamps[index] = time.time() if timestamp is None else timestamp
+        self._types[index] = event_type.value
+        self._nicks[index] = sys.intern(nick) if nick is not None else None
+        self._contents[index] = content
+        self._targets[index] = target
+
+    def _record(self, index):
+        """
+        :type index: int
+        :rtype: HistoryRecord
+        """
+        return HistoryRecord(_event_types[self._types[index]], self._nicks[index], self._timestamps[index],
+                             self._contents[index], self._targets[index])
+
+    def records(self, since=None, *, reverse=False, event_types=None, limit=None):
+        """
+        Yields the stored events as HistoryRecords, oldest first, making each record only as it's reached. Events added
+        while iterating may overwrite ones not yet reached, so take a list() first if anything could be added between
+        records, such as when iterating across a `yield from`.
+        :param since: Only yield events from this timestamp onwards
+        :param reverse: Yield the newest events first
+        :param event_types: Only yield events of these types
+        :param limit: The most records to yield
+        :type since: float
+        :type reverse: bool
+        :type event_types: collections.abc.Container[EventType]
+        :type limit: int
+        :rtype: collections.abc.Iterator[HistoryRecord]
+        """
+        if event_types is not None:
+            type_values = {event_type.value for event_type in event_types}
+        yielded = 0
+        offsets = range(self._size - 1, -1, -1) if reverse else range(self._size)
+        for offset in offsets:
+            if limit is not None and yielded >= limit:
+                return
+            index = (self._start + offset) % self.capacity
+            if since is not None and self._timestamps[index] < since:
+                if reverse:
+                    # everything older than this is before `since` too
+                    return
+                continue
+            if event_types is not None and self._types[index] not in type_values:
+                continue
+            yielded += 1
+            yield self._record(index)
+
+    def last(self, event_type=None):
+        """
+        Returns the newest event, or the newest event of a type, or None if there isn't one
+        :type event_type: EventType
+        :rtype: HistoryRecord
+        """
+        for record in self.records(reverse=True, event_types=None if event_type is None else (event_type,), limit=1):
+            return record
+        return None
+
+    def resize(self, capacity):
+        """
+        Changes the capacity, keeping as many of the newest events as will fit
+        :type capacity: int
+        """
+        records = list(self.records(reverse=True, limit=capacity))
+        self.__init__(capacity)
+        for record in reversed(records):
+            self.append(record.type, record.nick, record.content, record.target, record.timestamp)
+
+    def clear(self):
+        """
+        Removes every event, keeping the capacity
+        """
+        for index in range(self.capacity):
+            self._nicks[index] = self._contents[index] = self._targets[index] = None
+        self._start = 0
+        self._size = 0
@@ -0,0 +1,217 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import re
+
+logger = logging.getLogger("obrbot")
+
+
+class _Waiter:
+    """
+    A single wait_for() call, waiting for a message matching `regex`
+    :type nick: str
+    :type chan: str
+    :type key: (str, str)
+    :type regex: re.__Regex
+    :type future: asyncio.Future
+    :type deadline: float
+    """
+    __slots__ = ['nick', 'chan', 'key', 'regex', 'future', 'deadline']
+
+    def __init__(self, nick, chan, key, regex, future, deadline):
+        self.nick = nick
+        self.chan = chan
+        self.key = key
+        self.regex = regex
+        self.future = future
+        self.deadline = deadline
+
+
+class WaiterRegistry:
+    """
+    Holds the futures waiting for messages which match a regex, indexed by the nick and channel they're waiting on, so
+    each message only tests the waiters which could match it: those for its nick and channel, for its nick in any
+    channel, for its channel from anyone, and for anything at all.
+
+    Waiters with a timeout are kept in a heap ordered by deadline, with one timer scheduled for the earliest of them.
+    Waiters are removed as soon as their future is done, whether it matched, timed out or was cancelled by the caller.
+
+    :type loop: asyncio.events.AbstractEventLoop
+    :type casemapping: obrbot.util.dictionaries.CaseMapping
+    :type matched: int
+    :type timeouts: int
+    """
+
+    def __init__(self, loop, casemapping):
+        """
+        :type loop: asyncio.events.AbstractEventLoop
+        :type casemapping: obrbot.util.dictionaries.CaseMapping
+        """
+        self.loop = loop
+        self.casemapping = casemapping
+
+        # (folded nick or None, folded channel or None) -> waiters
+        self._waiters = {}
+        # (deadline, tiebreaker, waiter), for waiters with a timeout
+        self._deadlines = []
+        self._counter = itertools.count()
+        self._timer = None
+        self._timer_deadline = None
+        self._count = 0
+
+        # counters, for metrics
+        self.matched = 0
+        self.timeouts = 0
+
+    def __len__(self):
+        return self._count
+
+    def _key(self, nick, chan):
+        """
+        :type nick: str
+        :type chan: str
+        :rtype: (str, str)
+        """
+        return (self.casemapping.fold(nick) if nick is not None else None,
+                self.casemapping.fold(chan) if chan is not None else None)
+
+    def add(self, message, nick=None, chan=None, *, timeout=None):
+        """
+        Waits for a message matching a regex, from `nick` and in `chan` if given
+        :param message: The regex to search messages for
+        :param timeout: Seconds to wait before the future fails with asyncio.TimeoutError, or None to wait forever
+        :type message: str | re.__Regex
+        :type nick: str
+        :type chan: str
+        :type timeout: float
+        :return: A future resolved with the match object
+        :rtype: asyncio.Future
+        """
+        if not hasattr(message, "search"):
+            message = re.compile(message)
+        future = asyncio.Future(loop=self.loop)
+        deadline = self.loop.time() + timeout if timeout is not None else None
+        waiter = _Waiter(nick, chan, self._key(nick, chan), message, future, deadline)
+        self._waiters.setdefault(waiter.key, []).append(waiter)
+        self._count += 1
+        future.add_done_callback(lambda f: self._remove(waiter))
+        if deadline is not None:
+            heapq.heappush(self._deadlines, (deadline, next(self._counter), waiter))
+            self._schedule()
+        return future
+
+    def cancel(self, message, nick=None, chan=None):
+        """
+        Cancels every waiter for a regex, nick and channel
+        :type message: str | re.__Regex
+        :type nick: str
+        :type chan: str
+        :return: The number of waiters cancelled
+        :rtype: int
+        """
+        pattern = message.pattern if hasattr(message, "pattern") else message
+        cancelled = 0
+        for waiter in list(self._waiters.get(self._key(nick, chan), ())):
+            if waiter.regex.pattern == pattern and waiter.future.cancel():
+                cancelled += 1
+        return cancelled
+
+    def cancel_all(self):
+        """
+        Cancels every waiter, such as when the connection is closed
+        """
+        for waiters in list(self._waiters.values()):
+            for waiter in list(waiters):
+                waiter.future.cancel()
+        self._deadlines.clear()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = self._timer_deadline = None
+
+    def _remove(self, waiter):
+        """
+        Removes a waiter whose future is done. Its deadline, if it has one, is left in the heap until it's reached.
+        :type waiter: _Waiter
+        """
+        waiters = self._waiters.get(waiter.key)
+        if waiters is None:
+            return
+        try:
+            waiters.remove(waiter)
+        except ValueError:
+            return
+        self._count -= 1
+        if not waiters:
+            del self._waiters[waiter.key]
+        # don't let the deadlines of finished waiters pile up when most waiters are matched long before they expire
+        if len(self._deadlines) > 64 and len(self._deadlines) > 2 * self._count:
+            self._deadlines = [entry for entry in self._deadlines if not entry[2].future.done()]
+            heapq.heapify(self._deadlines)
+
+    def _schedule(self):
+        """
+        Makes sure a timer is set for the earliest deadline
+        """
+        if not self._deadlines:
+            return
+        deadline = self._deadlines[0][0]
+        if self._timer is not None:
+            if self._timer_deadline <= deadline:
+                return
+            self._timer.cancel()
+        self._timer_deadline = deadline
+        self._timer = self.loop.call_at(deadline, self._expire)
+
+    def _expire(self):
+        """
+        Fails every waiter whose deadline has passed, then sets a timer for the next deadline
+        """
+        # the loop can run a timer up to its clock resolution early, so what the timer was set for counts as reached
+        now = max(self.loop.time(), self._timer_deadline)
+        self._timer = self._timer_deadline = None
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, _, waiter = heapq.heappop(self._deadlines)
+            if not waiter.future.done():
+                self.timeouts += 1
+                waiter.future.set_exception(asyncio.TimeoutError())
+        self._schedule()
+
+    def dispatch(self, nick, chan, content):
+        """
+        Resolves the waiters matched by a message
+        :type nick: str
+        :type chan: str
+        :type content: str
+        """
+        if not self._waiters:
+            return
+        folded_nick, folded_chan = self._key(nick, chan)
+        for key in ((folded_nick, folded_chan), (folded_nick, None), (None, folded_chan), (None, None)):
+            waiters = self._waiters.get(key)
+            if not waiters:
+                continue
+            # resolving a future only schedules its callbacks, so the list isn't changed while it's walked
+            for waiter in waiters:
+                if waiter.future.done():
+                    continue
+                try:
+                    match = waiter.regex.search(content)
+                except Exception as exc:
+                    waiter.future.set_exception(exc)
+                else:
+                    if match:
+                        self.matched += 1
+                        waiter.future.set_result(match)
+
+    def set_casemapping(self, casemapping):
+        """
+        Refolds the nicks and channels waited on, after the server's casemapping changes
+        :type casemapping: obrbot.util.dictionaries.CaseMapping
+        """
+        self.casemapping = casemapping
+        waiters = [waiter for bucket in self._waiters.values() for waiter in bucket]
+        self._waiters = {}
+        for waiter in waiters:
+            waiter.key = self._key(waiter.nick, waiter.chan)
+            self._waiters.setdefault(waiter.key, []).append(waiter)
@@ -0,0 +1,309 @@
+from collections import deque
+import linecache
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from obrbot.metrics import Histogram, format_duration
+from obrbot.util.bucket import TokenBucket
+
+logger = logging.getLogger("obrbot")
+# slow hook reports go to their own log file, see obrbot/__init__.py
+slow_hook_logger = logging.getLogger("obrbot.slow_hooks")
+
+
+def describe_event(event):
+    """
+    Returns a short, single-line description of an event, for use in logs
+    :type event: obrbot.event.Event
+    :rtype: str
+    """
+    if event.conn is None:
+        return "{} event".format(event.type.name)
+    location = event.conn.name
+    if event.chan_name is not None:
+        location = "{}:{}".format(location, event.chan_name)
+    content = event.content
+    if content is not None and len(content) > 100:
+        content = content[:100] + "..."
+    return "[{}] {} from {}: {!r}".format(location, event.type.name, event.nick, content)
+
+
+def _format_frames(frames):
+    """
+    :type frames: list[frame]
+    :rtype: list[str]
+    """
+    lines = []
+    for frame in frames:
+        filename = frame.f_code.co_filename
+        lines.append('  File "{}", line {}, in {}\n'.format(filename, frame.f_lineno, frame.f_code.co_name))
+        source = linecache.getline(filename, frame.f_lineno, frame.f_globals).strip()
+        if source:
+            lines.append("    {}\n".format(source))
+    return lines
+
+
+def coroutine_stack(coroutine):
+    """
+    Returns the formatted stack of a suspended coroutine, following the chain of `yield from`s as far as the
+    running Python version allows.
+    :type coroutine: collections.Iterator
+    :rtype: list[str]
+    """
+    frames = []
+    while coroutine is not None:
+        frame = getattr(coroutine, "gi_frame", None) or getattr(coroutine, "cr_frame", None)
+        if frame is None:
+            break
+        frames.append(frame)
+        coroutine = getattr(coroutine, "gi_yieldfrom", None) or getattr(coroutine, "cr_await", None)
+    return _format_frames(frames)
+
+
+def thread_stack(thread_id):
+    """
+    Returns the formatted stack of the thread with the given ident, or None if the thread doesn't exist
+    :type thread_id: int
+    :rtype: list[str]
+    """
+    frame = sys._current_frames().get(thread_id)
+    if frame is None:
+        return None
+    return traceback.format_stack(frame)
+
+
+class HookWatchdog:
+    """
+    Periodically checks all running hooks, and logs the stack of any which have been running for longer than
+    `threshold` seconds to the slow hook log. Each run is reported at most once, and reports are rate-limited with a
+    token bucket, so this is cheap enough to leave on permanently.
+
+    :type loop: asyncio.events.AbstractEventLoop
+    :type threshold: float
+    :type interval: float
+    :type running: set[obrbot.metrics.HookRun]
+    :type suppressed: int
+    """
+
+    def __init__(self, loop, *, threshold=5.0, interval=1.0, report_burst=5, reports_per_minute=6):
+        """
+        :param threshold: Seconds a hook may run for before it's reported, or 0 to disable the watchdog
+        :param interval: Seconds between checks
+        :param report_burst: How many reports may be written in a burst
+        :param reports_per_minute: How many reports may be written per minute after a burst
+        :type loop: asyncio.events.AbstractEventLoop
+        :type threshold: float
+        :type interval: float
+        :type report_burst: int
+        :type reports_per_minute: float
+        """
+        self.loop = loop
+        self.threshold = threshold
+        self.interval = interval
+        self.running = set()
+        self.suppressed = 0
+        self._bucket = TokenBucket(report_burst, reports_per_minute / 60)
+        self._handle = None
+
+    @property
+    def enabled(self):
+        return bool(self.threshold)
+
+    def start(self):
+        if self.enabled and self._handle is None:
+            self._handle = self.loop.call_later(self.interval, self._check)
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def watch(self, run):
+        """
+        :type run: obrbot.metrics.HookRun
+        """
+        if self.enabled:
+            self.running.add(run)
+
+    def unwatch(self, run):
+        """
+        :type run: obrbot.metrics.HookRun
+        """
+        self.running.discard(run)
+        if run.reported:
+            slow_hook_logger.warning("Hook {} finished after {}".format(run.hook.description,
+                                                                        format_duration(run.elapsed)))
+
+    def _check(self):
+        try:
+            for run in list(self.running):
+                if not run.reported and run.elapsed >= self.threshold:
+                    run.reported = True
+                    self.report(run)
+        except Exception:
+            logger.exception("Error checking for slow hooks")
+        finally:
+            self._handle = self.loop.call_later(self.interval, self._check)
+
+    def report(self, run):
+        """
+        Writes the current stack of a running hook to the slow hook log
+        :type run: obrbot.metrics.HookRun
+        """
+        if not self._bucket.consume(1):
+            self.suppressed += 1
+            return
+
+        if run.thread_id is not None:
+            kind = "threaded"
+            stack = thread_stack(run.thread_id)
+        elif run.coroutine is not None:
+            kind = "coroutine"
+            stack = coroutine_stack(run.coroutine)
+        else:
+            # still in sieves, or waiting on a lock or executor thread
+            kind = "waiting"
+            stack = None
+
+        lines = ["Hook {} ({}) has been running for {} on {}".format(
+            run.hook.description, kind, format_duration(run.elapsed), describe_event(run.event))]
+        if self.suppressed:
+            lines.append("({} earlier reports were suppressed by rate limiting)".format(self.suppressed))
+            self.suppressed = 0
+        if stack:
+            lines.append("Stack (most recent call last):")
+            lines.append("".join(stack).rstrip("\n"))
+        else:
+            lines.append("No stack available (sieve {}, wait {})".format(format_duration(run.sieve),
+                                                                       format_duration(run.wait)))
+        slow_hook_logger.warning("\n".join(lines))
+        logger.warning("Hook {} has been running for {}, see slow_hooks.log".format(
+            run.hook.description, format_duration(run.elapsed)))
+
+
+class LoopLagMonitor:
+    """
+    Measures event loop lag by scheduling a callback every `interval` seconds, and recording how late it runs.
+
+    A background thread also checks that these callbacks keep running. If the loop hasn't run one for `threshold`
+    seconds past when it was due, the loop is blocked, and the loop thread's stack is logged while it is still blocked,
+    showing which callback is holding it up.
+
+    :type loop: asyncio.events.AbstractEventLoop
+    :type interval: float
+    :type threshold: float
+    :type histogram: Histogram
+    :type stalls: int
+    """
+
+    def __init__(self, loop, *, interval=0.25, threshold=0.1, window=60, window_count=5, slow_callback_debug=False):
+        """
+        :param interval: Seconds between lag samples, or 0 to disable the monitor
+        :param threshold: Lag, in seconds, above which the loop is considered blocked
+        :param window: Seconds covered by each rolling histogram window
+        :param window_count: Number of windows kept for the rolling histogram
+        :param slow_callback_debug: Whether to turn on asyncio's debug mode, which logs every slow callback by name
+        :type loop: asyncio.events.AbstractEventLoop
+        :type interval: float
+        :type threshold: float
+        :type window: float
+        :type window_count: int
+        :type slow_callback_debug: bool
+        """
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+        self.window = window
+        self.slow_callback_debug = slow_callback_debug
+        # lag over the whole lifetime of the bot
+        self.histogram = Histogram()
+        # the number of times the loop has been blocked for longer than the threshold
+        self.stalls = 0
+        self._windows = deque(maxlen=window_count)
+        self._window_start = time.monotonic()
+        self._windows.append(Histogram())
+
+        self._handle = None
+        self._expected = None
+        self._loop_thread_id = None
+        self._stopped = threading.Event()
+        self._thread = None
+        self._bucket = TokenBucket(5, 0.1)
+
+    @property
+    def enabled(self):
+        return bool(self.interval)
+
+    def start(self):
+        """
+        Starts monitoring. Must be called from the event loop's thread.
+        """
+        if not self.enabled or self._handle is not None:
+            return
+        if self.slow_callback_debug:
+            self.loop.set_debug(True)
+            self.loop.slow_callback_duration = self.threshold
+        self._loop_thread_id = threading.get_ident()
+        self._expected = time.monotonic() + self.interval
+        self._handle = self.loop.call_later(self.interval, self._tick)
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._watch, name="loop-lag-monitor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._stopped.set()
+
+    def rolling(self):
+        """
+        Returns a histogram of the lag recorded in the last `window * window_count` seconds
+        :rtype: Histogram
+        """
+        result = Histogram()
+        for histogram in self._windows:
+            result.merge(histogram)
+        return result
+
+    def _tick(self):
+        now = time.monotonic()
+        lag = now - self._expected
+
+        self.histogram.record(lag)
+        if now - self._window_start >= self.window:
+            self._window_start = now
+            self._windows.append(Histogram())
+        self._windows[-1].record(lag)
+
+        if lag >= self.threshold:
+            self.stalls += 1
+            logger.warning("Event loop lagged by {}".format(format_duration(lag)))
+
+        self._expected = now + self.interval
+        self._handle = self.loop.call_later(self.interval, self._tick)
+
+    def _watch(self):
+        """
+        Runs in a background thread, logging the loop thread's stack when the loop is blocked.
+        """
+        reported = None
+        while not self._stopped.wait(self.threshold / 2):
+            expected = self._expected
+            if expected == reported:
+                continue  # we've already reported this stall
+            blocked_for = time.monotonic() - expected
+            if blocked_for < self.threshold:
+                continue
+            reported = expected
+            if not self._bucket.consume(1):
+                continue
+            stack = thread_stack(self._loop_thread_id)
+            if stack is None:
+                continue
+            slow_hook_logger.warning("Event loop has been blocked for {}\nStack (most recent call last):\n{}".format(
+                format_duration(blocked_for), "".join(stack).rstrip("\n")))
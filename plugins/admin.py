@@ -158,7 +158,8 @@ def remove_permission_user(text, bot, conn, notice, reply):
             reply("No masks with elevated permissions matched {}".format(group, user))
 
     if changed:
-        bot.config.save_config()
+        # writing the config is blocking IO, so keep it off the event loop
+        yield from bot.loop.run_in_executor(None, bot.config.save_config)
         permission_manager.reload()
 
 
@@ -200,7 +201,8 @@ def add_permissions_user(text, conn, bot, notice, reply):
         reply("Group {} created with user {}".format(group, user))
 
     if changed:
-        bot.config.save_config()
+        # writing the config is blocking IO, so keep it off the event loop
+        yield from bot.loop.run_in_executor(None, bot.config.save_config)
         permission_manager.reload()
 
 
@@ -0,0 +1,106 @@
+import asyncio
+
+from obrbot import hook, history
+from obrbot.database import DatabaseError
+from obrbot.history import parse_history_key
+from obrbot.metrics import format_duration
+
+plugin_info = {
+    "plugin_category": "core",
+    "command_category_name": "Administration"
+}
+
+
+def format_bytes(size):
+    """
+    :type size: int
+    :rtype: str
+    """
+    if size < 1024:
+        return "{}B".format(size)
+    for unit in ("KiB", "MiB", "GiB"):
+        size /= 1024
+        if size < 1024 or unit == "GiB":
+            return "{:.1f}{}".format(size, unit)
+
+
+@asyncio.coroutine
+@hook.command("historystats", permissions=["bot.manage"], autohelp=False)
+def history_stats(text, bot, conn, notice):
+    """[count] - lists the [count] largest channel histories on this connection, and history compaction stats
+    :type text: str
+    :type bot: obrbot.bot.ObrBot
+    :type conn: obrbot.connection.Connection
+    """
+    text = text.strip()
+    if text and not text.isdigit():
+        notice("Count must be a number")
+        return
+    count = int(text) if text else 5
+
+    sizes = []
+    cursor = 0
+    backend = bot.history_backend
+    pattern = backend.key(conn.name, "*")
+    while True:
+        cursor, keys = yield from bot.db.scan(cursor, match=pattern, count=100)
+        if keys:
+            pipeline = bot.db.pipeline(transaction=False)
+            for key in keys:
+                if backend.name == "stream":
+                    pipeline.xlen(key)
+                else:
+                    pipeline.zcard(key)
+                pipeline.memory_usage(key)
+            replies = yield from pipeline.execute(raise_on_error=False)
+            for index, key in enumerate(keys):
+                entries, memory = replies[index * 2], replies[index * 2 + 1]
+                if isinstance(memory, DatabaseError):
+                    # MEMORY USAGE needs redis 4.0
+                    memory = None
+                sizes.append((entries, memory, parse_history_key(key)[1]))
+        if cursor == 0:
+            break
+
+    if not sizes:
+        notice("No history is stored for {}.".format(conn.name))
+    else:
+        sizes.sort(reverse=True, key=lambda size: size[0])
+        notice("{} channels have history, with {} entries in total. Largest:".format(
+            len(sizes), sum(size[0] for size in sizes)))
+        for entries, memory, channel in sizes[:count]:
+            if memory is None:
+                notice("{}: {} entries".format(channel, entries))
+            else:
+                notice("{}: {} entries, {}".format(channel, entries, format_bytes(memory)))
+
+    compactor = bot.history_compactor
+    if not compactor.enabled:
+        notice("History compaction is disabled.")
+    elif compactor.runs:
+        notice("History compaction has run {} times, removing {} entries. Last run removed {} in {}.".format(
+            compactor.runs, compactor.removed, compactor.last_removed, format_duration(compactor.last_duration)))
+    else:
+        notice("History compaction hasn't run yet.")
+
+
+@asyncio.coroutine
+@hook.command("compacthistory", permissions=["bot.manage"], autohelp=False)
+def compact_history(bot, notice):
+    """- trims all channel histories to their retention limits now
+    :type bot: obrbot.bot.ObrBot
+    """
+    notice("Compacting history...")
+    removed = yield from bot.history_compactor.compact()
+    notice("Removed {} old history entries.".format(removed))
+
+
+@asyncio.coroutine
+@hook.command("migratehistory", permissions=["bot.manage"], autohelp=False)
+def migrate_history(bot, notice):
+    """- converts channel history stored in the old text format to the compact record format
+    :type bot: obrbot.bot.ObrBot
+    """
+    notice("Migrating history...")
+    keys, records = yield from history.migrate_history(bot.db)
+    notice("Converted {} records in {} channels.".format(records, keys))
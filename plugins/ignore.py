@@ -33,7 +33,7 @@ def ignore_sieve(event, hook_event):
     if hook_event.hook.type is HookType.command and hook_event.hook.function_name == 'unignore':
         return event
 
-    ignore_list = yield from event.async(bot.db.smembers, 'plugins:ignore:ignored')
+    ignore_list = yield from bot.db.smembers('plugins:ignore:ignored')
 
     mask = event.mask.lower()
     for pattern in ignore_list:
@@ -52,10 +52,12 @@ def ignore_sieve(event, hook_event):
 
 @asyncio.coroutine
 @hook.command(autohelp=False, permissions=['ignored.view'])
-def ignored(notice, async, db):
-    """- lists all channels and users I'm ignoring"""
+def ignored(notice, db):
+    """- lists all channels and users I'm ignoring
+    :type db: obrbot.database.Database
+    """
 
-    ignore_list = yield from async(db.smembers, 'plugins:ignore:ignored')
+    ignore_list = yield from db.smembers('plugins:ignore:ignored')
     if ignore_list:
         notice("Ignored users: {}".format(", ".join(b.decode() for b in ignore_list)))
     else:
@@ -65,15 +67,15 @@ def ignored(notice, async, db):
 
 @asyncio.coroutine
 @hook.command(permissions=['ignored.manage'])
-def ignore(text, async, db):
+def ignore(text, db):
     """<nick|user-mask> - adds <channel|nick> to my ignore list
-    :type db: redis.StrictRedis
+    :type db: obrbot.database.Database
     """
     target = text.lower()
     if ('!' not in target or '@' not in target) and not target.startswith('#'):
         target = '{}!*@*'.format(target)
 
-    added = yield from async(db.sadd, 'plugins:ignore:ignored', target)
+    added = yield from db.sadd('plugins:ignore:ignored', target)
 
     if added > 0:
         return "{} has been ignored.".format(target)
@@ -83,15 +85,15 @@ def ignore(text, async, db):
 
 @asyncio.coroutine
 @hook.command(permissions=['ignored.manage'])
-def unignore(text, async, db):
+def unignore(text, db):
     """<nick|user-mask> - removes <nick|user-mask> from my ignore list
-    :type db: redis.StrictRedis
+    :type db: obrbot.database.Database
     """
     target = text.lower()
     if ('!' not in target or '@' not in target) and not target.startswith('#'):
         target = '{}!*@*'.format(target)
 
-    removed = yield from async(db.srem, 'plugins:ignore:ignored', target)
+    removed = yield from db.srem('plugins:ignore:ignored', target)
 
     if removed > 0:
         return "{} has been unignored.".format(target)
@@ -32,23 +32,38 @@ def onjoin(conn):
                              log_hide=nickserv_password)
             yield from asyncio.sleep(1)
 
-    # Set bot modes
-    mode = conn.config.get('mode')
-    if mode:
-        logger.info("Setting bot mode: '{}'".format(mode))
-        conn.cmd('MODE', conn.bot_nick, mode)
+    set_modes(conn)
 
-    # Join config-defined channels
+    # Join config-defined channels, the connection sends them in as few JOIN lines as the server allows
     logger.info("Joining channels.")
     for channel in conn.config.get('channels', []):
         conn.join(channel)
-        yield from asyncio.sleep(0.5)
 
     logger.info("Startup complete.")
 
 
+# A connection adopted after a restart is still identified and in its channels, so only needs its modes set again
+@hook.irc_raw('CONNECTED')
+def onadopt(conn):
+    """
+    :type conn: obrbot.clients.irc.IrcConnection
+    """
+    set_modes(conn)
+    logger.info("Adopted connection set up.")
+
+
+def set_modes(conn):
+    """
+    :type conn: obrbot.clients.irc.IrcConnection
+    """
+    mode = conn.config.get('mode')
+    if mode:
+        logger.info("Setting bot mode: '{}'".format(mode))
+        conn.cmd('MODE', conn.bot_nick, mode)
+
+
 @asyncio.coroutine
-@hook.irc_raw('004')
+@hook.irc_raw('004', 'CONNECTED')
 def keep_alive(conn):
     """
     :type conn: obrbot.clients.irc.IrcConnection
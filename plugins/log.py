@@ -137,6 +137,9 @@ def format_irc_event(event, args):
         return None
     elif event.irc_command == "PING":
         return None
+    elif event.irc_raw is None:
+        # dispatched by the bot itself, rather than sent by the server
+        return None
 
     # Format using the default raw format
 
@@ -218,7 +221,7 @@ def log_raw(event):
     :type event: obrbot.event.IrcEvent
     """
     logging_config = event.bot.config.get('logging', {})
-    if not logging_config.get("raw_file_log", False):
+    if not logging_config.get("raw_file_log", False) or event.irc_raw is None:
         return
 
     get_raw_log_stream(event.conn.name).write(event.irc_raw + "\n")
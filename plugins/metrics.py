@@ -0,0 +1,75 @@
+import asyncio
+import os
+import time
+
+from obrbot import hook
+import obrbot
+from obrbot.metrics import sort_keys, format_duration
+
+plugin_info = {
+    "plugin_category": "core",
+    "command_category_name": "Administration"
+}
+
+
+@asyncio.coroutine
+@hook.command("hookstats", permissions=["bot.manage"], autohelp=False)
+def hook_stats(text, bot, notice):
+    """[count] [p50|p99|max|mean|calls|errors] - lists the [count] slowest hooks, sorted by p99 latency by default
+    :type text: str
+    :type bot: obrbot.bot.ObrBot
+    """
+    count = 5
+    key = "p99"
+    for arg in text.lower().split():
+        if arg.isdigit():
+            count = int(arg)
+        elif arg in sort_keys:
+            key = arg
+        else:
+            notice("Unknown argument '{}'. Valid sort keys are: {}".format(arg, ", ".join(sort_keys)))
+            return
+
+    top = bot.plugin_manager.hook_metrics.top(count, key)
+    if not top:
+        notice("No hooks have been run yet.")
+        return
+
+    notice("Top {} hooks by {}:".format(len(top), key))
+    for stats in top:
+        notice(stats.summary())
+
+
+@asyncio.coroutine
+@hook.command("looplag", permissions=["bot.manage"], autohelp=False)
+def loop_lag(bot, notice):
+    """- shows how far behind schedule the event loop has been running
+    :type bot: obrbot.bot.ObrBot
+    """
+    monitor = bot.loop_monitor
+    if not monitor.enabled:
+        notice("Loop lag monitoring is disabled.")
+        return
+
+    for name, histogram in (("Recent", monitor.rolling()), ("Overall", monitor.histogram)):
+        notice("{} loop lag: {} samples - p50 {}, p99 {}, max {}".format(
+            name, histogram.count, format_duration(histogram.percentile(50)),
+            format_duration(histogram.percentile(99)), format_duration(histogram.max)))
+    notice("Loop blocked for over {} {} times.".format(format_duration(monitor.threshold), monitor.stalls))
+
+
+@asyncio.coroutine
+@hook.command("tracedump", permissions=["bot.manage"], autohelp=False)
+def trace_dump(bot, notice):
+    """- writes recent sampled and slow event traces to a Chrome trace-event JSON file
+    :type bot: obrbot.bot.ObrBot
+    """
+    traces = list(bot.tracer.traces)
+    if not traces:
+        notice("No traces have been recorded yet.")
+        return
+
+    file_name = time.strftime("trace_%Y%m%d_%H%M%S.json", time.gmtime())
+    path = os.path.join(obrbot.log_dir, "traces", file_name)
+    yield from bot.loop.run_in_executor(None, bot.tracer.write_chrome, path, traces)
+    notice("Wrote {} traces to {}".format(len(traces), path))
@@ -0,0 +1,74 @@
+import asyncio
+import datetime
+import re
+import time
+
+from obrbot import hook
+from obrbot.event import EventType
+
+plugin_info = {
+    "plugin_category": "core",
+    "command_category_name": "Informational"
+}
+
+since_re = re.compile(r"^(\d+)([mhdw])$", re.IGNORECASE)
+since_units = {"m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+max_results = 5
+
+
+def format_record(record):
+    """
+    :param record: A history record, as (timestamp, EventType, nickname, other data)
+    :type record: tuple
+    :rtype: str
+    """
+    timestamp, event_type, nick = record[:3]
+    when = datetime.datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M")
+    if event_type is EventType.action:
+        return "[{}] * {} {}".format(when, nick, record[-1])
+    elif event_type is EventType.topic:
+        return "[{}] {} changed the topic to: {}".format(when, nick, record[-1])
+    return "[{}] <{}> {}".format(when, nick, record[-1])
+
+
+@asyncio.coroutine
+@hook.command("grep")
+def grep(text, bot, conn, nick, notice):
+    """<channel> <terms> [since] - finds messages in <channel> with all of <terms>, only since [since] if given, e.g. 7d
+    :type text: str
+    :type bot: obrbot.bot.ObrBot
+    :type conn: obrbot.connection.Connection
+    :type nick: str
+    """
+    split = text.split()
+    if len(split) < 2:
+        notice("Usage: grep <channel> <terms> [since], where the optional [since] is like 30m, 12h, 7d or 2w")
+        return
+    channel_name, terms = split[0], split[1:]
+
+    since = None
+    match = since_re.match(terms[-1])
+    if match and len(terms) > 1:
+        since = time.time() - int(match.group(1)) * since_units[match.group(2).lower()]
+        terms = terms[:-1]
+
+    channel = conn.channels.get(channel_name)
+    if channel is None or nick not in channel.users:
+        notice("You can only search channels we're both in.")
+        return
+    if not bot.search_index.enabled:
+        notice("History search is disabled.")
+        return
+
+    start = time.perf_counter()
+    records = yield from bot.search_index.search(conn.name, channel.name, " ".join(terms), since=since,
+                                                 limit=max_results)
+    duration = time.perf_counter() - start
+    if not records:
+        notice("No messages in {} matched '{}' ({:.0f}ms).".format(channel.name, " ".join(terms), duration * 1000))
+        return
+    notice("Latest {} messages in {} matching '{}' ({:.0f}ms):".format(len(records), channel.name, " ".join(terms),
+                                                                        duration * 1000))
+    for record in reversed(records):
+        notice(format_record(record))
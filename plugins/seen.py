@@ -0,0 +1,80 @@
+import asyncio
+import time
+
+from obrbot import hook
+from obrbot.event import EventType
+
+plugin_info = {
+    "plugin_category": "core",
+    "command_category_name": "Informational"
+}
+
+time_units = (("day", 86400), ("hour", 3600), ("minute", 60), ("second", 1))
+
+
+def format_time_ago(seconds):
+    """
+    Formats a duration using its two largest units, such as "2 days, 3 hours"
+    :type seconds: float
+    :rtype: str
+    """
+    parts = []
+    seconds = int(seconds)
+    for name, size in time_units:
+        count, seconds = divmod(seconds, size)
+        if count:
+            parts.append("{} {}{}".format(count, name, "" if count == 1 else "s"))
+        if len(parts) == 2:
+            break
+    return ", ".join(parts) or "0 seconds"
+
+
+def describe(sighting):
+    """
+    :type sighting: obrbot.seen.Sighting
+    :rtype: str
+    """
+    event_type = sighting.event_type
+    if event_type is EventType.message:
+        return "in {}, saying: {}".format(sighting.channel, sighting.content)
+    elif event_type is EventType.action:
+        return "in {}, saying: * {} {}".format(sighting.channel, sighting.nick, sighting.content)
+    elif event_type is EventType.join:
+        return "joining {}".format(sighting.channel)
+    elif event_type is EventType.part:
+        return "leaving {}".format(sighting.channel)
+    elif event_type is EventType.kick:
+        return "kicking someone from {}".format(sighting.channel)
+    elif event_type is EventType.topic:
+        return "changing the topic of {}".format(sighting.channel)
+    elif event_type is EventType.nick:
+        # content is "to <new nick>" or "from <old nick>"
+        return "changing nick {}".format(sighting.content)
+    elif event_type is EventType.quit:
+        return "quitting ({})".format(sighting.content)
+    return "in {}".format(sighting.channel)
+
+
+@asyncio.coroutine
+@hook.command("seen")
+def seen(text, conn, nick):
+    """<nick> - tells when <nick> was last seen, and what they were doing
+    :type text: str
+    :type conn: obrbot.connection.Connection
+    :type nick: str
+    """
+    target = text.split()[0]
+    if conn.casemapping.fold(target) == conn.casemapping.fold(nick):
+        return "Have you looked in a mirror lately?"
+    if conn.is_bot_nick(target):
+        return "I'm right here."
+
+    sighting = yield from conn.seen.lookup(target)
+    if sighting is None:
+        return "I haven't seen {}.".format(target)
+    ago = format_time_ago(time.time() - sighting.timestamp)
+    # only say where they were, and what they said, to someone in that channel with us
+    channel = conn.channels.get(sighting.channel)
+    if channel is None or nick not in channel.users:
+        return "{} was last seen {} ago.".format(sighting.nick, ago)
+    return "{} was last seen {} ago, {}".format(sighting.nick, ago, describe(sighting))
@@ -0,0 +1,45 @@
+import asyncio
+import time
+
+from obrbot import hook
+
+plugin_info = {
+    "plugin_category": "core",
+    "command_category_name": "Informational"
+}
+
+top_talker_count = 3
+
+
+@asyncio.coroutine
+@hook.command("stats", "activity", autohelp=False)
+def stats(text, bot, conn, chan_name, nick, notice):
+    """[channel] - shows how active [channel], or the current channel, has been over the last day
+    :type text: str
+    :type bot: obrbot.bot.ObrBot
+    :type conn: obrbot.connection.Connection
+    :type chan_name: str
+    :type nick: str
+    """
+    channel_name = text.split()[0] if text.strip() else chan_name
+    channel = conn.channels.get(channel_name) if channel_name else None
+    if channel is None or nick not in channel.users:
+        notice("You can only get stats for channels we're both in.")
+        return
+    channel_stats = bot.channel_stats
+    if not channel_stats.enabled:
+        notice("Channel statistics are disabled.")
+        return
+
+    now = time.time()
+    last_hour = yield from channel_stats.message_count(conn.name, channel.name, now - 3600, now)
+    last_day = yield from channel_stats.message_count(conn.name, channel.name, now - 86400, now)
+    speakers = yield from channel_stats.unique_speakers(conn.name, channel.name, now - 86400, now)
+    talkers = yield from channel_stats.top_talkers(conn.name, channel.name, now, now, count=top_talker_count)
+
+    result = "{}: {} message{} in the last hour, {} in the last day, from about {} nick{}.".format(
+        channel.name, last_hour, "" if last_hour == 1 else "s", last_day, speakers, "" if speakers == 1 else "s")
+    if talkers:
+        result += " Most active today: {}".format(", ".join("{} ({})".format(talker, count)
+                                                             for talker, count in talkers))
+    return result
@@ -0,0 +1,298 @@
+"""
+Tests for the asyncio redis client, against an in-process stand-in which speaks enough RESP for the commands used.
+
+Run from the repository root:
+    python -m unittest discover tests
+"""
+import asyncio
+import unittest
+
+from obrbot.database.redis import RedisClient, RedisError, ReplyError, ConnectionClosedError, read_reply
+
+
+class Status(bytes):
+    """
+    A simple string reply, such as +OK, rather than a bulk string
+    """
+    pass
+
+
+OK = Status(b"OK")
+QUEUED = Status(b"QUEUED")
+
+
+def encode_reply(reply):
+    """
+    :type reply: bytes | int | list | None | ReplyError
+    :rtype: bytes
+    """
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, ReplyError):
+        return "-{}\r\n".format(reply).encode("utf-8")
+    if isinstance(reply, Status):
+        return b"+" + reply + b"\r\n"
+    if isinstance(reply, int):
+        return ":{}\r\n".format(reply).encode("ascii")
+    if isinstance(reply, list):
+        return "*{}\r\n".format(len(reply)).encode("ascii") + b"".join(encode_reply(item) for item in reply)
+    return "${}\r\n".format(len(reply)).encode("ascii") + reply + b"\r\n"
+
+
+class RespServer:
+    """
+    A stand-in redis server. Commands are answered in the order they arrive on each connection, except HANG, which
+    is never answered, so tests can leave replies outstanding.
+
+    :type commands: list[list[bytes]]
+    :type clients: int
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.strings = {}
+        self.zsets = {}
+        self.commands = []
+        self.clients = 0
+        self._server = None
+        self._writers = []
+
+    @asyncio.coroutine
+    def start(self):
+        self._server = yield from asyncio.start_server(self._handle, "127.0.0.1", 0, loop=self.loop)
+        return self._server.sockets[0].getsockname()[1]
+
+    def drop_clients(self):
+        """
+        Closes every client connection, as if the server went away
+        """
+        for writer in self._writers:
+            writer.close()
+        self._writers = []
+
+    def close(self):
+        self.drop_clients()
+        if self._server is not None:
+            self._server.close()
+
+    @asyncio.coroutine
+    def _handle(self, reader, writer):
+        self.clients += 1
+        self._writers.append(writer)
+        # commands queued by MULTI, or None outside a transaction, and whether one of them was rejected
+        queued = None
+        aborted = False
+        while True:
+            try:
+                command = yield from read_reply(reader)
+            except (ConnectionError, asyncio.IncompleteReadError, RedisError):
+                break
+            self.commands.append(command)
+            name = command[0].upper()
+            if name == b"HANG":
+                continue
+            if name == b"MULTI":
+                queued, aborted = [], False
+                reply = OK
+            elif name == b"EXEC":
+                if aborted:
+                    reply = ReplyError("EXECABORT Transaction discarded because of previous errors.")
+                else:
+                    reply = [self._run(queued_command) for queued_command in queued]
+                queued = None
+            elif queued is not None:
+                if name in self._commands:
+                    queued.append(command)
+                    reply = QUEUED
+                else:
+                    aborted = True
+                    reply = self._run(command)
+            else:
+                reply = self._run(command)
+            writer.write(encode_reply(reply))
+        writer.close()
+
+    _commands = frozenset((b"PING", b"GET", b"SET", b"INCRBY", b"ZADD", b"ZRANGE", b"ZREVRANGE"))
+
+    def _run(self, command):
+        name, args = command[0].upper(), command[1:]
+        if name not in self._commands:
+            return ReplyError("ERR unknown command '{}'".format(command[0].decode()))
+        if name == b"PING":
+            return Status(b"PONG")
+        if name == b"GET":
+            return self.strings.get(args[0])
+        if name == b"SET":
+            self.strings[args[0]] = args[1]
+            return OK
+        if name == b"INCRBY":
+            try:
+                value = int(self.strings.get(args[0], b"0")) + int(args[1])
+            except ValueError:
+                return ReplyError("ERR value is not an integer or out of range")
+            self.strings[args[0]] = str(value).encode()
+            return value
+        if name == b"ZADD":
+            zset = self.zsets.setdefault(args[0], {})
+            pairs = list(zip(args[1::2], args[2::2]))
+            for score, member in pairs:
+                zset[member] = float(score)
+            return len(pairs)
+        members = sorted(self.zsets.get(args[0], {}).items(), key=lambda item: item[1],
+                         reverse=name == b"ZREVRANGE")
+        start, end = int(args[1]), int(args[2])
+        return [member for member, score in members[start:end + 1 if end >= 0 else len(members) + end + 1]]
+
+
+class RedisClientTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = RespServer(self.loop)
+        port = self.loop.run_until_complete(self.server.start())
+        self.client = RedisClient("127.0.0.1", port, pool_size=2, loop=self.loop)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+        # let the connections see they've been closed
+        self.loop.run_until_complete(asyncio.sleep(0.01, loop=self.loop))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def run_coroutine(self, coroutine):
+        return self.loop.run_until_complete(asyncio.wait_for(coroutine, 5, loop=self.loop))
+
+    def test_concurrent_replies(self):
+        @asyncio.coroutine
+        def test():
+            for index in range(50):
+                self.server.strings["key{}".format(index).encode()] = "value{}".format(index).encode()
+            replies = yield from asyncio.gather(*[self.client.get("key{}".format(index)) for index in range(50)],
+                                                loop=self.loop)
+            self.assertEqual(replies, ["value{}".format(index).encode() for index in range(50)])
+
+        self.run_coroutine(test())
+        # they were pipelined over the pool's connections, rather than each needing its own
+        self.assertLessEqual(self.server.clients, 2)
+
+    def test_error_reply(self):
+        @asyncio.coroutine
+        def test():
+            with self.assertRaises(ReplyError):
+                yield from self.client.execute_command("BOGUS")
+            # the connection is still usable, with later replies matched to the right commands
+            self.assertTrue((yield from self.client.set("a", "1")))
+            self.assertEqual((yield from self.client.get("a")), b"1")
+
+        self.run_coroutine(test())
+
+    def test_pipeline_error(self):
+        @asyncio.coroutine
+        def test():
+            pipeline = self.client.pipeline(transaction=False)
+            pipeline.set("a", "1").execute_command("BOGUS").get("a")
+            replies = yield from pipeline.execute(raise_on_error=False)
+            self.assertEqual(replies[0], True)
+            self.assertIsInstance(replies[1], ReplyError)
+            self.assertEqual(replies[2], b"1")
+
+            pipeline.set("b", "2").execute_command("BOGUS").get("b")
+            with self.assertRaises(ReplyError):
+                yield from pipeline.execute()
+            # commands after the error were still run
+            self.assertEqual(self.server.strings[b"b"], b"2")
+
+        self.run_coroutine(test())
+
+    def test_transaction(self):
+        @asyncio.coroutine
+        def test():
+            pipeline = self.client.pipeline()
+            pipeline.set("a", "1").incrby("a", 2).get("a")
+            self.assertEqual((yield from pipeline.execute()), [True, 3, b"3"])
+            self.assertEqual([command[0] for command in self.server.commands],
+                             [b"MULTI", b"SET", b"INCRBY", b"GET", b"EXEC"])
+
+            # errors running a queued command come back in EXEC's reply
+            pipeline.set("b", "x").incrby("b", 1).get("b")
+            replies = yield from pipeline.execute(raise_on_error=False)
+            self.assertEqual(replies[0], True)
+            self.assertIsInstance(replies[1], ReplyError)
+            self.assertEqual(replies[2], b"x")
+
+        self.run_coroutine(test())
+
+    def test_transaction_queue_error(self):
+        @asyncio.coroutine
+        def test():
+            pipeline = self.client.pipeline()
+            pipeline.set("a", "1").execute_command("BOGUS").get("a")
+            # the error queuing BOGUS is raised, rather than the EXECABORT it causes
+            with self.assertRaises(ReplyError) as context:
+                yield from pipeline.execute()
+            self.assertIn("unknown command", str(context.exception))
+            self.assertNotIn(b"a", self.server.strings)
+            # the EXECABORT reply was consumed, so the next reply goes to the next command
+            self.assertEqual((yield from self.client.ping()), True)
+
+        self.run_coroutine(test())
+
+    def test_connection_lost(self):
+        @asyncio.coroutine
+        def test():
+            yield from self.client.ping()
+            futures = [asyncio.async(self.client.execute_command("HANG"), loop=self.loop) for _ in range(3)]
+            while len(self.server.commands) < 4:
+                yield from asyncio.sleep(0.01, loop=self.loop)
+            self.server.drop_clients()
+            for future in futures:
+                with self.assertRaises(ConnectionClosedError):
+                    yield from future
+            # the closed connection is dropped, and a new one opened for the next command
+            self.assertEqual((yield from self.client.ping()), True)
+            self.assertEqual(len(self.client.connections), 1)
+
+        self.run_coroutine(test())
+
+    def test_pool(self):
+        @asyncio.coroutine
+        def test():
+            yield from self.client.ping()
+            yield from self.client.ping()
+            # the first connection had no replies outstanding, so it was reused
+            self.assertEqual(len(self.client.connections), 1)
+
+            hanging = asyncio.async(self.client.execute_command("HANG"), loop=self.loop)
+            while len(self.server.commands) < 3:
+                yield from asyncio.sleep(0.01, loop=self.loop)
+            yield from self.client.ping()
+            self.assertEqual(len(self.client.connections), 2)
+            self.assertEqual(self.server.clients, 2)
+
+            # the pool is full, so the least busy connection is used rather than opening a third
+            yield from self.client.ping()
+            self.assertEqual(self.server.clients, 2)
+            hanging.cancel()
+
+        self.run_coroutine(test())
+
+    def test_command_wrappers(self):
+        @asyncio.coroutine
+        def test():
+            self.assertTrue(asyncio.iscoroutinefunction(RedisClient.incr))
+            self.assertEqual((yield from self.client.incr("counter")), 1)
+            self.assertEqual((yield from self.client.incr("counter", 5)), 6)
+            self.assertEqual(self.server.commands[-1], [b"INCRBY", b"counter", b"5"])
+
+            yield from self.client.zadd("zset", 1, "a", 2, "b", 3, "c")
+            self.assertEqual((yield from self.client.zrange("zset", 0, -1, desc=True)), [b"c", b"b", b"a"])
+            self.assertEqual(self.server.commands[-1][0], b"ZREVRANGE")
+            self.assertEqual((yield from self.client.zrange("zset", 0, 1)), [b"a", b"b"])
+            self.assertEqual(self.server.commands[-1][0], b"ZRANGE")
+
+        self.run_coroutine(test())
+
+
+if __name__ == "__main__":
+    unittest.main()